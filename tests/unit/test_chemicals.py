@@ -0,0 +1,142 @@
+import itertools
+import re
+import sys
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+from scipy.stats import binom
+
+from vimms.Chemicals import Formula, Isotopes, ELEMENTS, ISOTOPES_AGGREGATED, ISOTOPES_FINE, parse_formula, \
+    get_formula_counts, get_formula_masses, FINE_ISOTOPE_RESOLUTION, MAX_ISOTOPE_PEAKS
+from vimms.IsotopeEngine import IsotopeEngine, ISOTOPE_TABLE, truncate_envelope
+
+
+def make_formulas(n=2000, seed=0):
+    rs = np.random.RandomState(seed)
+    elements = ELEMENTS + ['Na', 'K', 'Fe', 'Co', 'Se', 'B', 'Hg']
+    formulas = ['C6H12O6', 'C2H6O.HCl', '(C2H4O)n', 'C10H16N5O13P3-4', '[13C]6H12O6', 'CHCl3', 'CoCl2.6H2O',
+                'Si(CH3)4', 'ICl', 'C0H2', '']
+    for _ in range(n):
+        atoms = rs.choice(len(elements), rs.randint(1, 8))
+        formulas.append(''.join(elements[k] + (str(rs.randint(0, 60)) if rs.rand() < 0.8 else '') for k in atoms))
+    return formulas
+
+
+def count_atoms(formula_string, atom_name):
+    # one regular expression per atom, as Formula used to count atoms
+    return sum(int(n) if n else 1 for n in re.findall(atom_name + r'(?![a-z])(\d*)', formula_string))
+
+
+class TestFormula(unittest.TestCase):
+    def setUp(self):
+        self.formulas = make_formulas()
+
+    def test_counts_same_as_regex_per_atom(self):
+        for f in self.formulas:
+            expected = [count_atoms(f, atom) for atom in ELEMENTS]
+            self.assertEqual(expected, parse_formula(f).tolist())
+            self.assertEqual(count_atoms(f, 'Na'), Formula(f)._get_n_element('Na'))
+
+    def test_batch_masses_same_as_formula(self):
+        masses = get_formula_masses(self.formulas)
+        self.assertEqual([Formula(f).mass for f in self.formulas], masses.tolist())
+        self.assertEqual((0, len(ELEMENTS)), get_formula_counts([]).shape)
+        self.assertAlmostEqual(180.0633881, Formula('C6H12O6').mass, places=6)
+
+    def test_parsed_counts_are_read_only(self):
+        with self.assertRaises(ValueError):
+            parse_formula('C6H12O6')[0] = 1
+
+
+def enumerate_isotopologues(formula_string):
+    # the mass shift and abundance of every combination of isotopes of the atoms
+    atoms = [element for element, n in zip(ELEMENTS, parse_formula(formula_string)) for _ in range(n)]
+    shifts, abundances = [], []
+    for isotopes in itertools.product(*[ISOTOPE_TABLE[atom] for atom in atoms]):
+        shifts.append(sum(mass - ISOTOPE_TABLE[atom][0][0] for (mass, _, _), atom in zip(isotopes, atoms)))
+        abundances.append(np.prod([abundance for _, abundance, _ in isotopes]))
+    return np.array(shifts), np.array(abundances)
+
+
+class TestIsotopes(unittest.TestCase):
+    def test_carbon_isotopes_unchanged(self):
+        for f in ['C6H12O6', 'C60H100', 'C200H300']:
+            n_carbon = Formula(f).atoms['C']
+            proportions = []
+            while sum(proportions) < 0.99:
+                proportions.append(binom.pmf(len(proportions), n_carbon, 1 - 0.989))
+            expected = [p / sum(proportions) for p in proportions]
+            isotopes = Isotopes(Formula(f)).get_isotopes(0.99)
+            self.assertEqual(expected, [proportion for _, proportion, _ in isotopes])
+            self.assertEqual([Formula(f).mass + i * 1.0033548378 for i in range(len(expected))],
+                             [mz for mz, _, _ in isotopes])
+
+    def test_envelopes_same_as_enumeration(self):
+        aggregated = IsotopeEngine(ELEMENTS, min_abundance=1e-12)
+        fine = IsotopeEngine(ELEMENTS, fine=True, min_abundance=0, resolution=1e-7)
+        for f in ['C2H5ClOS', 'CH2Br2', 'C3H4N2O2Si']:
+            shifts, abundances = enumerate_isotopologues(f)
+
+            # isotopologues of the same nominal mass are summed in aggregated envelopes
+            nominal = np.round(shifts).astype(int)
+            expected_abundances = np.bincount(nominal, abundances)
+            expected_shifts = np.bincount(nominal, abundances * shifts) / expected_abundances
+            significant = expected_abundances >= 1e-6
+            actual_shifts, actual_abundances = aggregated.get_envelope(parse_formula(f))
+            self.assertTrue(np.allclose(expected_abundances[expected_abundances >= 1e-12], actual_abundances,
+                                        rtol=0, atol=1e-15))
+            self.assertTrue(np.allclose(expected_shifts[significant], actual_shifts[:np.sum(significant)],
+                                        rtol=0, atol=1e-6))
+
+            order = np.argsort(shifts)
+            unique_shifts, inverse = np.unique(np.round(shifts[order], 6), return_inverse=True)
+            actual_shifts, actual_abundances = fine.get_envelope(parse_formula(f))
+            self.assertTrue(np.allclose(unique_shifts, actual_shifts, rtol=0, atol=1e-6))
+            self.assertTrue(np.allclose(np.bincount(inverse.ravel(), abundances[order]), actual_abundances,
+                                        rtol=0, atol=1e-15))
+
+    def test_batch_same_as_single(self):
+        formulas = make_formulas(200)
+        batch = IsotopeEngine(ELEMENTS).get_envelopes(get_formula_counts(formulas))
+        for f, (shifts, abundances) in zip(formulas, batch):
+            single_shifts, single_abundances = IsotopeEngine(ELEMENTS).get_envelope(parse_formula(f))
+            self.assertTrue(np.allclose(single_shifts, shifts, rtol=0, atol=1e-8))
+            self.assertTrue(np.allclose(single_abundances, abundances, rtol=0, atol=1e-12))
+
+    def test_get_isotopes(self):
+        for method in [ISOTOPES_AGGREGATED, ISOTOPES_FINE]:
+            isotopes = Isotopes(Formula('C6H12O6Cl'), method).get_isotopes(0.99)
+            self.assertEqual((Formula('C6H12O6Cl').mass, 'Mono'), (isotopes[0][0], isotopes[0][2]))
+            self.assertAlmostEqual(1.0, sum(proportion for _, proportion, _ in isotopes))
+            self.assertIn('M+2', [name for _, _, name in isotopes])  # 37Cl
+        shifts, proportions = truncate_envelope(np.arange(4.0), np.array([0.5, 0.3, 0.15, 0.05]), 0.9)
+        self.assertEqual([0.0, 1.0, 2.0], shifts.tolist())
+        self.assertTrue(np.allclose([0.5 / 0.95, 0.3 / 0.95, 0.15 / 0.95], proportions))
+        shifts, proportions = truncate_envelope(np.arange(4.0), np.array([0.3, 0.5, 0.15, 0.05]), 0.9, max_peaks=2)
+        self.assertEqual([0.0, 1.0], shifts.tolist())
+        self.assertTrue(np.allclose([0.3 / 0.8, 0.5 / 0.8], proportions))
+
+    def test_fine_isotopes_merged_and_capped(self):
+        formula = Formula('C100H200Br3Cl2S')
+        unresolved = Isotopes(formula, ISOTOPES_FINE, resolution=1e-7, max_peaks=None).get_isotopes(0.99)
+        merged = Isotopes(formula, ISOTOPES_FINE, max_peaks=None).get_isotopes(0.99)
+        isotopes = Isotopes(formula, ISOTOPES_FINE).get_isotopes(0.99)
+        self.assertGreater(len(unresolved), 300)
+        self.assertLess(len(merged), len(unresolved))
+        self.assertEqual(MAX_ISOTOPE_PEAKS, len(isotopes))
+
+        # merged peaks are further apart than the resolution, and the most abundant peaks are kept in mass order
+        mzs = np.array([mz for mz, _, _ in merged])
+        self.assertGreaterEqual(np.min(np.diff(mzs)), FINE_ISOTOPE_RESOLUTION)
+        proportions = np.array([proportion for _, proportion, _ in merged])
+        kept = np.sort(np.argsort(-proportions)[:MAX_ISOTOPE_PEAKS])
+        self.assertEqual(mzs[kept].tolist(), [mz for mz, _, _ in isotopes])
+        self.assertTrue(np.allclose(proportions[kept] / np.sum(proportions[kept]),
+                                    [proportion for _, proportion, _ in isotopes]))
+        self.assertEqual(merged[0][2], isotopes[0][2])
+
+
+if __name__ == '__main__':
+    unittest.main()
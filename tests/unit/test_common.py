@@ -0,0 +1,56 @@
+import sys
+import unittest
+import zlib
+
+sys.path.append('..')
+
+import numpy as np
+
+from vimms.Common import RandomStreams
+
+
+def draw(rng, n=5):
+    return rng.random(n).tolist()
+
+
+class TestRandomStreams(unittest.TestCase):
+    def test_same_seed_and_name(self):
+        self.assertEqual(draw(RandomStreams(0).get('mass_spec')), draw(RandomStreams(0).get('mass_spec')))
+        self.assertEqual(draw(RandomStreams(0).child('sample').get('mass_spec')),
+                         draw(RandomStreams(0).child('sample').get('mass_spec')))
+        self.assertEqual(draw(RandomStreams(np.random.SeedSequence(0)).get('mass_spec')),
+                         draw(RandomStreams(0).get('mass_spec')))
+
+        # the same name always starts from the same state, and other names don't shift it
+        streams = RandomStreams(0)
+        expected = draw(streams.get('mass_spec'))
+        draw(streams.get('chemicals'), 100)
+        self.assertEqual(expected, draw(streams.get('mass_spec')))
+
+    def test_different_names_and_seeds(self):
+        streams = RandomStreams(0)
+        draws = [draw(streams.get(name)) for name in ['mass_spec', 'chemicals', 'peak_sampler']]
+        draws.append(draw(streams.child('mass_spec').get('mass_spec')))
+        draws.append(draw(RandomStreams(1).get('mass_spec')))
+        self.assertEqual(len(draws), len(set(map(tuple, draws))))
+
+    def test_spawn(self):
+        streams = RandomStreams(0)
+        spawned = streams.spawn(3)
+        self.assertEqual(3, len(spawned))
+        self.assertEqual(3, len(set(map(tuple, (draw(child.get('mass_spec')) for child in spawned)))))
+        self.assertEqual([draw(child.get('mass_spec')) for child in spawned],
+                         [draw(child.get('mass_spec')) for child in RandomStreams(0).spawn(3)])
+
+        # spawned hierarchies never share a spawn key with named ones, which used to happen for a name whose hash
+        # was one of the spawned indices
+        self.assertEqual([(i,) for i in range(3)], [child.seed_sequence.spawn_key for child in spawned])
+        self.assertEqual((RandomStreams.NAME_TAG, zlib.crc32(b'mass_spec')),
+                         streams._child_sequence('mass_spec').spawn_key)
+        named = [draw(streams.get('mass_spec')), draw(streams.child('mass_spec').get('mass_spec'))]
+        for child in spawned:
+            self.assertNotIn(draw(child.get('mass_spec')), named)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,330 @@
+import glob
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.append('..')
+
+import numpy as np
+
+from vimms.Chemicals import COMPOUND_TABLE_COLUMNS_V1
+from vimms.Common import set_log_level_warning
+from vimms.Controller import Precursor
+from vimms.DataGenerator import DataSource, PeakSampler, save_peak_sampler, load_peak_sampler, HISTOGRAM_DENSITY, \
+    extract_hmdb_metabolite, get_compound_table_file
+from vimms.MassSpec import Scan, ScanParameters
+from vimms.MzmlWriter import MzmlWriter
+
+
+def write_mzml(out_file, n=60, seed=0):
+    # an MS1 scan followed by three MS2 scans of its largest peaks
+    rs = np.random.RandomState(seed)
+    scans = {1: [], 2: []}
+    precursor_information = {}
+    ms1_scan = None
+    for scan_id in range(n):
+        rt = 10.0 + scan_id * 0.3 + rs.uniform(0, 0.1)
+        n_peaks = rs.randint(5, 30)
+        mzs = np.sort(rs.uniform(100, 900, n_peaks))
+        intensities = np.exp(rs.uniform(5, 15, n_peaks))
+        if scan_id % 4 == 0:
+            ms1_scan = Scan(scan_id, mzs, intensities, 1, rt)
+            scans[1].append(ms1_scan)
+        else:
+            pos = np.argsort(ms1_scan.intensities)[-(scan_id % 4)]
+            precursor = Precursor(ms1_scan.mzs[pos], ms1_scan.intensities[pos], 1, ms1_scan.scan_id)
+            params = ScanParameters()
+            params.set(ScanParameters.MS_LEVEL, 2)
+            params.set(ScanParameters.PRECURSOR_MZ, precursor)
+            scan = Scan(scan_id, mzs, intensities, 2, rt, scan_params=params)
+            scans[2].append(scan)
+            precursor_information[precursor] = [scan]
+    MzmlWriter('test', scans, precursor_information=precursor_information).write_mzML(out_file)
+
+
+def assert_same_data(test, expected, actual):
+    test.assertEqual(list(expected.file_spectra), list(actual.file_spectra))
+    for fname in expected.file_spectra:
+        for attr in ['ms_levels', 'scan_times', 'time_units', 'offsets', 'mzs', 'intensities']:
+            test.assertTrue(np.array_equal(getattr(expected.file_spectra[fname], attr),
+                                           getattr(actual.file_spectra[fname], attr)))
+        test.assertTrue(expected.precursor_info[fname].drop(columns='ms2_peaklist').equals(
+            actual.precursor_info[fname].drop(columns='ms2_peaklist')))
+        test.assertEqual(expected.file_scan_durations[fname], actual.file_scan_durations[fname])
+
+
+def query_peaks_by_spectrum(ds, filename, ms_level, min_intensity, min_rt, max_rt, min_mz, max_mz):
+    # one spectrum and one peak at a time, as DataSource used to
+    fnames = list(ds.file_spectra) if filename is None else [filename]
+    values = []
+    for fname in fnames:
+        for spectrum in ds.file_spectra[fname].values():
+            if spectrum.ms_level != ms_level:
+                continue
+            rt = ds._get_rt(spectrum)
+            for mz, intensity in spectrum.peaks('raw'):
+                if min_intensity is not None and intensity < min_intensity:
+                    continue
+                if (min_rt is not None and rt < min_rt) or (max_rt is not None and rt > max_rt):
+                    continue
+                if (min_mz is not None and mz < min_mz) or (max_mz is not None and mz > max_mz):
+                    continue
+                values.append((mz, rt, intensity))
+    return np.array(values).reshape(-1, 3)
+
+
+def write_hmdb(out_file, n=20):
+    # metabolites with nested elements of the same names, and some without a SMILES string that aren't extracted
+    metabolites = []
+    with open(out_file, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<hmdb xmlns="http://www.hmdb.ca">\n')
+        for i in range(n):
+            metabolite = ('HMDB%07d' % i, 'Compound & "%d"' % i, 'C%dH%dO' % (i + 1, 2 * i + 4), 50.0 + i / 3,
+                          None if i % 5 == 0 else 'C' * (i + 1) + 'O', 'InChI=1S/%d' % i, 'KEY%d' % i)
+            f.write('<metabolite><version>4.0</version><accession>%s</accession>'
+                    '<secondary_accessions><accession>HMDB%05d</accession></secondary_accessions>'
+                    '<name>Compound &amp; "%d"</name><taxonomy><name>taxon %d</name></taxonomy>'
+                    '<chemical_formula>%s</chemical_formula>'
+                    '<monisotopic_molecular_weight>%r</monisotopic_molecular_weight>'
+                    % (metabolite[0], i, i, i, metabolite[2], metabolite[3]))
+            if metabolite[4] is not None:
+                f.write('<smiles>%s</smiles>' % metabolite[4])
+                metabolites.append(metabolite)
+            f.write('<inchi>%s</inchi><inchikey>%s</inchikey></metabolite>\n' % metabolite[5:])
+        f.write('</hmdb>\n')
+    return metabolites
+
+
+def get_compound_values(compounds):
+    return [(compound.accession, compound.name, compound.chemical_formula, compound.monisotopic_molecular_weight,
+             compound.smiles, compound.inchi, compound.inchikey) for compound in compounds]
+
+
+class TestDataSource(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_log_level_warning()
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.mzml_dir = os.path.join(cls.tmp_dir, 'mzml')
+        for i in range(3):
+            write_mzml(os.path.join(cls.mzml_dir, 'run_%d.mzML' % i), seed=i)
+        cls.ds = DataSource()
+        cls.ds.load_data(cls.mzml_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_parallel_load_same_as_serial(self):
+        self.assertEqual(['run_0.mzML', 'run_1.mzML', 'run_2.mzML'], list(self.ds.file_spectra))
+        for n_jobs in [2, None]:
+            ds = DataSource()
+            ds.load_data(self.mzml_dir, n_jobs=n_jobs)
+            assert_same_data(self, self.ds, ds)
+            self.assertEqual({}, ds.load_errors)
+
+    def test_parallel_load_skips_corrupt_files(self):
+        mzml_dir = os.path.join(self.tmp_dir, 'corrupt')
+        shutil.copytree(self.mzml_dir, mzml_dir)
+        with open(os.path.join(mzml_dir, 'bad.mzML'), 'w') as f:
+            f.write('<?xml version="1.0" encoding="utf-8"?>\n<mzML><run><spectrumList count="1"><spectrum')
+        ds = DataSource()
+        ds.load_data(mzml_dir, n_jobs=2)
+        self.assertEqual(['bad.mzML'], list(ds.load_errors))
+        assert_same_data(self, self.ds, ds)
+
+    def test_cache_invalidation(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        mzml_file = os.path.join(self.tmp_dir, 'cached.mzML')
+        shutil.copy(os.path.join(self.mzml_dir, 'run_0.mzML'), mzml_file)
+
+        ds = DataSource()
+        extracted = ds.extract_file_cached(mzml_file, cache_dir)
+        self.assertEqual(1, len(glob.glob(os.path.join(cache_dir, '*.npz'))))
+
+        # the cache is used when the file and the parameters are the same
+        cached = DataSource()
+        cached.extract_file = None
+        self.assertTrue(np.array_equal(extracted[0].mzs, cached.extract_file_cached(mzml_file, cache_dir)[0].mzs))
+
+        # but not when the file content changes, even with the same name
+        shutil.copy(os.path.join(self.mzml_dir, 'run_1.mzML'), mzml_file)
+        changed = ds.extract_file_cached(mzml_file, cache_dir)
+        self.assertTrue(np.array_equal(self.ds.file_spectra['run_1.mzML'].mzs, changed[0].mzs))
+        self.assertEqual(2, len(glob.glob(os.path.join(cache_dir, '*.npz'))))
+
+        # or when the extraction parameters change
+        ds.ms1_precision = 1e-5
+        ds.extract_file_cached(mzml_file, cache_dir)
+        self.assertEqual(3, len(glob.glob(os.path.join(cache_dir, '*.npz'))))
+
+        # invalid cache files are replaced
+        cache_file = os.path.join(cache_dir, '%s.npz' % ds._get_cache_key(mzml_file))
+        with open(cache_file, 'wb') as f:
+            f.write(b'not a cache file')
+        self.assertTrue(np.array_equal(changed[0].mzs, ds.extract_file_cached(mzml_file, cache_dir)[0].mzs))
+        self.assertTrue(np.array_equal(changed[0].mzs, cached.extract_file_cached(mzml_file, cache_dir)[0].mzs))
+
+    def test_query_peaks_same_as_by_spectrum(self):
+        queries = [
+            (None, 1, None, None, None, None, None),
+            ('run_1.mzML', 1, 1e4, 12, 20, None, None),
+            (None, 2, 5e3, None, 25, 200, 600),
+            ('run_2.mzML', 2, None, 15, None, None, 500)
+        ]
+        for query in queries:
+            expected = query_peaks_by_spectrum(self.ds, *query)
+            peaks = self.ds.query_peaks(query[0], query[1], min_intensity=query[2], min_rt=query[3], max_rt=query[4],
+                                        min_mz=query[5], max_mz=query[6])
+            self.assertGreater(len(expected), 0)
+            self.assertTrue(np.array_equal(expected, np.stack([peaks['mz'], peaks['rt'], peaks['intensity']], axis=1)))
+            self.assertTrue(np.array_equal(np.log(expected[:, 2]), peaks['log_intensity']))
+
+            n_peaks = self.ds.get_n_peaks(query[0], query[1], min_intensity=query[2], min_rt=query[3],
+                                          max_rt=query[4])
+            self.assertEqual(len(self.ds.query_peaks(query[0], query[1], min_intensity=query[2], min_rt=query[3],
+                                                     max_rt=query[4])['mz']), n_peaks.sum())
+
+
+class TestPeakSampler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_log_level_warning()
+        cls.tmp_dir = tempfile.mkdtemp()
+        for i in range(3):
+            write_mzml(os.path.join(cls.tmp_dir, 'run_%d.mzML' % i), seed=i)
+        cls.ds = DataSource()
+        cls.ds.load_data(cls.tmp_dir)
+        cls.ps = PeakSampler(cls.ds, 0, 100, 0, 0)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def get_peaks(self, ps, rng=None):
+        return [(peak.mz, peak.rt, peak.intensity) for peak in ps.get_peak(1, 5, min_mz=100, max_mz=200, rng=rng)]
+
+    def test_reseeding_global_state_reproduces_peaks(self):
+        # samplers with the same acceptance rates, e.g. freshly loaded ones, draw the same peaks after re-seeding
+        def draw_after_seeding():
+            ps = pickle.loads(pickle.dumps(self.ps))
+            np.random.seed(0)
+            return [self.get_peaks(ps) for _ in range(3)]
+
+        self.assertEqual(draw_after_seeding(), draw_after_seeding())
+
+    def test_global_state_draws_only_what_is_needed(self):
+        vals = self.ps.sample(1, 100000, rng=np.random.default_rng(0))
+        rate = np.mean((vals[:, 0] >= 100) & (vals[:, 0] <= 200))
+        self.assertGreater(rate, 0.01)
+
+        ps = pickle.loads(pickle.dumps(self.ps))
+        n_drawn = []
+        sample = ps.sample
+        ps.sample = lambda ms_level, n_sample, rng=None: n_drawn.append(n_sample) or sample(ms_level, n_sample, rng)
+        np.random.seed(0)
+        for _ in range(300):
+            self.assertEqual(1, len(ps.get_peak(1, 1, min_mz=100, max_mz=200)))
+        self.assertLess(sum(n_drawn), 3 * 300 / rate)
+
+    def test_same_stream_reproduces_peaks(self):
+        # peaks drawn from an explicit stream are kept for the next calls, and a fresh sampler draws the same ones
+        rng = np.random.default_rng(1)
+        expected = [self.get_peaks(self.ps, rng=rng) for _ in range(3)]
+        copied = pickle.loads(pickle.dumps(self.ps))
+        rng = np.random.default_rng(1)
+        self.assertEqual(expected, [self.get_peaks(copied, rng=rng) for _ in range(3)])
+
+    def test_save_and_load_same_draws(self):
+        def draw(ps, seed):
+            rng = np.random.default_rng(seed)
+            return (self.get_peaks(ps, rng=rng), ps.n_peaks(2, 10, rng=rng).tolist(),
+                    ps.scan_durations(1, 2, 5, 0, 0, rng=rng).tolist(),
+                    [(scan.scan_id, scan.mzs.tolist(), scan.intensities.tolist())
+                     for scan in ps.get_ms2_spectra(3, rng=rng)],
+                    ps.get_parent_intensity_proportion(2, rng=rng).tolist())
+
+        for ps in [self.ps, PeakSampler(self.ds, 0, 100, 0, 0, density=HISTOGRAM_DENSITY, n_bins=20)]:
+            out_dir = os.path.join(self.tmp_dir, 'saved_%s' % ps.density)
+            save_peak_sampler(ps, out_dir)
+            loaded = load_peak_sampler(out_dir)
+            for seed in [0, 1]:
+                self.assertEqual(draw(ps, seed), draw(loaded, seed))
+
+    def test_load_version_1(self):
+        # version 1 stored the MS2 spectra as peaks of (m/z, rt, intensity) and the columns of the precursor dataframe
+        out_dir = os.path.join(self.tmp_dir, 'saved_v1')
+        save_peak_sampler(self.ps, out_dir)
+        library = self.ps.ms2_library
+        rts = np.repeat(library.rts, np.diff(library.offsets))
+        arrays = {'ms2_scan_ids': library.scan_ids, 'ms1_mz': library.precursor_mzs,
+                  'ms1_scan_rt': library.precursor_rts, 'ms1_intensity': library.precursor_intensities,
+                  'ms2_peak_offsets': library.offsets,
+                  'ms2_peaks': np.stack([library.mzs, rts, library.intensities], axis=1)}
+        for name in glob.glob(os.path.join(out_dir, 'ms2_library_*.npy')):
+            os.remove(name)
+        for name, value in arrays.items():
+            np.save(os.path.join(out_dir, '%s.npy' % name), value)
+        with open(os.path.join(out_dir, 'header.json')) as f:
+            header = json.load(f)
+        header['version'] = 1
+        with open(os.path.join(out_dir, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+        loaded = load_peak_sampler(out_dir).ms2_library
+        for name in ['scan_ids', 'rts', 'precursor_mzs', 'precursor_rts', 'precursor_intensities', 'offsets', 'mzs',
+                     'intensities']:
+            self.assertTrue(np.array_equal(getattr(library, name), getattr(loaded, name)))
+
+
+class TestExtractHmdbMetabolite(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_file = os.path.join(self.tmp_dir, 'hmdb_metabolites.xml')
+        self.expected = write_hmdb(self.xml_file)
+        self.zip_file = os.path.join(self.tmp_dir, 'hmdb_metabolites.zip')
+        with zipfile.ZipFile(self.zip_file, 'w') as zf:
+            zf.write(self.xml_file, 'hmdb_metabolites.xml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_extract(self):
+        for in_file in [self.xml_file, self.zip_file]:
+            compounds = extract_hmdb_metabolite(in_file, delete=False, use_cache=False)
+            self.assertEqual(self.expected, get_compound_values(compounds))
+        self.assertFalse(os.path.exists(get_compound_table_file(self.zip_file)))
+
+    def test_cache_round_trip(self):
+        table_file = get_compound_table_file(self.zip_file)
+        self.assertEqual(self.expected, get_compound_values(extract_hmdb_metabolite(self.zip_file, delete=False)))
+        self.assertTrue(os.path.exists(table_file))
+
+        # the compounds are loaded from the table, and the HMDB file is still deleted
+        self.assertEqual(self.expected, get_compound_values(extract_hmdb_metabolite(self.zip_file)))
+        self.assertFalse(os.path.exists(self.zip_file))
+        self.assertEqual(self.expected, get_compound_values(extract_hmdb_metabolite(self.zip_file)))
+
+    def test_old_table_replaced(self):
+        table_file = get_compound_table_file(self.xml_file)
+        with open(table_file, 'w') as f:
+            f.write('\t'.join(COMPOUND_TABLE_COLUMNS_V1) + '\nHMDB0000001\tname\tC2H6O\t46.0\n')
+        self.assertEqual(self.expected, get_compound_values(extract_hmdb_metabolite(self.xml_file, delete=False)))
+        self.assertEqual(self.expected, get_compound_values(extract_hmdb_metabolite(self.xml_file)))
+
+    def test_unwritable_cache(self):
+        # a directory where the table should be can neither be read nor replaced
+        os.mkdir(get_compound_table_file(self.xml_file))
+        self.assertEqual(self.expected, get_compound_values(extract_hmdb_metabolite(self.xml_file)))
+        self.assertFalse(os.path.exists(self.xml_file))
+        self.assertEqual([], glob.glob(os.path.join(self.tmp_dir, '*.tmp')))
+
+
+if __name__ == '__main__':
+    unittest.main()
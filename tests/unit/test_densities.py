@@ -0,0 +1,92 @@
+import pickle
+import sys
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+from scipy.stats import ks_2samp
+from sklearn.neighbors import KernelDensity
+
+from vimms.Densities import HistogramDensity, get_density_arrays, make_density
+from vimms.Kernels import build_alias_table
+
+
+def make_data(n=20000, seed=0):
+    # (m/z, log intensity, rt) like data: clusters of different sizes and spreads
+    rs = np.random.RandomState(seed)
+    centres = np.array([[150, 10, 200], [300, 12, 450], [420, 9, 800], [700, 14, 1000]])
+    scales = np.array([[30, 1, 60], [50, 1.5, 100], [20, 0.5, 40], [80, 2, 150]])
+    sizes = rs.multinomial(n, [0.4, 0.3, 0.2, 0.1])
+    return np.concatenate([rs.normal(c, s, (k, 3)) for c, s, k in zip(centres, scales, sizes)])
+
+
+class TestAliasTable(unittest.TestCase):
+    def test_alias_table_probabilities(self):
+        rs = np.random.RandomState(1)
+        probs = rs.dirichlet(np.full(50, 0.5))
+        prob, alias = build_alias_table(probs)
+
+        # the probability of each outcome is the chance to draw it and keep it, plus the chance to be an alias
+        n = len(probs)
+        actual = prob / n + np.bincount(alias, weights=(1 - prob) / n, minlength=n)
+        self.assertTrue(np.allclose(probs, actual, atol=1e-12))
+
+
+class TestGaussianKernelDensity(unittest.TestCase):
+    def test_same_as_sklearn(self):
+        X = make_data(n=2000)
+        kde = KernelDensity(kernel='gaussian', bandwidth=2.0).fit(X)
+        kind, params, arrays = get_density_arrays(kde)
+        loaded = make_density(kind, params, arrays)
+        self.assertTrue(np.array_equal(kde.sample(100, random_state=0), loaded.sample(100, random_state=0)))
+        self.assertTrue(np.allclose(kde.score_samples(X[:50]), loaded.score_samples(X[:50])))
+
+
+class TestHistogramDensity(unittest.TestCase):
+    """
+    Compares the histogram density to sklearn's KernelDensity with the same bandwidth.
+    With 100 bins per dimension, the marginals of 20000 samples are within a Kolmogorov-Smirnov distance of 0.03 of
+    the marginals of the KDE samples. In 1D with 500 bins, the log densities differ by less than 0.05 wherever the
+    density is above 1% of its maximum. The fitted model is several times smaller than the KDE.
+    """
+
+    def setUp(self):
+        self.X = make_data()
+        self.kde = KernelDensity(kernel='gaussian', bandwidth=1.0).fit(self.X)
+        self.hist = HistogramDensity(n_bins=100, bandwidth=1.0).fit(self.X)
+
+    def test_samples_match_kde(self):
+        hist_samples = self.hist.sample(20000, random_state=0)
+        kde_samples = self.kde.sample(20000, random_state=1)
+        self.assertEqual(hist_samples.shape, (20000, 3))
+        for j in range(3):
+            self.assertLess(ks_2samp(hist_samples[:, j], kde_samples[:, j]).statistic, 0.03)
+        self.assertTrue(np.allclose(hist_samples.mean(axis=0), kde_samples.mean(axis=0), rtol=0.02))
+
+    def test_log_density_matches_kde(self):
+        X = self.X[:, [0]]
+        kde = KernelDensity(kernel='gaussian', bandwidth=5.0).fit(X)
+        hist = HistogramDensity(n_bins=500, bandwidth=5.0).fit(X)
+        grid = np.linspace(X.min() - 50, X.max() + 50, 2000)[:, np.newaxis]
+        kde_density = np.exp(kde.score_samples(grid))
+        hist_density = np.exp(hist.score_samples(grid))
+        self.assertAlmostEqual(np.sum(hist_density) * (grid[1, 0] - grid[0, 0]), 1.0, places=4)
+        dense = kde_density > 0.01 * kde_density.max()
+        self.assertLess(np.max(np.abs(np.log(hist_density[dense]) - np.log(kde_density[dense]))), 0.05)
+
+    def test_plain_histogram_stays_in_range(self):
+        hist = HistogramDensity(n_bins=20).fit(self.X)
+        samples = hist.sample(10000, random_state=0)
+        self.assertTrue(np.all(samples >= self.X.min(axis=0)))
+        self.assertTrue(np.all(samples <= self.X.max(axis=0)))
+
+    def test_pickle_is_small(self):
+        hist_size = len(pickle.dumps(self.hist))
+        self.assertLess(hist_size, len(pickle.dumps(self.kde)) / 4)
+        hist = pickle.loads(pickle.dumps(self.hist))
+        self.assertTrue(np.array_equal(hist.sample(100, random_state=0), self.hist.sample(100, random_state=0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append('..')
+
+from pathlib import Path
+
+import numpy as np
+import pymzml
+
+from vimms.Common import POSITIVE, load_obj, set_log_level_warning
+from vimms.Controller import TopNController, FixedScheduleController
+from vimms.Dispatch import Channel, EventDispatcher
+from vimms.Environment import Environment, AsyncEnvironment, ShardedEnvironment
+from vimms.MassSpec import IndependentMassSpectrometer
+from vimms.Sinks import ScanSink
+from vimms.Trace import TraceRecorder, load_trace, TRACE_DTYPE
+
+fixtures_dir = Path(os.path.dirname(os.path.realpath(__file__)), '..', 'integration', 'fixtures')
+beer_chems = load_obj(Path(fixtures_dir, 'QCB_22May19_1.p'))
+
+
+class ScanDurationSampler(object):
+    """
+    Provides the scan durations of a mass spec without a trained PeakSampler
+    """
+    DURATIONS = {(1, 1): [0.4, 0.5, 0.45], (1, 2): [0.2, 0.25], (2, 1): [0.3, 0.35], (2, 2): [0.1, 0.12, 0.15]}
+
+    def scan_durations(self, previous_level, current_level, n_sample, N, DEW, rng=None):
+        rng = np.random if rng is None else rng
+        return rng.choice(self.DURATIONS[(previous_level, current_level)], size=n_sample, replace=False)
+
+    def get_msn_noisy_intensity(self, intensity, ms_level):
+        return intensity
+
+    def get_noise_sample(self):
+        return []
+
+
+class RecordingSink(ScanSink):
+    """
+    Keeps the ids of the scans it receives, and fails on a given scan if set
+    """
+
+    def __init__(self, fail_at=None, delay=0):
+        self.fail_at = fail_at
+        self.delay = delay
+        self.scan_ids = []
+        self.closed = False
+
+    def handle_scan(self, scan):
+        time.sleep(self.delay)
+        if len(self.scan_ids) + 1 == self.fail_at:
+            raise ValueError('Sink failed')
+        self.scan_ids.append(scan.scan_id)
+
+    def close(self):
+        self.closed = True
+
+
+class CrashingTopNController(TopNController):
+    """
+    A Top-N controller that fails after a given time, to interrupt a run
+    """
+
+    def __init__(self, *args, crash_time=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.crash_time = crash_time
+
+    def update_state_after_scan(self, last_scan):
+        if self.crash_time is not None and last_scan.rt > self.crash_time:
+            raise RuntimeError('Crashed at %f' % last_scan.rt)
+        super().update_state_after_scan(last_scan)
+
+
+def make_environment(cls=Environment, min_time=200, max_time=260, seed=0, crash_time=None, controller=None,
+                     **kwargs):
+    np.random.seed(seed)
+    mass_spec = IndependentMassSpectrometer(POSITIVE, beer_chems, ScanDurationSampler())
+    if controller is None:
+        controller = CrashingTopNController(POSITIVE, 5, 1, 10, 15, 1.75e5, crash_time=crash_time)
+    return cls(mass_spec, controller, min_time, max_time, progress_bar=False, **kwargs)
+
+
+def get_scans(env):
+    return [(scan.scan_id, scan.rt, scan.ms_level, scan.mzs.tolist(), scan.intensities.tolist())
+            for ms_level in sorted(env.controller.scans) for scan in env.controller.scans[ms_level]]
+
+
+class TestDispatch(unittest.TestCase):
+    def test_channel_is_fifo(self):
+        channel = Channel()
+        self.assertIsNone(channel.peek())
+        channel.put(1)
+        channel.extend([2, 3])
+        self.assertEqual((3, 1), (len(channel), channel.peek()))
+        self.assertEqual([1, 2], [channel.get(), channel.get()])
+        self.assertEqual([3], list(channel))
+        channel.clear()
+        self.assertEqual(0, len(channel))
+
+    def test_dispatcher_calls_handlers_in_order(self):
+        calls = []
+        dispatcher = EventDispatcher(['a', 'b'])
+        dispatcher.register('a', lambda arg: calls.append(('first', arg)))
+        dispatcher.register('a', lambda arg: calls.append(('second', arg)))
+        dispatcher.register('b', lambda: calls.append(('b', None)))
+        dispatcher.fire('a', 1)
+        dispatcher.fire('b')
+        self.assertEqual([('first', 1), ('second', 1), ('b', None)], calls)
+        dispatcher.clear_all()
+        dispatcher.fire('a', 2)
+        self.assertEqual(3, len(calls))
+        with self.assertRaises(ValueError):
+            dispatcher.register('c', print)
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+
+    def test_recorder_chunks_and_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_file = os.path.join(tmp_dir, 'trace', 'trace.npy')
+            recorder = TraceRecorder(out_file, chunk_size=4)
+            for i in range(10):
+                recorder.record(i, i * 0.5, 1 + i % 2, 1, i % 3, i, 0.001)
+            self.assertEqual(10, len(recorder))
+            recorder.close()
+            trace = load_trace(out_file)
+        self.assertEqual(TRACE_DTYPE, trace.dtype)
+        self.assertEqual(list(range(10)), trace['scan_id'].tolist())
+        self.assertEqual([i % 3 for i in range(10)], trace['n_tasks'].tolist())
+
+    def test_environment_trace(self):
+        recorder = TraceRecorder(chunk_size=16)
+        env = make_environment(trace_recorder=recorder)
+        env.run()
+        trace = recorder.get_trace()
+        scans = sorted(get_scans(env))
+        self.assertEqual([scan_id for scan_id, _, _, _, _ in scans], trace['scan_id'].tolist())
+        self.assertEqual([ms_level for _, _, ms_level, _, _ in scans], trace['ms_level'].tolist())
+        self.assertTrue(np.all(trace['scan_channel_size'] == 1))  # each scan is handled as soon as it arrives
+        self.assertTrue(np.all(trace['n_tasks'][trace['ms_level'] == 2] == 0))
+        self.assertTrue(np.any(trace['n_tasks'][trace['ms_level'] == 1] > 0))
+
+
+class TestIterScans(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+
+    def test_same_scans_as_run(self):
+        env = make_environment()
+        env.run()
+        expected = sorted(get_scans(env), key=lambda scan: scan[0])
+        for keep_history in [True, False]:
+            env = make_environment()
+            scans = [(scan.scan_id, scan.rt, scan.ms_level, scan.mzs.tolist(), scan.intensities.tolist())
+                     for scan in env.iter_scans(keep_history=keep_history)]
+            self.assertEqual(expected, scans)
+            if keep_history:
+                self.assertEqual(expected, sorted(get_scans(env), key=lambda scan: scan[0]))
+
+    def test_close_early(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = make_environment(out_dir=tmp_dir, out_file='early.mzML', stream_mzML=True)
+            env.progress_bar = True
+            bars = []
+            close_progress_bar = env.close_progress_bar
+            env.close_progress_bar = lambda bar: bars.append(bar) or close_progress_bar(bar)
+
+            generator = env.iter_scans()
+            scans = [next(generator) for _ in range(10)]
+            generator.close()
+            with self.assertRaises(StopIteration):
+                next(generator)
+            self.assertEqual(scans[-1].rt + scans[-1].scan_duration, env.mass_spec.time)
+            self.assertIsNone(env.mzml_writer)
+            self.assertEqual(1, len(bars))
+            self.assertTrue(bars[0].disable)  # closed
+            spectra = list(pymzml.run.Reader(os.path.join(tmp_dir, 'early.mzML')))
+            self.assertEqual([scan.scan_id for scan in scans], [spectrum.ID for spectrum in spectra])
+
+    def test_history_stays_bounded(self):
+        env = make_environment()
+        n_scans = 0
+        for _ in env.iter_scans():
+            n_scans += 1
+            self.assertEqual(0, sum(len(scans) for scans in env.controller.scans.values()))
+            self.assertEqual(0, len(env.controller.precursor_information))
+            self.assertEqual(0, len(env.mass_spec.fragmentation_events))
+        self.assertGreater(n_scans, 100)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+
+    def test_resumed_run_same_as_uninterrupted(self):
+        env = make_environment()
+        env.run()
+        expected = get_scans(env)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_file = os.path.join(tmp_dir, 'checkpoint.p')
+            env = make_environment(crash_time=235, checkpoint_file=checkpoint_file, checkpoint_interval=10)
+            with self.assertRaises(RuntimeError):
+                env.run()
+
+            env = Environment.load_checkpoint(checkpoint_file)
+            self.assertTrue(220 <= env.mass_spec.time <= 235)
+            env.controller.crash_time = None
+            env.resume()
+        self.assertEqual(expected, get_scans(env))
+
+    def test_warm_start(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_file = os.path.join(tmp_dir, 'checkpoint.p')
+            env = make_environment(max_time=230, checkpoint_file=checkpoint_file)
+            env.run()
+            prefix = get_scans(env)
+            checkpoint_time = env.mass_spec.time
+            expected_state = np.random.get_state()
+
+            results = []
+            for _ in range(2):
+                np.random.seed(42)  # overwritten by the checkpoint
+                env = Environment.load_checkpoint(checkpoint_file)
+                self.assertEqual(checkpoint_time, env.mass_spec.time)
+                state = np.random.get_state()
+                self.assertEqual(expected_state[1].tolist(), state[1].tolist())
+                self.assertEqual(expected_state[2:], state[2:])
+
+                controller = TopNController(POSITIVE, 1, 1, 10, 15, 1.75e5)
+                self.assertIs(env, env.warm_start(controller, max_time=260))
+                env.resume()
+                self.assertIs(controller, env.controller)
+                results.append(get_scans(env))
+
+        # the same continuation each time, after the scans of the checkpoint
+        self.assertEqual(results[0], results[1])
+        scans = sorted(results[0], key=lambda scan: scan[0])
+        self.assertEqual(sorted(prefix, key=lambda scan: scan[0]), scans[:len(prefix)])
+        new_scans = scans[len(prefix):]
+        self.assertGreater(len(new_scans), 0)
+        self.assertTrue(all(rt >= checkpoint_time for _, rt, _, _, _ in new_scans))
+
+        # the new Top-1 controller makes at most one MS2 scan after each MS1 scan it handles, the old one made more
+        ms_levels = ''.join(str(ms_level) for _, _, ms_level, _, _ in scans)
+        self.assertIn('22', ms_levels[:len(prefix)])
+        new_levels = ms_levels[len(prefix):]
+        self.assertNotIn('22', new_levels[new_levels.index('1'):])
+
+
+class TestAsyncEnvironment(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+
+    def test_same_scans_as_environment(self):
+        env = make_environment(max_time=230)
+        env.run()
+        sink = RecordingSink()
+        async_env = make_environment(AsyncEnvironment, max_time=230, sinks=[sink], sink_queue_size=3)
+        async_env.run()
+        self.assertEqual(get_scans(env), get_scans(async_env))
+        self.assertEqual(sorted(scan_id for scan_id, _, _, _, _ in get_scans(env)), sink.scan_ids)
+        self.assertTrue(sink.closed)
+
+    def test_failing_sink_stops_the_run(self):
+        # the slow sink fails while its queue is full, which used to block the run forever
+        sinks = [RecordingSink(), RecordingSink(fail_at=5, delay=0.05)]
+        env = make_environment(AsyncEnvironment, sinks=sinks, sink_queue_size=3)
+        with self.assertRaises(ValueError):
+            asyncio.run(asyncio.wait_for(env.run_async(), 30))
+        self.assertTrue(all(sink.closed for sink in sinks))
+
+
+class TestShardedEnvironment(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+
+    def make_controller(self):
+        return FixedScheduleController.from_dia_windows('basic', None, 0, num_windows=10)
+
+    def get_fragmentation_events(self, env):
+        return [(frag.scan_id, frag.ms_level, frag.query_rt, id(frag.chem),
+                 [(peak.mz, peak.rt, np.asarray(peak.intensity).tolist(), peak.ms_level) for peak in frag.peaks])
+                for frag in env.mass_spec.fragmentation_events]
+
+    def test_same_as_serial(self):
+        env = make_environment(controller=self.make_controller(), max_time=230)
+        env.run()
+        sharded = make_environment(ShardedEnvironment, controller=self.make_controller(), max_time=230, n_shards=5,
+                                   max_workers=2)
+        sharded.run()
+        self.assertGreater(len(get_scans(env)), 0)
+        self.assertEqual(get_scans(env), get_scans(sharded))
+        self.assertGreater(len(env.mass_spec.fragmentation_events), 0)
+        self.assertEqual(self.get_fragmentation_events(env), self.get_fragmentation_events(sharded))
+
+    def test_needs_fixed_schedule(self):
+        with self.assertRaises(ValueError):
+            make_environment(ShardedEnvironment, max_workers=1).run()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import bisect
+import sys
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+from scipy.stats import norm
+
+from vimms.Kernels import NUMBA_AVAILABLE, roi_assign, greedy_cluster_labels, find_exclusion, \
+    mixture_log_likelihoods, observed_weighted_sums, build_alias_table
+from vimms.Roi import Roi, match, update_roi, roi_correlation, greedy_roi_cluster
+
+
+def make_scans(n_scans=20, n_ions=100, seed=0):
+    rs = np.random.RandomState(seed)
+    ions = np.sort(rs.uniform(100, 1000, n_ions))
+    scans = []
+    for rt in range(n_scans):
+        mzs = ions[rs.rand(n_ions) < 0.8]
+        mzs = np.concatenate([mzs + rs.normal(0, 0.002, len(mzs)), rs.uniform(100, 1000, 10)])
+        rs.shuffle(mzs)
+        scans.append((float(rt), mzs, rs.uniform(1e4, 1e6, len(mzs))))
+    return scans
+
+
+def make_roi_list(scans, mz_tol, mz_units):
+    # like make_roi, ROI that don't grow in a scan are closed, so all ROI have consecutive retention times
+    live_roi = []
+    dead_roi = []
+    for rt, mzs, intensities in scans:
+        live_roi.sort()
+        n_points = [r.n for r in live_roi]
+        updated_roi, positions = update_roi(live_roi, mzs, rt, intensities, mz_tol, mz_units=mz_units)
+        dead_roi.extend(r for r, n in zip(live_roi, n_points) if r.n == n)
+        live_roi = [r for r, pos in zip(updated_roi, positions) if pos is None or r.n > n_points[pos]]
+    return dead_roi + live_roi
+
+
+class TestRoiKernels(unittest.TestCase):
+    """
+    Tests that the ROI kernels give the same results as the original algorithms
+    """
+
+    def test_update_roi_same_as_match(self):
+        scans = make_scans()
+        for mz_tol, mz_units in [(0.005, 'Da'), (10, 'ppm')]:
+            expected = []
+            for rt, mzs, intensities in scans:
+                expected.sort()
+                for mz, intensity in zip(mzs, intensities):
+                    match_roi = match(Roi(mz, 0, 0), expected, mz_tol, mz_units=mz_units)
+                    if match_roi:
+                        match_roi.add(mz, rt, intensity)
+                    else:
+                        bisect.insort_right(expected, Roi(mz, rt, intensity))
+            actual = []
+            for rt, mzs, intensities in scans:
+                actual.sort()
+                actual, _ = update_roi(actual, mzs, rt, intensities, mz_tol, mz_units=mz_units)
+            self.assertEqual([r.mz_list for r in expected], [r.mz_list for r in actual])
+            self.assertEqual([r.rt_list for r in expected], [r.rt_list for r in actual])
+
+    def test_greedy_roi_cluster_same_as_roi_correlation(self):
+        roi_list = [r for r in make_roi_list(make_scans(), 0.005, 'Da') if r.n >= 5]
+        roi_list.sort(key=lambda x: max(x.intensity_list), reverse=True)
+        expected = []
+        remaining = list(roi_list)
+        while len(remaining) > 0:
+            cluster = [remaining[0]] + [r for r in remaining[1:] if roi_correlation(remaining[0], r) > 0.75]
+            expected.append(cluster)
+            remaining = [r for r in remaining if r not in cluster]
+        self.assertEqual(expected, greedy_roi_cluster(roi_list, corr_thresh=0.75))
+
+    @unittest.skipUnless(NUMBA_AVAILABLE, 'numba is not installed')
+    def test_compiled_same_as_python(self):
+        rs = np.random.RandomState(1)
+        mzs = rs.uniform(100, 1000, 500)
+        roi_sums = np.sort(rs.uniform(100, 1000, 200)) * 3
+        roi_counts = np.full(200, 3)
+        for args in [(mzs, roi_sums, roi_counts, 0.01, False), (mzs, roi_sums, roi_counts, 20.0, True)]:
+            for a, b in zip(roi_assign(*args), roi_assign.py_func(*args)):
+                self.assertTrue(np.array_equal(a, b))
+
+        roi_list = make_roi_list(make_scans(), 0.005, 'Da')
+        offsets = np.cumsum([0] + [r.n for r in roi_list])
+        rts = np.concatenate([r.rt_list for r in roi_list])
+        intensities = np.concatenate([r.intensity_list for r in roi_list])
+        for pearson in [True, False]:
+            args = (rts, intensities, offsets, 0.5, pearson)
+            self.assertTrue(np.array_equal(greedy_cluster_labels(*args), greedy_cluster_labels.py_func(*args)))
+
+
+class TestExclusionKernels(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(2)
+        self.from_mz = rs.uniform(100, 1000, 50)
+        self.to_mz = self.from_mz + 0.01
+        self.from_rt = rs.uniform(0, 100, 50)
+        self.to_rt = self.from_rt + 15
+        self.queries = [(self.from_mz[i] + 0.005, self.from_rt[i] + t) for i in range(50) for t in [-1, 0, 10, 20]]
+
+    def test_find_exclusion(self):
+        for mz, rt in self.queries:
+            expected = -1
+            for i in range(len(self.from_mz)):
+                if self.from_mz[i] <= mz <= self.to_mz[i] and self.from_rt[i] <= rt <= self.to_rt[i]:
+                    expected = i
+                    break
+            self.assertEqual(expected, find_exclusion(mz, rt, self.from_mz, self.to_mz, self.from_rt, self.to_rt))
+
+    @unittest.skipUnless(NUMBA_AVAILABLE, 'numba is not installed')
+    def test_compiled_same_as_python(self):
+        for mz, rt in self.queries:
+            args = (mz, rt, self.from_mz, self.to_mz, self.from_rt, self.to_rt)
+            self.assertEqual(find_exclusion(*args), find_exclusion.py_func(*args))
+
+
+class TestSamplerKernels(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(3)
+        self.t = np.linspace(0, 50, 40)
+        self.y = 100 + 300 * norm.pdf(self.t, 25, 4) + rs.normal(0, 5, 40)
+        self.particles = rs.normal([100, 20, 25, 4], [10, 5, 5, 1], size=(200, 4))
+        self.X = rs.normal(size=(30, 20))
+        self.observed = rs.rand(30, 20) < 0.7
+        self.V = rs.normal(size=(20, 3))
+
+    def test_mixture_log_likelihoods(self):
+        expected = []
+        for theta in self.particles:
+            mean = theta[0] + (theta[1] ** 2) * norm.pdf(self.t, abs(theta[2]), abs(theta[3]))
+            var = sum((self.y - mean) ** 2) / len(self.y)
+            expected.append(sum(np.log(norm.pdf(self.y, mean, var))))
+        actual = mixture_log_likelihoods(self.particles, self.y, self.t, True)
+        self.assertTrue(np.allclose(expected, actual, rtol=1e-12))
+
+    def test_observed_weighted_sums(self):
+        expected = np.zeros((30, 3))
+        for n in range(30):
+            for m in range(20):
+                if self.observed[n, m]:
+                    expected[n, :] += self.X[n, m] * self.V[m, :]
+        self.assertTrue(np.array_equal(expected, observed_weighted_sums(self.X, self.observed, self.V)))
+
+    @unittest.skipUnless(NUMBA_AVAILABLE, 'numba is not installed')
+    def test_compiled_same_as_python(self):
+        for mixture in [True, False]:
+            args = (self.particles, self.y, self.t, mixture)
+            self.assertTrue(np.array_equal(mixture_log_likelihoods(*args), mixture_log_likelihoods.py_func(*args)))
+        args = (self.X.T, self.observed.T, self.X[:, :3])
+        self.assertTrue(np.array_equal(observed_weighted_sums(*args), observed_weighted_sums.py_func(*args)))
+
+
+class TestDensityKernels(unittest.TestCase):
+    @unittest.skipUnless(NUMBA_AVAILABLE, 'numba is not installed')
+    def test_compiled_same_as_python(self):
+        probs = np.random.RandomState(4).dirichlet(np.ones(200))
+        for a, b in zip(build_alias_table(probs), build_alias_table.py_func(probs)):
+            self.assertTrue(np.array_equal(a, b))
+
+
+if __name__ == '__main__':
+    unittest.main()
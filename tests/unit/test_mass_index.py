@@ -0,0 +1,57 @@
+import sys
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+
+from vimms.MassIndex import MassIndex
+
+
+class TestMassIndex(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.masses = np.round(rs.uniform(100, 1000, 3000), 2)  # rounded to have equal masses
+        self.groups = ['F%d' % g for g in rs.randint(0, 1500, 3000)]
+        self.queries = np.concatenate([rs.uniform(50, 1050, 300), rs.normal(500, 2, 300)])
+        self.index = MassIndex(self.masses)
+
+    def test_range_and_within(self):
+        for mass in self.queries[:50]:
+            expected = np.flatnonzero((self.masses >= mass - 1) & (self.masses <= mass + 1))
+            self.assertEqual(sorted(expected), sorted(self.index.get_range(mass - 1, mass + 1)))
+        within = self.index.get_within(self.queries[:50], 1)
+        for mass, positions in zip(self.queries[:50], within):
+            self.assertTrue(np.all(np.abs(self.masses[positions] - mass) <= 1))
+            self.assertEqual(np.sum(np.abs(self.masses - mass) <= 1), len(positions))
+
+    def test_nearest(self):
+        nearest = self.index.get_nearest(self.queries, k=5)
+        for mass, positions in zip(self.queries, nearest):
+            expected = np.sort(np.abs(self.masses - mass))[:5]
+            self.assertTrue(np.array_equal(expected, np.abs(self.masses[positions] - mass)))
+
+    def test_sample_nearest_same_as_sorting(self):
+        # the nearest mass of an unused group for each query in turn, by sorting all the distances. The masses are
+        # sorted so that ties are broken the same way
+        self.masses = np.sort(self.masses)
+        self.index = MassIndex(self.masses)
+        expected = []
+        used = set()
+        for mass in self.queries:
+            for pos in np.argsort(np.abs(self.masses - mass), kind='stable'):
+                if self.groups[pos] not in used:
+                    used.add(self.groups[pos])
+                    expected.append(pos)
+                    break
+        picked = self.index.sample_nearest(self.queries, self.groups)
+        self.assertEqual(expected, picked.tolist())
+        self.assertEqual(len(picked), len(set(self.groups[pos] for pos in picked)))
+
+    def test_sample_too_many(self):
+        with self.assertRaises(ValueError):
+            MassIndex([1.0, 2.0, 3.0]).sample_nearest([1.0, 2.0, 3.0], ['a', 'b', 'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import copy
+import pickle
+import sys
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+
+from vimms.MassSpec import ScanParameters, FrozenScanParameters
+
+
+def make_params(windows):
+    params = ScanParameters()
+    params.set(ScanParameters.MS_LEVEL, 2)
+    params.set(ScanParameters.COLLISION_ENERGY, 25)
+    params.set(ScanParameters.ISOLATION_WINDOWS, windows)
+    return params
+
+
+class TestFrozenScanParameters(unittest.TestCase):
+    def test_hash_and_equality(self):
+        windows = [[(100.0, 101.0), (200.0, 201.0)]]
+        frozen = make_params(windows).freeze()
+        for same in [make_params([[(100.0, 101.0), (200.0, 201.0)]]), make_params(np.array(windows))]:
+            self.assertEqual(frozen, same.freeze())
+            self.assertEqual(hash(frozen), hash(same.freeze()))
+        self.assertNotEqual(frozen, make_params([[(100.0, 101.0)]]).freeze())
+        self.assertEqual(1, len({frozen, make_params(windows).freeze()}))
+
+        # 2-D arrays are frozen to nested tuples
+        hash(make_params(np.array([[100.0, 101.0], [200.0, 201.0]])).freeze())
+
+    def test_cannot_be_modified(self):
+        params = make_params([[(100.0, 101.0)]])
+        frozen = params.freeze()
+        params.set(ScanParameters.COLLISION_ENERGY, 35)
+        self.assertEqual(25, frozen.get(ScanParameters.COLLISION_ENERGY))
+        self.assertIs(frozen, frozen.freeze())
+        with self.assertRaises(TypeError):
+            frozen.set(ScanParameters.COLLISION_ENERGY, 35)
+        with self.assertRaises(TypeError):
+            frozen.params[ScanParameters.COLLISION_ENERGY] = 35
+
+        thawed = frozen.thaw()
+        thawed.set(ScanParameters.COLLISION_ENERGY, 35)
+        self.assertEqual(25, frozen.get(ScanParameters.COLLISION_ENERGY))
+
+    def test_pickle_and_copy(self):
+        frozen = make_params(np.array([[100.0, 101.0], [200.0, 201.0]])).freeze()
+        for copied in [pickle.loads(pickle.dumps(frozen)), copy.deepcopy(frozen)]:
+            self.assertIsInstance(copied, FrozenScanParameters)
+            self.assertEqual(frozen, copied)
+            self.assertEqual(hash(frozen), hash(copied))
+            with self.assertRaises(TypeError):
+                copied.params[ScanParameters.MS_LEVEL] = 1
+
+
+if __name__ == '__main__':
+    unittest.main()
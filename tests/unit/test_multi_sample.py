@@ -0,0 +1,94 @@
+import os
+import sys
+import unittest
+
+sys.path.append('..')
+
+from pathlib import Path
+
+import numpy as np
+
+from vimms.Chemicals import MultiSampleCreator
+from vimms.Common import POSITIVE, RandomStreams, load_obj, set_log_level_warning
+from vimms.Controller import TopNController
+from vimms.Environment import Environment
+from vimms.MassSpec import IndependentMassSpectrometer
+from vimms.MultiSample import MultiSampleEnvironment
+
+fixtures_dir = Path(os.path.dirname(os.path.realpath(__file__)), '..', 'integration', 'fixtures')
+beer_chems = load_obj(Path(fixtures_dir, 'QCB_22May19_1.p'))
+
+
+class ScanDurationSampler(object):
+    """
+    Provides the scan durations of a mass spec without a trained PeakSampler
+    """
+    DURATIONS = {(1, 1): [0.4, 0.5, 0.45], (1, 2): [0.2, 0.25], (2, 1): [0.3, 0.35], (2, 2): [0.1, 0.12, 0.15]}
+
+    def scan_durations(self, previous_level, current_level, n_sample, N, DEW, rng=None):
+        rng = np.random if rng is None else rng
+        return rng.choice(self.DURATIONS[(previous_level, current_level)], size=n_sample, replace=False)
+
+    def get_msn_noisy_intensity(self, intensity, ms_level):
+        return intensity
+
+    def get_noise_sample(self):
+        return []
+
+
+class TestMultiSampleEnvironment(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+        self.min_time, self.max_time = 150, 250
+        self.chemicals = beer_chems[:300]
+
+    def make_creator(self, compact):
+        return MultiSampleCreator(self.chemicals, [2, 1], ['a', 'b'], [1000], [0.5], [0], [10000],
+                                  dropout_probabilities=[0.1, 0.2], rng=np.random.default_rng(3), compact=compact)
+
+    def make_controller(self):
+        return TopNController(POSITIVE, 3, 1, 10, 15, 1000)
+
+    def run_separately(self, samples, seeds):
+        controllers = []
+        for sample, seed in zip(samples, seeds):
+            mass_spec = IndependentMassSpectrometer(POSITIVE, sample, ScanDurationSampler(),
+                                                    rng=RandomStreams(seed).get('mass_spec'))
+            controller = self.make_controller()
+            Environment(mass_spec, controller, self.min_time, self.max_time, progress_bar=False).run()
+            controllers.append(controller)
+        return controllers
+
+    def run_together(self, creator, seeds):
+        env = MultiSampleEnvironment(creator.original_dataset, creator.sample_intensities, creator.sample_masks,
+                                     ScanDurationSampler(), [self.make_controller() for _ in seeds], self.min_time,
+                                     self.max_time, rngs=[RandomStreams(seed).get('mass_spec') for seed in seeds],
+                                     progress_bar=False)
+        env.run()
+        return env
+
+    def assert_same_scans(self, expected_controllers, controllers):
+        for expected, actual in zip(expected_controllers, controllers):
+            for ms_level in [1, 2]:
+                self.assertGreater(len(expected.scans[ms_level]), 0)
+                self.assertEqual(len(expected.scans[ms_level]), len(actual.scans[ms_level]))
+                for expected_scan, scan in zip(expected.scans[ms_level], actual.scans[ms_level]):
+                    self.assertEqual(expected_scan.rt, scan.rt)
+                    self.assertTrue(np.array_equal(expected_scan.mzs, scan.mzs))
+                    self.assertTrue(np.allclose(expected_scan.intensities, scan.intensities, rtol=1e-12, atol=0))
+
+    def test_compact_same_as_separate_samples(self):
+        full, compact = self.make_creator(False), self.make_creator(True)
+        self.assertTrue(np.array_equal(full.sample_intensities, compact.sample_intensities))
+        self.assertTrue(np.array_equal(full.sample_masks, compact.sample_masks))
+
+        # samples scanned at the same times, and at drifting times
+        for seeds in [[5, 5, 5], [5, 6, 7]]:
+            expected = self.run_separately(full.samples, seeds)
+            env = self.run_together(compact, seeds)
+            self.assert_same_scans(expected, env.controllers)
+            self.assertGreater(env.shared.peak_cache.hits, 10 * env.shared.peak_cache.misses)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+import pymzml
+from psims.mzml import binary_encoding
+
+from vimms.Common import set_log_level_warning
+from vimms.Controller import Precursor
+from vimms.MassSpec import Scan, ScanParameters
+from vimms.MzmlWriter import MzmlWriter, StreamingMzmlWriter, BackgroundMzmlWriter, recover_mzml
+
+
+def make_scans(n=40, seed=0):
+    # an MS1 scan followed by three MS2 scans of its largest peaks, some of them empty
+    rs = np.random.RandomState(seed)
+    scans = {1: [], 2: []}
+    precursor_information = {}
+    ms1_scan = None
+    for scan_id in range(n):
+        rt = 10.0 + scan_id * 0.3
+        n_peaks = rs.randint(5, 20) if scan_id % 4 == 0 else rs.randint(0, 20)
+        mzs = np.sort(rs.uniform(100, 900, n_peaks))
+        intensities = rs.uniform(1e3, 1e6, n_peaks)
+        if scan_id % 4 == 0:
+            ms1_scan = Scan(scan_id, mzs, intensities, 1, rt)
+            scans[1].append(ms1_scan)
+        else:
+            pos = np.argsort(ms1_scan.intensities)[-(scan_id % 4)]
+            precursor = Precursor(ms1_scan.mzs[pos], ms1_scan.intensities[pos], 1, ms1_scan.scan_id)
+            params = ScanParameters()
+            params.set(ScanParameters.MS_LEVEL, 2)
+            params.set(ScanParameters.PRECURSOR_MZ, precursor)
+            scan = Scan(scan_id, mzs, intensities, 2, rt, scan_params=params)
+            scans[2].append(scan)
+            precursor_information[precursor] = [scan]
+    return scans, precursor_information
+
+
+def read_spectra(filename):
+    run = pymzml.run.Reader(filename)
+    spectra = []
+    for spectrum in run:
+        precursors = spectrum.selected_precursors
+        spectra.append((spectrum.ID, spectrum.ms_level, round(spectrum.scan_time_in_minutes() * 60, 6),
+                        spectrum.mz.tolist(), spectrum.i.tolist(),
+                        [round(p['mz'], 4) for p in precursors] if precursors else None))
+    return spectra
+
+
+def get_spectrum_count_attribute(filename):
+    with open(filename, 'rb') as f:
+        return re.search(rb'<spectrumList count="([^"]*)"', f.read()).group(1).decode('utf-8')
+
+
+class TestStreamingMzmlWriter(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scans, self.precursor_information = make_scans()
+        self.batch_file = os.path.join(self.tmp_dir, 'batch.mzML')
+        MzmlWriter('test', self.scans, precursor_information=self.precursor_information).write_mzML(self.batch_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_scans_in_order(self):
+        return sorted(self.scans[1] + self.scans[2], key=lambda scan: scan.scan_id)
+
+    def test_streamed_same_as_batch(self):
+        expected = read_spectra(self.batch_file)
+        for cls in [StreamingMzmlWriter, BackgroundMzmlWriter]:
+            out_file = os.path.join(self.tmp_dir, '%s.mzML' % cls.__name__)
+            with cls('test', out_file) as writer:
+                for scan in self.get_scans_in_order():
+                    writer.write_scan(scan)
+            self.assertEqual(expected, read_spectra(out_file))
+            self.assertEqual(str(len(expected)), get_spectrum_count_attribute(out_file))
+
+            # the checksum still covers the file after the spectrum count has been set
+            with open(out_file, 'rb') as f:
+                data = f.read()
+            pos = data.rfind(b'<fileChecksum>') + len(b'<fileChecksum>')
+            self.assertEqual(hashlib.sha1(data[:pos]).hexdigest(), data[pos:pos + 40].decode('utf-8'))
+
+    def test_recover_all_written_spectra(self):
+        expected = read_spectra(self.batch_file)
+        out_file = os.path.join(self.tmp_dir, 'stream.mzML')
+        partial_file = os.path.join(self.tmp_dir, 'partial.mzML')
+        recovered_file = os.path.join(self.tmp_dir, 'recovered.mzML')
+        writer = StreamingMzmlWriter('test', out_file)
+        writer.open()
+        for n, scan in enumerate(self.get_scans_in_order()[:25]):
+            writer.write_scan(scan)
+            if n == 0 or n == 24:
+                # a copy of the file left by a crash at this point
+                shutil.copy(out_file, partial_file)
+                self.assertEqual(n + 1, recover_mzml(partial_file, recovered_file))
+                self.assertEqual(expected[:n + 1], read_spectra(recovered_file))
+                self.assertEqual(str(n + 1), get_spectrum_count_attribute(recovered_file))
+        writer.close()
+
+        with open(partial_file, 'wb') as f:
+            f.write(b'<?xml version="1.0" encoding="utf-8"?>\n<mzML>')
+        with self.assertRaises(ValueError):
+            recover_mzml(partial_file, recovered_file)
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scans, self.precursor_information = make_scans()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_uncompressed_same_as_zlib(self):
+        zlib_file = os.path.join(self.tmp_dir, 'zlib.mzML')
+        MzmlWriter('test', self.scans, precursor_information=self.precursor_information).write_mzML(zlib_file)
+        none_file = os.path.join(self.tmp_dir, 'none.mzML')
+        MzmlWriter('test', self.scans, precursor_information=self.precursor_information,
+                   compression='none').write_mzML(none_file)
+        self.assertEqual(read_spectra(zlib_file), read_spectra(none_file))
+        with open(none_file) as f:
+            text = f.read()
+        self.assertIn('no compression', text)
+        self.assertNotIn('zlib compression', text)
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            MzmlWriter('test', self.scans, compression='gzip')
+        with self.assertRaises(ValueError):
+            StreamingMzmlWriter('test', os.path.join(self.tmp_dir, 'out.mzML'), compression='gzip')
+
+    @unittest.skipIf(binary_encoding.pynumpress is not None, 'pynumpress is installed')
+    def test_numpress_needs_pynumpress(self):
+        with self.assertRaises(ImportError):
+            MzmlWriter('test', self.scans, compression='numpress')
+        with self.assertRaises(ImportError):
+            BackgroundMzmlWriter('test', os.path.join(self.tmp_dir, 'out.mzML'), compression='numpress')
+
+
+class TestBackgroundMzmlWriter(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_encoder_error_raised_on_close(self):
+        scans, _ = make_scans(n=10)
+        scans = sorted(scans[1] + scans[2], key=lambda scan: scan.scan_id)
+        scans[-1].mzs = None  # can't be encoded
+        writer = BackgroundMzmlWriter('test', os.path.join(self.tmp_dir, 'out.mzML'), queue_size=2)
+        writer.open()
+        for scan in scans:
+            writer.write_scan(scan)  # the last scan fails in the encoder thread, after it was queued
+        with self.assertRaises(TypeError) as context:
+            writer.close()
+        self.assertIs(writer.error, context.exception)
+        self.assertIsNone(writer.thread)
+        writer.close()  # already closed
+
+        # later scans are refused once the encoder has failed
+        with self.assertRaises(TypeError):
+            writer.write_scan(scans[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+
+from vimms.Parallel import SharedObjectStore, SharedRef, load_shared_file, resolve_shared, run_jobs
+
+
+def divide(job):
+    return job['numerator'] / job['denominator']
+
+
+def sum_shared(job):
+    return float(np.sum(resolve_shared(job['data'])['values'])) + job['offset']
+
+
+class TestRunJobs(unittest.TestCase):
+    def test_failures_are_isolated(self):
+        jobs = [{'numerator': i, 'denominator': i % 3} for i in range(7)]
+        results = run_jobs(divide, jobs, max_workers=2, progress_bar=False)
+        self.assertEqual(list(range(7)), [result.index for result in results])
+        for i, result in enumerate(results):
+            if i % 3 == 0:
+                self.assertFalse(result.success)
+                self.assertIsNone(result.result)
+                self.assertIn('ZeroDivisionError', result.error)
+            else:
+                self.assertTrue(result.success)
+                self.assertEqual(i / (i % 3), result.result)
+
+    def test_shared_values_in_workers(self):
+        data = {'values': np.arange(1000.0)}
+        with SharedObjectStore() as store:
+            jobs = [store.publish_values({'data': data, 'offset': i}, ['data']) for i in range(4)]
+            self.assertIsInstance(jobs[0]['data'], SharedRef)
+            results = run_jobs(sum_shared, jobs, max_workers=2, progress_bar=False)
+        self.assertEqual([499500.0 + i for i in range(4)], [result.result for result in results])
+
+
+class TestSharedObjectStore(unittest.TestCase):
+    def test_round_trip(self):
+        obj = {'a': np.arange(10.0), 'b': np.arange(12).reshape(3, 4)[:, ::2], 'c': [np.zeros(0), 'text', 3]}
+        with SharedObjectStore() as store:
+            ref = store.publish(obj)
+            self.assertIs(ref, store.publish(obj))
+            loaded = load_shared_file(ref.path)
+        self.assertTrue(np.array_equal(obj['a'], loaded['a']))
+        self.assertTrue(np.array_equal(obj['b'], loaded['b']))
+        self.assertEqual(0, len(loaded['c'][0]))
+        self.assertEqual(obj['c'][1:], loaded['c'][1:])
+
+    def test_only_empty_arrays(self):
+        with SharedObjectStore() as store:
+            loaded = store.publish({'a': np.empty(0), 'b': np.zeros((0, 3))}).resolve()
+        self.assertEqual((0,), loaded['a'].shape)
+        self.assertEqual((0, 3), loaded['b'].shape)
+        loaded['a'][:] = 1  # still writeable
+
+    def test_arrays_are_mapped_copy_on_write(self):
+        with SharedObjectStore() as store:
+            ref = store.publish({'values': np.arange(100.0)})
+            loaded = load_shared_file(ref.path)
+            self.assertFalse(loaded['values'].flags.owndata)  # a view of the mapping, not a copy
+            loaded['values'][0] = -1
+            self.assertEqual(0, load_shared_file(ref.path)['values'][0])
+
+    def test_close_deletes_files(self):
+        store = SharedObjectStore()
+        store.publish([1, 2, 3])
+        self.assertTrue(os.path.exists(store.store_dir))
+        store.close()
+        self.assertFalse(os.path.exists(store.store_dir))
+        store.close()  # closing twice is fine
+
+        store = SharedObjectStore()
+        store_dir = store.store_dir
+        del store
+        self.assertFalse(os.path.exists(store_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
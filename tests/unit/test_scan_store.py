@@ -0,0 +1,147 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+import pymzml
+
+from vimms.Common import set_log_level_warning
+from vimms.Controller import Precursor
+from vimms.MassSpec import Scan, ScanParameters
+from vimms.MzmlWriter import MzmlWriter
+from vimms.ScanStore import ScanStore, ScanStoreWriter, save_scans
+
+
+def make_scans(n=40, seed=0):
+    # an MS1 scan followed by three MS2 scans of its largest peaks, with column vectors of intensities as in
+    # simulated MS2 scans, and some MS2 scans without peaks
+    rs = np.random.RandomState(seed)
+    scans = {1: [], 2: []}
+    precursor_information = {}
+    ms1_scan = None
+    for scan_id in range(n):
+        rt = 10.0 + scan_id * 0.3
+        n_peaks = rs.randint(5, 20) if scan_id % 4 == 0 else rs.randint(0, 20)
+        mzs = np.sort(rs.uniform(100, 900, n_peaks))
+        intensities = rs.uniform(1e3, 1e6, n_peaks)
+        params = ScanParameters()
+        if scan_id % 4 == 0:
+            params.set(ScanParameters.MS_LEVEL, 1)
+            params.set(ScanParameters.ISOLATION_WINDOWS, [[(70.0, 1000.0)]])
+            params.set(ScanParameters.COLLISION_ENERGY, 0)
+            ms1_scan = Scan(scan_id, mzs, intensities, 1, rt, scan_duration=0.4, scan_params=params)
+            scans[1].append(ms1_scan)
+        else:
+            pos = np.argsort(ms1_scan.intensities)[-(scan_id % 4)]
+            precursor = Precursor(ms1_scan.mzs[pos], ms1_scan.intensities[pos], 1, ms1_scan.scan_id)
+            params.set(ScanParameters.MS_LEVEL, 2)
+            params.set(ScanParameters.PRECURSOR_MZ, precursor)
+            params.set(ScanParameters.ISOLATION_WIDTH, 1.0)
+            params.set(ScanParameters.COLLISION_ENERGY, 25)
+            scan = Scan(scan_id, mzs, intensities.reshape(-1, 1), 2, rt, scan_params=params)
+            scans[2].append(scan)
+            precursor_information[precursor] = [scan]
+    return scans, precursor_information
+
+
+def read_spectra(filename):
+    spectra = []
+    for spectrum in pymzml.run.Reader(filename):
+        precursors = spectrum.selected_precursors
+        spectra.append((spectrum.ID, spectrum.ms_level, round(spectrum.scan_time_in_minutes() * 60, 6),
+                        spectrum.mz.tolist(), spectrum.i.tolist(),
+                        [round(p['mz'], 4) for p in precursors] if precursors else None))
+    return spectra
+
+
+class TestScanStore(unittest.TestCase):
+    def setUp(self):
+        set_log_level_warning()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scans, self.precursor_information = make_scans()
+        self.store_dir = os.path.join(self.tmp_dir, 'store')
+        save_scans(self.store_dir, self.scans, analysis_name='test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        store = ScanStore(self.store_dir)
+        self.assertEqual(sum(len(scans) for scans in self.scans.values()), len(store))
+        self.assertEqual('test', store.analysis_name)
+        scans = store.to_scans()
+        for ms_level in [1, 2]:
+            self.assertEqual(len(self.scans[ms_level]), len(scans[ms_level]))
+            for expected, scan in zip(self.scans[ms_level], scans[ms_level]):
+                self.assertEqual((expected.scan_id, expected.rt, expected.ms_level, expected.scan_duration),
+                                 (scan.scan_id, scan.rt, scan.ms_level, scan.scan_duration))
+                self.assertEqual(expected.mzs.tolist(), scan.mzs.tolist())
+
+                # intensities are read back as 1-D arrays
+                self.assertEqual(1, scan.intensities.ndim)
+                self.assertEqual(expected.intensities.ravel().tolist(), scan.intensities.tolist())
+
+                for key in [ScanParameters.MS_LEVEL, ScanParameters.COLLISION_ENERGY,
+                            ScanParameters.ISOLATION_WIDTH, ScanParameters.ISOLATION_WINDOWS]:
+                    self.assertEqual(expected.scan_params.get(key), scan.scan_params.get(key))
+                precursor = expected.scan_params.get(ScanParameters.PRECURSOR_MZ)
+                if precursor is not None:
+                    actual = scan.scan_params.get(ScanParameters.PRECURSOR_MZ)
+                    self.assertEqual((precursor.precursor_mz, precursor.precursor_intensity,
+                                      precursor.precursor_charge, precursor.precursor_scan_id),
+                                     (actual.precursor_mz, actual.precursor_intensity, actual.precursor_charge,
+                                      actual.precursor_scan_id))
+                    windows = expected.scan_params.compute_isolation_windows()
+                else:
+                    self.assertIsNone(scan.scan_params.get(ScanParameters.PRECURSOR_MZ))
+                    windows = expected.scan_params.get(ScanParameters.ISOLATION_WINDOWS)
+                position = store.scan_id.tolist().index(scan.scan_id)
+                self.assertEqual([[tuple(window) for window in level] for level in windows],
+                                 store.get_isolation_windows(position))
+
+    def test_select(self):
+        store = ScanStore(self.store_dir)
+        all_scans = sorted(self.scans[1] + self.scans[2], key=lambda scan: scan.scan_id)
+        for ms_level, min_rt, max_rt in [(None, None, None), (2, None, None), (1, 12, None), (None, 11.5, 17.2),
+                                         (2, 30, 40)]:
+            expected = [i for i, scan in enumerate(all_scans)
+                        if (ms_level is None or scan.ms_level == ms_level) and
+                        (min_rt is None or scan.rt >= min_rt) and (max_rt is None or scan.rt <= max_rt)]
+            self.assertEqual(expected, store.select(ms_level=ms_level, min_rt=min_rt, max_rt=max_rt).tolist())
+        self.assertEqual([scan.scan_id for scan in self.scans[2]],
+                         [scan.scan_id for scan in store.iter_scans(ms_level=2)])
+
+    def test_memory_mapped(self):
+        mapped = ScanStore(self.store_dir)
+        loaded = ScanStore(self.store_dir, mmap=False)
+        self.assertIsInstance(mapped.mzs, np.memmap)
+        self.assertNotIsInstance(loaded.mzs, np.memmap)
+        self.assertFalse(mapped.intensities.flags.writeable)
+        self.assertTrue(np.array_equal(mapped.mzs, loaded.mzs))
+        self.assertTrue(np.array_equal(mapped.intensities, loaded.intensities))
+        for i in range(len(mapped)):
+            self.assertEqual(mapped.get_scan(i).intensities.tolist(), loaded.get_scan(i).intensities.tolist())
+
+    def test_incomplete_store(self):
+        writer = ScanStoreWriter(os.path.join(self.tmp_dir, 'incomplete'))
+        writer.open()
+        writer.write_scan(self.scans[1][0])
+        with self.assertRaises(ValueError):
+            ScanStore(writer.path)
+        writer.close()
+        self.assertEqual(1, len(ScanStore(writer.path)))
+
+    def test_write_mzml_same_as_mzml_writer(self):
+        expected_file = os.path.join(self.tmp_dir, 'expected.mzML')
+        MzmlWriter('test', self.scans, precursor_information=self.precursor_information).write_mzML(expected_file)
+        out_file = os.path.join(self.tmp_dir, 'store.mzML')
+        ScanStore(self.store_dir).write_mzML(out_file)
+        self.assertEqual(read_spectra(expected_file), read_spectra(out_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
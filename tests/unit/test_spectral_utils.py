@@ -0,0 +1,84 @@
+import sys
+import unittest
+
+sys.path.append('..')
+
+import numpy as np
+import pandas as pd
+
+from vimms.SpectralUtils import make_ms2_library
+
+
+def make_precursor_info(n=30, seed=0):
+    # spectra of 0 to 5 peaks with precursors between 100 and 500 m/z, some of them with the same precursor m/z
+    rs = np.random.RandomState(seed)
+    precursor_mzs = np.round(rs.uniform(100, 500, n))
+    rows = []
+    for i in range(n):
+        n_peaks = rs.randint(0, 6)
+        rt = 10.0 + i
+        peaklist = np.stack([np.sort(rs.uniform(50, precursor_mzs[i], n_peaks)), np.full(n_peaks, rt),
+                             rs.uniform(1e3, 1e5, n_peaks)], axis=1)
+        rows.append([rt, peaklist, precursor_mzs[i], rt - 0.5, rs.uniform(1e5, 1e6)])
+    df = pd.DataFrame(rows, columns=['ms2_scan_rt', 'ms2_peaklist', 'ms1_mz', 'ms1_scan_rt', 'ms1_intensity'])
+    df.index = np.arange(100, 100 + n)
+    return df
+
+
+class TestMS2Library(unittest.TestCase):
+    def setUp(self):
+        self.df = make_precursor_info()
+        self.library = make_ms2_library([self.df])
+
+    def test_query(self):
+        for min_mz, max_mz in [(None, None), (200, 300), (None, 250), (350, None), (self.df['ms1_mz'].iloc[0],) * 2,
+                               (100, 100.5)]:
+            expected = np.arange(len(self.df))
+            if min_mz is not None:
+                expected = expected[self.df['ms1_mz'].values >= min_mz]
+            if max_mz is not None:
+                expected = expected[self.df['ms1_mz'].values[expected] <= max_mz]
+            self.assertEqual(expected.tolist(), self.library.query(min_mz, max_mz).tolist())
+
+    def test_sample(self):
+        idx = self.library.sample(10, min_mz=200, max_mz=400, rng=np.random.default_rng(0))
+        self.assertEqual(10, len(set(idx)))
+        self.assertTrue(set(idx) <= set(self.library.query(200, 400)))
+        self.assertEqual(idx.tolist(), self.library.sample(10, min_mz=200, max_mz=400,
+                                                           rng=np.random.default_rng(0)).tolist())
+
+        # all the matching spectra when there are fewer than asked for, and none when there are none
+        candidates = self.library.query(200, 250)
+        self.assertLess(len(candidates), 10)
+        self.assertEqual(sorted(candidates.tolist()), sorted(self.library.sample(10, min_mz=200, max_mz=250).tolist()))
+        self.assertEqual(len(self.library), len(self.library.sample(2 * len(self.library))))
+        self.assertEqual(0, len(self.library.sample(2, min_mz=100, max_mz=100.5)))
+
+    def test_get_scans(self):
+        idx = [3, 0, 7]
+        scans = self.library.get_scans(idx)
+        for i, scan in zip(idx, scans):
+            row = self.df.iloc[i]
+            self.assertEqual(self.df.index[i], scan.scan_id)
+            self.assertEqual(2, scan.ms_level)
+            self.assertEqual(row['ms2_scan_rt'], scan.rt)
+            self.assertEqual(row['ms2_peaklist'][:, 0].tolist(), scan.mzs.tolist())
+            self.assertEqual(row['ms2_peaklist'][:, 2].tolist(), scan.intensities.tolist())
+            self.assertEqual((row['ms1_mz'], row['ms1_scan_rt'], row['ms1_intensity']),
+                             (scan.parent.mz, scan.parent.rt, scan.parent.intensity))
+
+    def test_total_intensities(self):
+        expected = [np.sum(peaklist[:, 2]) for peaklist in self.df['ms2_peaklist']]
+        self.assertIn(0, [len(peaklist) for peaklist in self.df['ms2_peaklist']])
+        self.assertTrue(np.allclose(expected, self.library.get_total_intensities(), rtol=1e-12, atol=0))
+
+    def test_rts_from_peaks(self):
+        # dataframes of old samplers don't have the retention time of the MS2 scans
+        library = make_ms2_library([self.df.drop(columns='ms2_scan_rt')])
+        empty = np.array([len(peaklist) == 0 for peaklist in self.df['ms2_peaklist']])
+        self.assertTrue(np.array_equal(self.df['ms2_scan_rt'].values[~empty], library.rts[~empty]))
+        self.assertTrue(np.array_equal(self.df['ms1_scan_rt'].values[empty], library.rts[empty]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 import copy
+import csv
 import math
+import os
 import random
 import re
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
@@ -11,58 +14,120 @@ from loguru import logger
 
 from vimms.ChineseRestaurantProcess import Restricted_Crp
 from vimms.Chromatograms import EmpiricalChromatogram
-from vimms.Common import CHEM_DATA, POS_TRANSFORMATIONS, load_obj, save_obj
+from vimms.Common import CHEM_DATA, POS_TRANSFORMATIONS, load_obj, save_obj, get_rng
+from vimms.IsotopeEngine import IsotopeEngine, truncate_envelope, merge_envelope
+from vimms.MassIndex import MassIndex
 
 GET_MS2_BY_PEAKS = "sample"
 GET_MS2_BY_SPECTRA = "spectra"
 
+# the elements counted in formulas and their monoisotopic masses
+ELEMENTS = ['C', 'H', 'N', 'O', 'P', 'S', 'Cl', 'I', 'Br', 'Si', 'F', 'D']
+ELEMENT_MASSES = np.array([12.00000000000, 1.00782503214, 14.00307400524, 15.99491462210, 30.97376151200,
+                           31.97207069000, 34.96885271000, 126.904468, 78.9183376, 27.9769265327, 18.99840320500,
+                           2.01410177800])
+ELEMENT_INDEX = {element: k for k, element in enumerate(ELEMENTS)}
+
+# an element symbol and its optional count, e.g. 'Cl2' or 'H'
+FORMULA_TOKEN = re.compile(r'([A-Z][a-z]*)(\d*)')
+FORMULA_CACHE_SIZE = 1 << 18  # the number of parsed formulas kept by parse_formula
+
+# how isotopes are computed: 13C only, or all the elements with one peak per nominal mass or with the fine structure
+ISOTOPES_CARBON = "carbon"
+ISOTOPES_AGGREGATED = "aggregated"
+ISOTOPES_FINE = "fine"
+ISOTOPE_ENGINES = {}  # the IsotopeEngine of each method, created when first used
+
+# fine isotopologues closer than this (in Dalton) are merged into one peak, as the instrument can't resolve them, and
+# at most this many of the most abundant isotope peaks of an envelope are kept for a chemical
+FINE_ISOTOPE_RESOLUTION = 0.002
+MAX_ISOTOPE_PEAKS = 20
+
+
+# the columns of a compound table written by save_compound_table, and of tables written before the structures
+COMPOUND_TABLE_COLUMNS = ['accession', 'name', 'formula', 'monoisotopic_mass', 'smiles', 'inchi', 'inchikey']
+COMPOUND_TABLE_COLUMNS_V1 = ['accession', 'name', 'formula', 'monoisotopic_mass']
+
 
 class DatabaseCompound(object):
-    def __init__(self, name, chemical_formula, monisotopic_molecular_weight, smiles, inchi, inchikey):
+    def __init__(self, name, chemical_formula, monisotopic_molecular_weight, smiles, inchi, inchikey,
+                 accession=None):
         self.name = name
         self.chemical_formula = chemical_formula
         self.monisotopic_molecular_weight = monisotopic_molecular_weight
         self.smiles = smiles
         self.inchi = inchi
         self.inchikey = inchikey
+        self.accession = accession
+
+
+def save_compound_table(compounds, out_file):
+    """
+    Saves database compounds to a tab-separated table of accessions, names, formulas, monoisotopic masses, SMILES,
+    InChI and InChIKeys.
+    The table is much smaller and faster to load than a pickled list of compounds.
+    :param compounds: a list of `DatabaseCompound` objects
+    :param out_file: the table file
+    :return: None
+    """
+    tmp_file = '%s.%d.tmp' % (out_file, os.getpid())
+    try:
+        with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(COMPOUND_TABLE_COLUMNS)
+            for compound in compounds:
+                writer.writerow([getattr(compound, 'accession', None) or '', compound.name, compound.chemical_formula,
+                                 repr(float(compound.monisotopic_molecular_weight)), compound.smiles or '',
+                                 compound.inchi or '', compound.inchikey or ''])
+        os.replace(tmp_file, out_file)  # so that an interrupted write never leaves a partial table
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    logger.debug('Saved %d compounds to %s' % (len(compounds), out_file))
+
+
+def load_compound_table(in_file):
+    """
+    Loads database compounds from a table written by `save_compound_table`.
+    The compounds of tables written before the structures were stored have no SMILES, InChI or InChIKey.
+    :param in_file: the table file
+    :return: a list of `DatabaseCompound` objects
+    """
+    with open(in_file, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader, None)
+        if header == COMPOUND_TABLE_COLUMNS_V1:
+            reader = (row + ['', '', ''] for row in reader)
+        elif header != COMPOUND_TABLE_COLUMNS:
+            raise ValueError('%s is not a compound table' % in_file)
+        compounds = [DatabaseCompound(name, formula, float(mass), smiles or None, inchi or None, inchikey or None,
+                                      accession=accession or None)
+                     for accession, name, formula, mass, smiles, inchi, inchikey in reader]
+    logger.debug('Loaded %d compounds from %s' % (len(compounds), in_file))
+    return compounds
 
 
 class Formula(object):
     def __init__(self, formula_string):
         self.formula_string = formula_string
-        self.atom_names = ['C', 'H', 'N', 'O', 'P', 'S', 'Cl', 'I', 'Br', 'Si', 'F', 'D']
-        self.atoms = {}
-        for atom in self.atom_names:
-            self.atoms[atom] = self._get_n_element(atom)
-        self.mass = self._get_mz()
+        self.atom_names = ELEMENTS
+        self.atoms = dict(zip(ELEMENTS, parse_formula(formula_string).tolist()))
+        self.mass = self.compute_exact_mass()
 
     def _get_mz(self):
-        return self.compute_exact_mass()
+        return self.mass
 
     def _get_n_element(self, atom_name):
-        # Do some regex matching to find the numbers of the important atoms
-        ex = atom_name + '(?![a-z])' + '\d*'
-        m = re.search(ex, self.formula_string)
-        if m == None:
-            return 0
-        else:
-            ex = atom_name + '(?![a-z])' + '(\d*)'
-            m2 = re.findall(ex, self.formula_string)
-            total = 0
-            for a in m2:
-                if len(a) == 0:
-                    total += 1
-                else:
-                    total += int(a)
-            return total
+        if atom_name in self.atoms:
+            return self.atoms[atom_name]
+        return sum(int(n) if n else 1 for element, n in FORMULA_TOKEN.findall(self.formula_string)
+                   if element == atom_name)
 
     def compute_exact_mass(self):
-        masses = {'C': 12.00000000000, 'H': 1.00782503214, 'O': 15.99491462210, 'N': 14.00307400524,
-                  'P': 30.97376151200, 'S': 31.97207069000, 'Cl': 34.96885271000, 'I': 126.904468, 'Br': 78.9183376,
-                  'Si': 27.9769265327, 'F': 18.99840320500, 'D': 2.01410177800}
         exact_mass = 0.0
-        for a in self.atoms:
-            exact_mass += masses[a] * self.atoms[a]
+        for element, element_mass in zip(ELEMENTS, ELEMENT_MASSES.tolist()):
+            exact_mass += element_mass * self.atoms[element]
         return exact_mass
 
     def __repr__(self):
@@ -72,30 +137,88 @@ class Formula(object):
         return self.formula_string
 
 
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def parse_formula(formula_string):
+    """
+    Counts the atoms of each element in a formula string, in a single pass over the string.
+    Elements that are not in ELEMENTS are ignored, and so are brackets, charges and multipliers in front of elements.
+    :param formula_string: a formula, e.g. 'C6H12O6'
+    :return: a read-only array of the number of atoms of each element in ELEMENTS. Results are memoised, so the
+    array must not be modified.
+    """
+    counts = [0] * len(ELEMENTS)
+    for element, n in FORMULA_TOKEN.findall(formula_string):
+        k = ELEMENT_INDEX.get(element)
+        if k is not None:
+            counts[k] += int(n) if n else 1
+    counts = np.array(counts, dtype=np.int64)
+    counts.flags.writeable = False
+    return counts
+
+
+def get_formula_counts(formula_strings):
+    """
+    Counts the atoms of many formulas
+    :param formula_strings: a list of formula strings
+    :return: an array of shape (number of formulas, number of ELEMENTS)
+    """
+    if len(formula_strings) == 0:
+        return np.zeros((0, len(ELEMENTS)), dtype=np.int64)
+    return np.array([parse_formula(str(f)) for f in formula_strings])
+
+
+def get_formula_masses(formula_strings):
+    """
+    Computes the monoisotopic masses of many formulas at once, e.g. all the compounds of a database
+    :param formula_strings: a list of formula strings
+    :return: an array of masses, the same as the `mass` of a `Formula` for each string
+    """
+    return _get_exact_masses(get_formula_counts(formula_strings))
+
+
+def _get_exact_masses(counts):
+    # the product of the counts with the element masses, summed in element order like Formula.compute_exact_mass so
+    # that the results are exactly the same
+    masses = np.zeros(len(counts))
+    for k, element_mass in enumerate(ELEMENT_MASSES):
+        masses += element_mass * counts[:, k]
+    return masses
+
+
 class Isotopes(object):
-    def __init__(self, formula):
+    def __init__(self, formula, method=ISOTOPES_CARBON, resolution=FINE_ISOTOPE_RESOLUTION,
+                 max_peaks=MAX_ISOTOPE_PEAKS):
+        """
+        Creates the isotopes of a formula
+        :param formula: a `Formula` object
+        :param method: ISOTOPES_CARBON for the 13C isotopes only, or ISOTOPES_AGGREGATED or ISOTOPES_FINE for the
+        isotopes of all the elements computed by an `IsotopeEngine`
+        :param resolution: the mass difference (in Dalton) below which ISOTOPES_FINE isotopologues are merged
+        :param max_peaks: the maximum number of ISOTOPES_AGGREGATED or ISOTOPES_FINE isotope peaks, the most abundant
+        ones, or None for no limit
+        """
         self.formula = formula
+        self.method = method
+        self.resolution = resolution
+        self.max_peaks = max_peaks
         self.C12_proportion = 0.989
         self.mz_diff = 1.0033548378
-        # TODO: Add functionality for elements other than Carbon
 
     def get_isotopes(self, total_proportion):
-        peaks = [() for i in range(len(self._get_isotope_proportions(total_proportion)))]
-        for i in range(len(peaks)):
-            peaks[i] += (self._get_isotope_mz(self._get_isotope_names(i)),)
-            peaks[i] += (self._get_isotope_proportions(total_proportion)[i],)
-            peaks[i] += (self._get_isotope_names(i),)
+        if self.method != ISOTOPES_CARBON:
+            return self._get_envelope_isotopes(total_proportion)
+        proportions = self._get_isotope_proportions(total_proportion)
+        peaks = []
+        for i in range(len(proportions)):
+            name = self._get_isotope_names(i)
+            peaks.append((self._get_isotope_mz(name), proportions[i], name))
         return peaks
 
     # outputs [(mz_1, intensity_proportion_1, isotope_name_1),...,(mz_n, intensity_proportion_n, isotope_name_n)]
 
     def _get_isotope_proportions(self, total_proportion):
-        proportions = []
-        while sum(proportions) < total_proportion:
-            proportions.extend(
-                [scipy.stats.binom.pmf(len(proportions), self.formula._get_n_element("C"), 1 - self.C12_proportion)])
-        normalised_proportions = [proportions[i] / sum(proportions) for i in range(len(proportions))]
-        return normalised_proportions
+        return list(_get_carbon_isotope_proportions(self.formula._get_n_element("C"), 1 - self.C12_proportion,
+                                                    total_proportion))
 
     def _get_isotope_names(self, isotope_number):
         if isotope_number == 0:
@@ -111,12 +234,49 @@ class Isotopes(object):
         else:
             return None
 
+    def _get_envelope_isotopes(self, total_proportion):
+        shifts, abundances = get_isotope_engine(self.method).get_envelope(parse_formula(self.formula.formula_string))
+        if self.method == ISOTOPES_FINE:
+            shifts, abundances = merge_envelope(shifts, abundances, self.resolution)
+        shifts, proportions = truncate_envelope(shifts, abundances, total_proportion, max_peaks=self.max_peaks)
+        mono_mz = self.formula._get_mz()
+        peaks = []
+        for shift, proportion in zip(shifts.tolist(), proportions.tolist()):
+            nominal_shift = int(round(shift))
+            name = "Mono" if nominal_shift == 0 else "M+%d" % nominal_shift
+            peaks.append((mono_mz + shift, proportion, name))
+        return peaks
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def _get_carbon_isotope_proportions(n_carbon, c13_proportion, total_proportion):
+    # the binomial probabilities of 0, 1, 2, ... 13C atoms, until they add up to total_proportion
+    proportions = []
+    while sum(proportions) < total_proportion:
+        proportions.extend([scipy.stats.binom.pmf(len(proportions), n_carbon, c13_proportion)])
+    return tuple(proportions[i] / sum(proportions) for i in range(len(proportions)))
+
+
+def get_isotope_engine(method):
+    """
+    Gets the shared `IsotopeEngine` of an isotope method, so that envelopes are cached across chemicals
+    :param method: ISOTOPES_AGGREGATED or ISOTOPES_FINE
+    :return: an `IsotopeEngine` for the formula counts of `parse_formula`
+    """
+    if method not in ISOTOPE_ENGINES:
+        if method not in [ISOTOPES_AGGREGATED, ISOTOPES_FINE]:
+            raise ValueError("Isotope method must be one of '%s', '%s' or '%s'" % (ISOTOPES_CARBON,
+                                                                                 ISOTOPES_AGGREGATED, ISOTOPES_FINE))
+        ISOTOPE_ENGINES[method] = IsotopeEngine(ELEMENTS, fine=method == ISOTOPES_FINE)
+    return ISOTOPE_ENGINES[method]
+
 
 class Adducts(object):
-    def __init__(self, formula, adduct_proportion_cutoff=0.05):
+    def __init__(self, formula, adduct_proportion_cutoff=0.05, rng=None):
         self.adduct_names = list(POS_TRANSFORMATIONS.keys())
         self.formula = formula
         self.adduct_proportion_cutoff = adduct_proportion_cutoff
+        self.rng = rng
 
     def get_adducts(self):
         adducts = []
@@ -130,9 +290,10 @@ class Adducts(object):
         # TODO: replace this with something proper
         prior = np.ones(len(self.adduct_names)) * 0.1
         prior[0] = 1.0  # give more weight to the first one, i.e. M+H
-        proportions = np.random.dirichlet(prior)
+        rng = get_rng(self.rng)
+        proportions = rng.dirichlet(prior)
         while max(proportions) < 0.2:
-            proportions = np.random.dirichlet(prior)
+            proportions = rng.dirichlet(prior)
         proportions[np.where(proportions < self.adduct_proportion_cutoff)] = 0
         proportions = proportions / max(proportions)
         proportions.tolist()
@@ -229,22 +390,27 @@ class MSN(Chemical):
 
 
 class ChemicalCreator(object):
-    def __init__(self, peak_sampler, ROI_sources=None, database=None):
+    def __init__(self, peak_sampler, ROI_sources=None, database=None, rng=None):
         self.peak_sampler = peak_sampler
         self.ROI_sources = ROI_sources
+        if isinstance(database, (str, Path)):  # a table written by save_compound_table
+            database = load_compound_table(database)
         self.database = database
+        self.rng = rng  # used for all the draws made while creating chemicals, None to use the global numpy state
 
         # sort database compounds by their mass
         if self.database is not None:
             logger.debug('Sorting database compounds by masses')
-            compound_mass_list = [Formula(compound.chemical_formula).mass for compound in self.database]
+            compound_mass_list = get_formula_masses([compound.chemical_formula for compound in self.database])
             sort_index = np.argsort(compound_mass_list)
             self.compound_mass_list = np.array(compound_mass_list)[sort_index].tolist()
             self.compound_list = np.array(self.database)[sort_index].tolist()
+            self.mass_index = MassIndex(self.compound_mass_list)
 
     def sample(self, mz_range, rt_range, min_ms1_intensity, n_ms1_peaks, ms_levels, alpha=math.inf,
                fixed_mz=False, adduct_proportion_cutoff=0.05, roi_rt_range=None, include_adducts_isotopes=True,
-               get_children_method=GET_MS2_BY_PEAKS):
+               get_children_method=GET_MS2_BY_PEAKS, isotope_method=ISOTOPES_CARBON,
+               isotope_resolution=FINE_ISOTOPE_RESOLUTION, max_isotope_peaks=MAX_ISOTOPE_PEAKS):
         self.mz_range = mz_range
         self.rt_range = rt_range
         self.min_ms1_intensity = min_ms1_intensity
@@ -255,6 +421,9 @@ class ChemicalCreator(object):
         self.adduct_proportion_cutoff = adduct_proportion_cutoff
         self.include_adducts_isotopes = include_adducts_isotopes
         self.get_children_method = get_children_method
+        self.isotope_method = isotope_method
+        self.isotope_resolution = isotope_resolution
+        self.max_isotope_peaks = max_isotope_peaks
 
         # set up some counters
         self.crp_samples = [[] for i in range(self.ms_levels)]
@@ -272,9 +441,12 @@ class ChemicalCreator(object):
         logger.debug("{} chemicals to be created.".format(n_ms1))
         sampled_peaks = self.peak_sampler.get_peak(1, n_ms1, self.mz_range[0][0], self.mz_range[0][1],
                                                    self.rt_range[0][0],
-                                                   self.rt_range[0][1], self.min_ms1_intensity)
+                                                   self.rt_range[0][1], self.min_ms1_intensity, rng=self.rng)
         # Get formulae from database and check there are enough of them
         self.formula_list = self._sample_formulae(sampled_peaks)
+        if self.include_adducts_isotopes and self.isotope_method != ISOTOPES_CARBON:
+            # computes the envelopes of all the formulas together, they are then cached for each chemical
+            get_isotope_engine(self.isotope_method).get_envelopes(get_formula_counts(self.formula_list))
 
         # Get file split information
         split = self._get_n_ROI_files()
@@ -340,24 +512,12 @@ class ChemicalCreator(object):
     def _sample_formulae(self, sampled_peaks):
         assert len(sampled_peaks) < len(self.database), 'The number of sampled peaks must be less than ' \
                                                         'the number of database compounds'
-        formula_set = set()
-        for formula_index in range(len(sampled_peaks)):
-            if formula_index % 500 == 0:
-                logger.debug('Sampling formula %d/%d' % (formula_index, len(sampled_peaks)))
-
-            mz_peak_sample = sampled_peaks[formula_index].mz
-            idx = np.argsort(abs(self.compound_mass_list - mz_peak_sample))
-
-            list_index = 0
-            compound_found = False
-            while compound_found is False:
-                pos = idx[list_index]
-                new_compound = self.compound_list[pos].chemical_formula
-                if str(new_compound) not in formula_set:
-                    formula_set.add(str(new_compound))
-                    compound_found = True
-                list_index += 1
-        return list(formula_set)
+        # each peak in turn takes the formula of the nearest compound whose formula hasn't been taken yet, so the
+        # formulas keep the sampling order and the same seed gives the same chemicals
+        logger.debug('Sampling %d formulae' % len(sampled_peaks))
+        formulas = [str(compound.chemical_formula) for compound in self.compound_list]
+        positions = self.mass_index.sample_nearest([peak.mz for peak in sampled_peaks], formulas)
+        return [formulas[pos] for pos in positions]
 
     def _get_children(self, get_children_method, parent, n_peaks=None):
         if get_children_method == GET_MS2_BY_SPECTRA:
@@ -374,11 +534,11 @@ class ChemicalCreator(object):
     def _get_children_spectra(self, parent):
         # spectra is a list containing one MassSpec.Scan object
 
-        spectra = self.peak_sampler.get_ms2_spectra()[0]
+        spectra = self.peak_sampler.get_ms2_spectra(rng=self.rng)[0]
         kids = []
         return kids
         intensity_props = self._get_msn_proportions(None, None, spectra.intensities)
-        parent_mass_prop = self.peak_sampler.get_parent_intensity_proportion()
+        parent_mass_prop = self.peak_sampler.get_parent_intensity_proportion(rng=self.rng)
         for i in range(len(spectra.mzs)):
             kid = MSN(spectra.mzs[i], spectra.ms_level, intensity_props[i], parent_mass_prop, None, parent)
             kids.append(kid)
@@ -389,7 +549,7 @@ class ChemicalCreator(object):
         if n_peaks is None:
             n_peaks = self._get_n(children_ms_level)
         kids = []
-        parent_mass_prop = self.peak_sampler.get_parent_intensity_proportion()
+        parent_mass_prop = self.peak_sampler.get_parent_intensity_proportion(rng=self.rng)
         kids_intensity_proportions = self._get_msn_proportions(children_ms_level, n_peaks)
         if self.alpha < math.inf:
             # draws from here if using Chinese Restaurant Process (SLOW!!!)
@@ -397,7 +557,7 @@ class ChemicalCreator(object):
                 next_crp, self.counts[children_ms_level - 1] = Restricted_Crp(self.alpha,
                                                                               self.counts[children_ms_level - 1],
                                                                               self.crp_index[children_ms_level - 1],
-                                                                              index_children)
+                                                                              index_children, rng=self.rng)
                 self.crp_index[children_ms_level - 1].append(next_crp)
                 if next_crp == max(self.crp_index[children_ms_level - 1]):
                     kid = self._get_unknown_msn(children_ms_level, parent)
@@ -425,9 +585,9 @@ class ChemicalCreator(object):
     def _get_msn_proportions(self, children_ms_level=None, n_peaks=None, children_intensities=None):
         if children_intensities is None:
             if children_ms_level == 2:
-                kids_intensities = self.peak_sampler.get_peak(children_ms_level, n_peaks)
+                kids_intensities = self.peak_sampler.get_peak(children_ms_level, n_peaks, rng=self.rng)
             else:
-                kids_intensities = self.peak_sampler.get_peak(2, n_peaks)
+                kids_intensities = self.peak_sampler.get_peak(2, n_peaks, rng=self.rng)
             kids_intensities_total = sum([x.intensity for x in kids_intensities])
             kids_intensities_proportion = [x.intensity / kids_intensities_total for x in kids_intensities]
         else:
@@ -440,9 +600,9 @@ class ChemicalCreator(object):
         if ms_level == 1:
             return int(self.n_ms1_peaks)
         elif ms_level == 2:
-            return int(self.peak_sampler.n_peaks(2, 1))
+            return int(self.peak_sampler.n_peaks(2, 1, rng=self.rng))
         else:
-            return int(math.floor(self.peak_sampler.n_peaks(2, 1) / (5 ** (ms_level - 2))))
+            return int(math.floor(self.peak_sampler.n_peaks(2, 1, rng=self.rng) / (5 ** (ms_level - 2))))
 
     def _get_known_ms1(self, formula, ROI, sampled_peak, include_adducts_isotopes):  # fix this
         ## from sampled_peak.rt (XCMS output), we get the point where maximum intensity occurs
@@ -452,16 +612,16 @@ class ChemicalCreator(object):
         adjusted_rt = rt - min2mid_rt_ROI
         intensity = sampled_peak.intensity
         formula = Formula(formula)
-        isotopes = Isotopes(formula)
-        adducts = Adducts(formula, self.adduct_proportion_cutoff)
+        isotopes = Isotopes(formula, self.isotope_method, self.isotope_resolution, self.max_isotope_peaks)
+        adducts = Adducts(formula, self.adduct_proportion_cutoff, rng=self.rng)
         return KnownChemical(formula, isotopes, adducts, adjusted_rt, intensity, ROI.chromatogram, None,
                              include_adducts_isotopes)
 
     def _get_unknown_msn(self, ms_level, parent=None):  # fix this
         if ms_level == 2:
-            mz = self.peak_sampler.get_peak(ms_level, 1)[0].mz
+            mz = self.peak_sampler.get_peak(ms_level, 1, rng=self.rng)[0].mz
         else:
-            mz = self.peak_sampler.get_peak(2, 1)[0].mz
+            mz = self.peak_sampler.get_peak(2, 1, rng=self.rng)[0].mz
         return MSN(mz, ms_level, None, None, None, parent)
 
     def _valid_ms1_chem(self, chem):
@@ -479,7 +639,16 @@ class MultiSampleCreator(object):
     def __init__(self, original_dataset, n_samples, classes, intensity_noise_sd,
                  change_probabilities, change_differences_means, change_differences_sds, dropout_probabilities=None,
                  dropout_numbers=None, experimental_classes=None, experimental_probabilitities=None,
-                 experimental_sds=None, save_location=None):
+                 experimental_sds=None, save_location=None, rng=None, compact=False):
+        """
+        Creates multiple samples from an original dataset by changing the intensities of chemicals between classes,
+        dropping some chemicals and adding noise.
+        The intensities and presence of the chemicals in each sample are always stored in sample_intensities and
+        sample_masks (arrays of shape (number of samples, number of chemicals)). Unless compact is True, a copy of the
+        chemicals is also created for each sample in samples.
+        :param compact: if True, don't copy the chemicals for each sample, e.g. when simulating all the samples
+        together with MultiSample.MultiSampleEnvironment. Samples are not saved to save_location in this case.
+        """
         self.original_dataset = original_dataset
         self.n_samples = n_samples
         self.classes = classes
@@ -493,6 +662,8 @@ class MultiSampleCreator(object):
         self.experimental_probabilitities = experimental_probabilitities
         self.experimental_sds = experimental_sds
         self.save_location = save_location
+        self.rng = rng
+        self.compact = compact
 
         self.sample_classes = []
         for index_classes in range(len(self.classes)):
@@ -504,28 +675,45 @@ class MultiSampleCreator(object):
             self.experimental_effects = self._get_experimental_effects()
         logger.debug("Classes, Statuses and Differences defined.")
 
+        n_total = sum(self.n_samples)
+        self.sample_intensities = np.zeros((n_total, len(self.original_dataset)))
+        self.sample_masks = np.zeros((n_total, len(self.original_dataset)), dtype=bool)
         self.samples = []
-        for index_sample in range(sum(self.n_samples)):
-            logger.debug("Dataset {} of {} created.".format(index_sample + 1, sum(self.n_samples)))
+        for index_sample in range(n_total):
+            logger.debug("Dataset {} of {} created.".format(index_sample + 1, n_total))
+            intensities, mask = self._get_sample_intensities(index_sample)
+            self.sample_intensities[index_sample] = intensities
+            self.sample_masks[index_sample] = mask
+            if self.compact:
+                continue
+
             new_sample = copy.deepcopy(self.original_dataset)
-            which_class = np.where(np.array(self.classes) == self.sample_classes[index_sample])
-            for index_chemical in range(len(new_sample)):
-                if not np.array(self.chemical_statuses)[which_class][0][index_chemical] == "missing":
-                    original_intensity = new_sample[index_chemical].max_intensity
-                    intensity = self._get_intensity(original_intensity, which_class, index_chemical)
-                    adjusted_intensity = self._get_experimental_factor_effect(intensity, index_sample, index_chemical)
-                    noisy_adjusted_intensity = self._get_noisy_intensity(adjusted_intensity)
-                    new_sample[index_chemical].max_intensity = noisy_adjusted_intensity.tolist()[0]
-            chemicals_to_keep = np.where((np.array(self.chemical_statuses)[which_class][0]) != "missing")
+            for index_chemical in np.nonzero(mask)[0]:
+                new_sample[index_chemical].max_intensity = float(intensities[index_chemical])
+            chemicals_to_keep = np.where(mask)
             new_sample = np.array(new_sample)[chemicals_to_keep].tolist()
             if self.save_location is not None:
                 save_obj(new_sample, Path(self.save_location, 'sample_%d.p' % index_sample))
             self.samples.append(new_sample)
 
+    def _get_sample_intensities(self, index_sample):
+        which_class = np.where(np.array(self.classes) == self.sample_classes[index_sample])
+        statuses = np.array(self.chemical_statuses)[which_class][0]
+        intensities = np.array([chem.max_intensity for chem in self.original_dataset], dtype=float)
+        mask = statuses != "missing"
+        for index_chemical in np.nonzero(mask)[0]:
+            original_intensity = self.original_dataset[index_chemical].max_intensity
+            intensity = self._get_intensity(original_intensity, which_class, index_chemical)
+            adjusted_intensity = self._get_experimental_factor_effect(intensity, index_sample, index_chemical)
+            noisy_adjusted_intensity = self._get_noisy_intensity(adjusted_intensity)
+            intensities[index_chemical] = noisy_adjusted_intensity.tolist()[0]
+        return intensities, mask
+
     def _get_chemical_statuses(self):
         chemical_statuses = [np.array(["unchanged" for i in range(len(self.original_dataset))])]
-        chemical_statuses.extend([np.random.choice(["changed", "unchanged"], len(self.original_dataset),
-                                                   p=[self.change_probabilities[i], 1 - self.change_probabilities[i]])
+        rng = get_rng(self.rng)
+        chemical_statuses.extend([rng.choice(["changed", "unchanged"], len(self.original_dataset),
+                                             p=[self.change_probabilities[i], 1 - self.change_probabilities[i]])
                                   for i in range(len(self.classes) - 1)])
         self.missing = self._get_missing_chemicals(chemical_statuses)
         self.missing_chemicals = [np.array(self.original_dataset)[miss].tolist() for miss in self.missing]
@@ -539,10 +727,14 @@ class MultiSampleCreator(object):
             if self.dropout_probabilities is not None:
                 if self.dropout_numbers is not None:
                     logger.debug("using dropout_probabilties rather than dropout_number.")
-                new_missing = list(np.where(np.random.binomial(1, self.dropout_probabilities[len(missing)],
-                                                               len(self.original_dataset)))[0])
+                new_missing = list(np.where(get_rng(self.rng).binomial(1, self.dropout_probabilities[len(missing)],
+                                                                       len(self.original_dataset)))[0])
             if self.dropout_probabilities is None and self.dropout_numbers is not None:
-                new_missing = random.sample(range(0, len(self.original_dataset)), self.dropout_numbers)
+                if self.rng is None:
+                    new_missing = random.sample(range(0, len(self.original_dataset)), self.dropout_numbers)
+                else:
+                    new_missing = self.rng.choice(len(self.original_dataset), self.dropout_numbers,
+                                                  replace=False).tolist()
             missing.append(new_missing)
             missing = [list(x) for x in set(tuple(sorted(x)) for x in missing)]
         return missing
@@ -550,15 +742,15 @@ class MultiSampleCreator(object):
     def _get_experimental_statuses(self):
         experimental_statuses = []
         for i in range(len(self.experimental_classes)):
-            class_allocation = np.random.choice(self.experimental_classes[i], sum(self.n_samples),
-                                                p=self.experimental_probabilitities[i])
+            class_allocation = get_rng(self.rng).choice(self.experimental_classes[i], sum(self.n_samples),
+                                                        p=self.experimental_probabilitities[i])
             experimental_statuses.append(class_allocation)
         return experimental_statuses
 
     def _get_experimental_effects(self):
         experimental_effects = []
         for i in range(len(self.experimental_classes)):
-            coef = [np.random.normal(0, self.experimental_sds[i], len(self.experimental_classes[i])) for j in
+            coef = [get_rng(self.rng).normal(0, self.experimental_sds[i], len(self.experimental_classes[i])) for j in
                     range(len(self.original_dataset))]
             experimental_effects.append(coef)
         return experimental_effects
@@ -570,7 +762,7 @@ class MultiSampleCreator(object):
             coef_mean = self.change_differences_means[index_classes - 1]
             coef_sd = self.change_differences_sds[index_classes - 1]
             coef_len = sum(self.chemical_statuses[index_classes] == "changed")
-            coef = np.random.normal(coef_mean, coef_sd, coef_len)
+            coef = get_rng(self.rng).normal(coef_mean, coef_sd, coef_len)
             chemical_differences_from_class1[index_classes][
                 np.where(self.chemical_statuses[index_classes] == "changed")] = coef
         return chemical_differences_from_class1
@@ -593,7 +785,7 @@ class MultiSampleCreator(object):
         return intensity + experimental_factor_effect
 
     def _get_noisy_intensity(self, adjusted_intensity):
-        noisy_intensity = adjusted_intensity + np.random.normal(0, self.intensity_noise_sd[0], 1)
+        noisy_intensity = adjusted_intensity + get_rng(self.rng).normal(0, self.intensity_noise_sd[0], 1)
         if noisy_intensity < 0:
             logger.warning("Warning: Negative Intensities have been created")
         return noisy_intensity
@@ -1,14 +1,16 @@
 import numpy as np
 
+from vimms.Common import get_rng
 
-def discrete_draw(p):
+
+def discrete_draw(p, rng=None):
     # samples a discrete number based on a vector of probabilities
+    rng = get_rng(rng)
     probs = [float(z) / sum(p) for z in p]
-    rv = np.random.multinomial(1, probs)
-    return int(np.where(np.random.multinomial(1, probs) == 1)[0])
+    return int(np.where(rng.multinomial(1, probs) == 1)[0][0])
 
 
-def Restricted_Crp(alpha, previous_counts, previous_ms2, len_current_ms2):
+def Restricted_Crp(alpha, previous_counts, previous_ms2, len_current_ms2, rng=None):
     # Draws a value from a Chinese Restaurant process, but excludes values already part of the current sample
     n = len(previous_ms2)
     if previous_ms2 == []:
@@ -21,7 +23,7 @@ def Restricted_Crp(alpha, previous_counts, previous_ms2, len_current_ms2):
         else:
             assign_probs[i] = previous_counts[i] / (n - 1 + alpha)
     assign_probs[-1] = alpha / (n - 1 + alpha)
-    next_crp = discrete_draw(assign_probs)
+    next_crp = discrete_draw(assign_probs, rng=rng)
     if next_crp == (len(previous_counts)):
         previous_counts.append(1)
     else:
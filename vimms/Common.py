@@ -7,6 +7,7 @@ import pathlib
 import pickle
 import sys
 import zipfile
+import zlib
 from bisect import bisect_left
 
 import numpy as np
@@ -197,3 +198,68 @@ def extract_zip_file(in_file, delete=True):
     if delete:
         logger.info('Deleting %s' % in_file)
         os.remove(in_file)
+
+
+########################################################################################################################
+# Random number streams
+########################################################################################################################
+
+
+def get_rng(rng=None):
+    """
+    Returns the random number generator a component should draw from
+    :param rng: a numpy Generator, or None to use the legacy global numpy random state
+    :return: rng, or the np.random module if rng is None
+    """
+    return np.random if rng is None else rng
+
+
+class RandomStreams(object):
+    """
+    A hierarchy of independent random number streams derived from a single seed.
+    Each component (mass spec, peak sampler, chemical creator, ...) draws from its own named stream, so changing how
+    many numbers one component uses doesn't shift the draws of any other component. Running two controllers with the
+    same seed gives common random numbers across the comparison.
+    """
+    # added to the spawn key before the hash of a stream name, so that named streams never collide with the
+    # numbered hierarchies created by spawn()
+    NAME_TAG = 0x6e616d65
+
+    def __init__(self, seed=None):
+        """
+        Creates a hierarchy of random streams
+        :param seed: an int, a numpy SeedSequence, or None for fresh entropy
+        """
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+    def get(self, name):
+        """
+        Creates a Generator for a named stream. The same name always gives a Generator starting from the same state.
+        :param name: the stream name, e.g. 'mass_spec'
+        :return: a numpy Generator
+        """
+        return np.random.default_rng(self._child_sequence(name))
+
+    def child(self, name):
+        """
+        Creates a named sub-hierarchy, e.g. for the components of one sample in a multi-sample experiment
+        :param name: the sub-hierarchy name
+        :return: a new RandomStreams object
+        """
+        return RandomStreams(self._child_sequence(name))
+
+    def spawn(self, n):
+        """
+        Creates independent hierarchies for parallel workers
+        :param n: the number of hierarchies to create
+        :return: a list of n RandomStreams objects
+        """
+        return [RandomStreams(seq) for seq in self.seed_sequence.spawn(n)]
+
+    def _child_sequence(self, name):
+        key = zlib.crc32(name.encode('utf-8'))
+        return np.random.SeedSequence(self.seed_sequence.entropy,
+                                      spawn_key=self.seed_sequence.spawn_key + (self.NAME_TAG, key))
+
+    def __repr__(self):
+        return 'RandomStreams entropy=%s spawn_key=%s' % (self.seed_sequence.entropy, self.seed_sequence.spawn_key)
@@ -1,4 +1,3 @@
-import bisect
 import math
 import time
 from collections import defaultdict
@@ -8,10 +7,12 @@ import pylab as plt
 from loguru import logger
 from time import time
 
-from vimms.Common import POSITIVE, DEFAULT_MS1_SCAN_WINDOW, DEFAULT_MSN_SCAN_WINDOW, DEFAULT_COLLISION_ENERGY
+from vimms.Common import POSITIVE, DEFAULT_MS1_SCAN_WINDOW, DEFAULT_MSN_SCAN_WINDOW, DEFAULT_COLLISION_ENERGY, \
+    get_rng
 from vimms.DIA import DiaWindows
+from vimms.Kernels import find_exclusion
 from vimms.MassSpec import ScanParameters, ExclusionItem
-from vimms.Roi import match, Roi
+from vimms.Roi import update_roi
 from vimms.PeakDetector import calculate_window_change
 
 
@@ -44,7 +45,7 @@ class Controller(object):
         raise NotImplementedError()
 
     def handle_scan(self, scan, queue_size):
-        logger.info('Time %f Received %s' % (scan.rt, scan))
+        logger.info('Time {} Received {}', scan.rt, scan)
         self.scans[scan.ms_level].append(scan)
 
         # plot scan if there are peaks
@@ -316,22 +317,35 @@ class TopNController(Controller):
         :param rt: RT value
         :return: True if excluded, False otherwise
         """
-        # TODO: make this faster?
-        for x in self.exclusion_list:
-            exclude_mz = x.from_mz <= mz <= x.to_mz
-            exclude_rt = x.from_rt <= rt <= x.to_rt
-            if exclude_mz and exclude_rt:
-                logger.debug(
-                    'Excluded precursor ion mz {:.4f} rt {:.2f} because of {}'.format(mz, rt, x))
-                return True
+        pos = find_exclusion(mz, rt, *self._get_exclusion_arrays())
+        if pos >= 0:
+            logger.debug(
+                'Excluded precursor ion mz {:.4f} rt {:.2f} because of {}'.format(mz, rt, self.exclusion_list[pos]))
+            return True
         return False
 
+    def _get_exclusion_arrays(self):
+        """
+        Returns the bounds of the exclusion windows as arrays, rebuilt only when the exclusion list has changed
+        :return: a tuple of arrays of from_mz, to_mz, from_rt and to_rt
+        """
+        cached = getattr(self, '_exclusion_arrays', None)
+        if cached is None or cached[0] is not self.exclusion_list or cached[1] != len(self.exclusion_list):
+            bounds = np.array([(x.from_mz, x.to_mz, x.from_rt, x.to_rt) for x in self.exclusion_list],
+                              dtype=np.double).reshape(-1, 4)
+            arrays = tuple(np.ascontiguousarray(bounds[:, i]) for i in range(4))
+            cached = (self.exclusion_list, len(self.exclusion_list), arrays)
+            self._exclusion_arrays = cached
+        return cached[2]
+
 
 class PurityController(TopNController):
     def __init__(self, ionisation_mode, N, scan_param_changepoints,
                  isolation_widths, mz_tols, rt_tols, min_ms1_intensity,
-                 n_purity_scans=None, purity_shift=None, purity_threshold=0, purity_randomise=True, purity_add_ms1=True):
+                 n_purity_scans=None, purity_shift=None, purity_threshold=0, purity_randomise=True, purity_add_ms1=True,
+                 rng=None):
         super().__init__(ionisation_mode, N, isolation_widths, mz_tols, rt_tols, min_ms1_intensity)
+        self.rng = rng
 
         # make sure these are stored as numpy arrays
         self.N = np.array(N)
@@ -409,7 +423,8 @@ class PurityController(TopNController):
                     purity_shift_amounts = [self.purity_shift * (i - (self.n_purity_scans - 1) / 2) for i in
                                             range(self.n_purity_scans)]
                     if self.purity_randomise:
-                        purity_randomise_idx = np.random.choice(self.n_purity_scans, self.n_purity_scans, replace=False)
+                        purity_randomise_idx = get_rng(self.rng).choice(self.n_purity_scans, self.n_purity_scans,
+                                                                        replace=False)
                     else:
                         purity_randomise_idx = range(self.n_purity_scans)
                     for purity_idx in purity_randomise_idx:
@@ -539,21 +554,17 @@ class RoiController(TopNController):
             self.live_roi_fragmented = np.array(self.live_roi_fragmented)[order].tolist()
             self.live_roi_last_rt = np.array(self.live_roi_last_rt)[order].tolist()
             current_ms1_scan_rt = new_scan.rt
-            not_grew = set(self.live_roi)
-            for idx in range(len(new_scan.intensities)):
-                intensity = new_scan.intensities[idx]
-                mz = new_scan.mzs[idx]
-                if intensity >= self.min_roi_intensity:
-                    match_roi = match(Roi(mz, 0, 0), self.live_roi, self.mz_tols, mz_units=self.mz_units)
-                    if match_roi:
-                        match_roi.add(mz, current_ms1_scan_rt, intensity)
-                        if match_roi in not_grew:
-                            not_grew.remove(match_roi)
-                    else:
-                        new_roi = Roi(mz, current_ms1_scan_rt, intensity)
-                        bisect.insort_right(self.live_roi, new_roi)
-                        self.live_roi_fragmented.insert(self.live_roi.index(new_roi), False)
-                        self.live_roi_last_rt.insert(self.live_roi.index(new_roi), None)
+            n_points = [roi.n for roi in self.live_roi]
+            keep = np.asarray(new_scan.intensities) >= self.min_roi_intensity
+            mzs = np.asarray(new_scan.mzs)[keep]
+            intensities = np.asarray(new_scan.intensities)[keep]
+            old_roi = self.live_roi
+            self.live_roi, positions = update_roi(self.live_roi, mzs, current_ms1_scan_rt, intensities,
+                                                  self.mz_tols, mz_units=self.mz_units)
+            self.live_roi_fragmented = [self.live_roi_fragmented[pos] if pos is not None else False
+                                        for pos in positions]
+            self.live_roi_last_rt = [self.live_roi_last_rt[pos] if pos is not None else None for pos in positions]
+            not_grew = set(roi for roi, n in zip(old_roi, n_points) if roi.n == n)
 
             for roi in not_grew:
                 if roi.n >= self.min_roi_length:
@@ -673,6 +684,83 @@ class Classifier_RoiController(RoiController):  # TODO: Needs properly implement
         scores = self._get_top_N_scores(initial_scores)
         return scores
 
+########################################################################################################################
+# Fixed schedule controllers
+########################################################################################################################
+
+class FixedScheduleController(Controller):
+    """
+    A controller whose scans are known before the run starts and don't depend on the content of the scans it
+    receives, e.g. fixed-window DIA or a schedule replayed from a previous run.
+    Because of this, runs using this controller can be sharded across processes by ShardedEnvironment.
+    """
+
+    def __init__(self, cycle=None, schedule=None):
+        """
+        Creates a fixed schedule controller
+        :param cycle: a list of ScanParameters for the MSn scans to send after every MS1 scan
+        :param schedule: a list of ScanParameters for the scans to acquire, in order, at the start of the run.
+        Default MS1 scans are acquired once the schedule is finished.
+        """
+        super().__init__()
+        self.cycle = [] if cycle is None else cycle
+        self.schedule = [] if schedule is None else schedule
+
+    @staticmethod
+    def from_dia_windows(dia_design, kaufmann_design, extra_bins, num_windows=None,
+                         ms1_range=DEFAULT_MS1_SCAN_WINDOW):
+        """
+        Creates a controller that sends evenly spaced DIA windows after every MS1 scan.
+        The windows are the same as those of a TreeController with window_type='even'.
+        :param dia_design: 'basic' or 'kaufmann'
+        :param kaufmann_design: the kaufmann design, used when dia_design is 'kaufmann'
+        :param extra_bins: the number of extra bins
+        :param num_windows: the number of windows for the 'basic' design
+        :param ms1_range: the m/z range to cover
+        :return: a FixedScheduleController
+        """
+        locations = DiaWindows(None, [ms1_range], dia_design, 'even', kaufmann_design, extra_bins,
+                               num_windows).locations
+        cycle = []
+        for isolation_windows in locations:
+            dda_scan_params = ScanParameters()
+            dda_scan_params.set(ScanParameters.MS_LEVEL, 2)
+            dda_scan_params.set(ScanParameters.ISOLATION_WINDOWS, isolation_windows)
+            cycle.append(dda_scan_params.freeze())
+        return FixedScheduleController(cycle=cycle)
+
+    @staticmethod
+    def from_scans(scans):
+        """
+        Creates a controller that replays the scans acquired in a previous run
+        :param scans: a dictionary of scans by ms level, e.g. controller.scans of the previous run
+        :return: a FixedScheduleController
+        """
+        all_scans = sorted([scan for level in scans for scan in scans[level]], key=lambda scan: scan.scan_id)
+        return FixedScheduleController(schedule=[scan.scan_params for scan in all_scans])
+
+    def handle_acquisition_open(self):
+        logger.info('Acquisition open')
+        self.environment.add_tasks(self.schedule)
+
+    def handle_acquisition_closing(self):
+        logger.info('Acquisition closing')
+
+    def _process_scan(self, scan, queue_size):
+        if scan.ms_level == 1:
+            return list(self.cycle)
+        return []
+
+    def update_state_after_scan(self, last_scan):
+        pass
+
+    def handle_state_changed(self, state):
+        pass
+
+    def reset(self):
+        pass
+
+
 ########################################################################################################################
 # DIA Controllers
 ########################################################################################################################
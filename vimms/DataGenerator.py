@@ -1,8 +1,12 @@
 import copy
 import glob
+import hashlib
+import json
+import math
 import os
 import xml.etree.ElementTree
 import zipfile
+from collections.abc import Mapping
 
 import numpy as np
 import pandas as pd
@@ -11,13 +15,54 @@ import pymzml
 from loguru import logger
 from sklearn.neighbors import KernelDensity
 
-from vimms.Chemicals import DatabaseCompound
-from vimms.Common import MZ, INTENSITY, RT, N_PEAKS, SCAN_DURATION, MZ_INTENSITY_RT, save_obj
-from vimms.MassSpec import Peak, Scan
-from vimms.SpectralUtils import get_precursor_info
+from vimms.Chemicals import DatabaseCompound, save_compound_table, load_compound_table
+from vimms.Common import MZ, INTENSITY, RT, N_PEAKS, SCAN_DURATION, MZ_INTENSITY_RT, save_obj, get_rng, \
+    create_if_not_exist
+from vimms.Densities import HistogramDensity, get_density_arrays, make_density
+from vimms.MassSpec import Peak
+from vimms.Parallel import run_jobs
+from vimms.SpectralUtils import get_precursor_info, PrecursorInfoExtractor, MS2Library, make_ms2_library, \
+    get_spectrum_rts
 
+# the format written by save_peak_sampler
+PEAK_SAMPLER_FORMAT = 'vimms_peak_sampler'
+PEAK_SAMPLER_VERSION = 2  # 2: MS2 spectra stored as MS2Library columns
+
+# the suffix of the compound table cached next to an HMDB file by extract_hmdb_metabolite
+COMPOUND_TABLE_SUFFIX = '_compounds.tsv'
+
+# the density estimators that PeakSampler can use
+KDE_DENSITY = 'kde'
+HISTOGRAM_DENSITY = 'histogram'
+
+
+def extract_hmdb_metabolite(in_file, delete=True, use_cache=True):
+    """
+    Extracts metabolites from the HMDB metabolites .xml file, or from a .zip file containing it.
+    The file is streamed one metabolite at a time, so memory use doesn't grow with its size.
+    A table of the compounds is cached next to `in_file` (see `get_compound_table_file`), and later calls read
+    that table instead of parsing the file again, even if `in_file` has been deleted. The extraction doesn't fail if
+    the table can't be written, e.g. in a read-only directory.
+    :param in_file: the HMDB .xml or .zip file
+    :param delete: whether to delete `in_file` once the compounds have been extracted or loaded from the table
+    :param use_cache: whether to read and write the cached compound table
+    :return: a list of `DatabaseCompound` objects
+    """
+    table_file = get_compound_table_file(in_file)
+    if use_cache and os.path.exists(table_file) and \
+            (not os.path.exists(in_file) or os.path.getmtime(table_file) >= os.path.getmtime(in_file)):
+        try:
+            compounds = load_compound_table(table_file)
+            # tables written before the structures were stored are only used if the HMDB file is gone
+            if not os.path.exists(in_file) or all(compound.smiles is not None for compound in compounds):
+                logger.info('Loaded %d DatabaseCompounds from %s' % (len(compounds), table_file))
+                if delete and os.path.exists(in_file):
+                    logger.info('Deleting %s' % in_file)
+                    os.remove(in_file)
+                return compounds
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring invalid compound table %s: %s' % (table_file, e))
 
-def extract_hmdb_metabolite(in_file, delete=True):
     logger.debug('Extracting HMDB metabolites from %s' % in_file)
 
     # if out_file is zipped then extract the xml file inside
@@ -28,37 +73,21 @@ def extract_hmdb_metabolite(in_file, delete=True):
         f = zf.open(metabolite_xml_file)
     except zipfile.BadZipFile:  # oops not a zip file
         zf = None
-        f = in_file
+        f = open(in_file, 'rb')
 
-    # loops through file and extract the necessary element text to create a DatabaseCompound
-    db = xml.etree.ElementTree.parse(f).getroot()
-    compounds = []
-    prefix = '{http://www.hmdb.ca}'
-    for metabolite_element in db:
-        row = [None, None, None, None, None, None]
-        for element in metabolite_element:
-            if element.tag == (prefix + 'name'):
-                row[0] = element.text
-            elif element.tag == (prefix + 'chemical_formula'):
-                row[1] = element.text
-            elif element.tag == (prefix + 'monisotopic_molecular_weight'):
-                row[2] = element.text
-            elif element.tag == (prefix + 'smiles'):
-                row[3] = element.text
-            elif element.tag == (prefix + 'inchi'):
-                row[4] = element.text
-            elif element.tag == (prefix + 'inchikey'):
-                row[5] = element.text
-
-        # if all fields are present, then add them as a DatabaseCompound
-        if None not in row:
-            compound = DatabaseCompound(row[0], row[1], row[2], row[3], row[4], row[5])
-            compounds.append(compound)
+    try:
+        compounds = list(_iter_hmdb_metabolites(f))
+    finally:
+        f.close()
+        if zf is not None:
+            zf.close()
     logger.info('Loaded %d DatabaseCompounds from %s' % (len(compounds), in_file))
 
-    f.close()
-    if zf is not None:
-        zf.close()
+    if use_cache:
+        try:
+            save_compound_table(compounds, table_file)
+        except OSError as e:
+            logger.warning('Could not cache the compounds to %s: %s' % (table_file, e))
 
     if delete:
         logger.info('Deleting %s' % in_file)
@@ -67,24 +96,67 @@ def extract_hmdb_metabolite(in_file, delete=True):
     return compounds
 
 
-def get_data_source(mzml_path, filename, xcms_output=None):
+def get_compound_table_file(in_file):
+    """
+    Gets the location of the compound table cached by `extract_hmdb_metabolite`
+    :param in_file: the HMDB .xml or .zip file
+    :return: the path of the table, next to `in_file`
+    """
+    return os.path.splitext(str(in_file))[0] + COMPOUND_TABLE_SUFFIX
+
+
+def _iter_hmdb_metabolites(f):
+    # loops through file and extract the necessary element text to create a DatabaseCompound
+    prefix = '{http://www.hmdb.ca}'
+    fields = {prefix + tag: k for k, tag in enumerate(['name', 'chemical_formula', 'monisotopic_molecular_weight',
+                                                        'smiles', 'inchi', 'inchikey', 'accession'])}
+    root = None
+    depth = 0
+    for event, element in xml.etree.ElementTree.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:  # only metabolites, the children of the root, are processed
+            continue
+
+        row = [None, None, None, None, None, None, None]
+        for child in element:
+            k = fields.get(child.tag)
+            if k is not None:
+                row[k] = child.text
+
+        # if all fields are present, then add them as a DatabaseCompound
+        if None not in row[:6]:
+            yield DatabaseCompound(row[0], row[1], float(row[2]), row[3], row[4], row[5], accession=row[6])
+
+        # discard the parsed metabolites, as the root would otherwise keep all of them
+        root.clear()
+
+
+def get_data_source(mzml_path, filename, xcms_output=None, cache_dir=None, n_jobs=1):
     """
     Load a `DataSource` object that stores information on a set of .mzML files.
     :param mzml_path: the location of .mzML files to train the KDEs.
     :param filename: a particular .mzML file to be used. If None then all files in `mzml_path` will be used.
     :param xcms_output: As an option, we can use XCMS peak picking results to train the (mz, RT, intensity) densities.
     This makes the generated spectra more similar to real ones after peak picking. If not available, leave this as None.
+    :param cache_dir: a directory to cache the data extracted from the .mzML files, so that loading the same files
+    again is fast. If None, no cache is used.
+    :param n_jobs: the number of worker processes used to load the .mzML files, None for the number of CPUs.
     :return: a DataSource object.
     """
     ds = DataSource()
-    ds.load_data(mzml_path, filename)
+    ds.load_data(mzml_path, filename, cache_dir=cache_dir, n_jobs=n_jobs)
     if xcms_output is not None:
         ds.load_xcms_output(xcms_output)
     return ds
 
 
 def get_spectral_feature_database(ds, filename, min_ms1_intensity, min_ms2_intensity, min_rt, max_rt,
-                                  bandwidth_mz_intensity_rt, bandwidth_n_peaks, out_file=None):
+                                  bandwidth_mz_intensity_rt, bandwidth_n_peaks, out_file=None, density=KDE_DENSITY):
     """
     Generate spectral feature database on the .mzML files that have been loaded into the DataSource
     :param ds: the `DataSource` object that contains loaded .mzML files.
@@ -96,15 +168,130 @@ def get_spectral_feature_database(ds, filename, min_ms1_intensity, min_ms2_inten
     :param bandwidth_mz_intensity_rt: the bandwidth of the kernel to train the KDEs for (mz, RT, intensity) values.
     :param bandwidth_n_peaks: the bandwidth of the kernel to train the KDEs for the number of peaks per scan.
     :param out_file: the resulting output file to store the trained KDEs (in form of `PeakSampler` object).
+    :param density: the density estimator, KDE_DENSITY for sklearn's KernelDensity or HISTOGRAM_DENSITY for the
+    smaller and faster Densities.HistogramDensity.
     :return: a PeakSampler object that can be used to draw samples for simulation.
     """
     ps = PeakSampler(ds, min_rt, max_rt, min_ms1_intensity, min_ms2_intensity, filename, False,
-                     bandwidth_mz_intensity_rt, bandwidth_n_peaks)
+                     bandwidth_mz_intensity_rt, bandwidth_n_peaks, density=density)
     if out_file is not None:
         save_obj(ps, out_file)
     return ps
 
 
+def save_peak_sampler(ps, out_dir):
+    """
+    Saves what a `PeakSampler` needs for sampling to a directory: a versioned json header and numpy arrays for the
+    densities, scan durations, intensity proportions and MS2 spectra. Unlike pickled samplers, the result doesn't
+    depend on the versions of sklearn or pandas used to create it.
+    :param ps: the `PeakSampler` object
+    :param out_dir: the output directory
+    :return: None
+    """
+    create_if_not_exist(out_dir)
+    arrays = {}
+    header = {
+        'format': PEAK_SAMPLER_FORMAT,
+        'version': PEAK_SAMPLER_VERSION,
+        'attributes': {
+            'min_rt': ps.min_rt,
+            'max_rt': ps.max_rt,
+            'min_ms1_intensity': ps.min_ms1_intensity,
+            'min_ms2_intensity': ps.min_ms2_intensity,
+            'filename': ps.filename,
+            'filename_to_N_DEW': ps.filename_to_N_DEW,
+            'kernel': ps.kernel,
+            'density': getattr(ps, 'density', KDE_DENSITY),
+            'n_bins': getattr(ps, 'n_bins', None)
+        },
+        'densities': [],
+        'scan_durations': []
+    }
+
+    for i, ((data_type, ms_level), density) in enumerate(ps.kdes.items()):
+        kind, params, density_arrays = get_density_arrays(density)
+        names = {}
+        for key, value in density_arrays.items():
+            names[key] = 'density_%d_%s' % (i, key)
+            arrays[names[key]] = value
+        header['densities'].append({'data_type': data_type, 'ms_level': ms_level, 'kind': kind, 'params': params,
+                                    'arrays': names})
+
+    for i, ((N, DEW), transitions) in enumerate(ps.file_scan_durations.items()):
+        names = []
+        for (previous_level, current_level), durations in transitions.items():
+            name = 'scan_durations_%d_%d_%d' % (i, previous_level, current_level)
+            arrays[name] = np.array(durations, dtype=np.float64)
+            names.append([previous_level, current_level, name])
+        header['scan_durations'].append({'N': N, 'DEW': DEW, 'arrays': names})
+
+    arrays['intensity_props'] = np.asarray(ps.intensity_props, dtype=np.float64)
+    library = ps._get_ms2_library()
+    for name in ['scan_ids', 'rts', 'precursor_mzs', 'precursor_rts', 'precursor_intensities', 'offsets', 'mzs',
+                 'intensities']:
+        arrays['ms2_library_%s' % name] = getattr(library, name)
+
+    for name, value in arrays.items():
+        np.save(os.path.join(out_dir, '%s.npy' % name), value)
+    with open(os.path.join(out_dir, 'header.json'), 'w') as f:  # written last, as a marker of a complete export
+        json.dump(header, f, indent=1)
+    logger.debug('Saved peak sampler to %s' % out_dir)
+
+
+def load_peak_sampler(in_dir):
+    """
+    Loads a `PeakSampler` saved by save_peak_sampler. Arrays are memory-mapped, so loading is fast and they are only
+    read when sampling needs them.
+    :param in_dir: the directory written by save_peak_sampler
+    :return: a `PeakSampler` object
+    """
+    with open(os.path.join(in_dir, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('format') != PEAK_SAMPLER_FORMAT:
+        raise ValueError('%s is not a saved peak sampler' % in_dir)
+    if header['version'] > PEAK_SAMPLER_VERSION:
+        raise ValueError('Unsupported peak sampler version %d' % header['version'])
+
+    def load(name):
+        return np.load(os.path.join(in_dir, '%s.npy' % name), mmap_mode='r')
+
+    ps = PeakSampler.__new__(PeakSampler)
+    attributes = header['attributes']
+    for key, value in attributes.items():
+        setattr(ps, key, value)
+    if ps.filename_to_N_DEW is not None:
+        ps.filename_to_N_DEW = {filename: tuple(v) for filename, v in ps.filename_to_N_DEW.items()}
+    ps.plot = False
+    ps.rng = None
+    ps.reservoirs = {}
+
+    ps.kdes = {}
+    for entry in header['densities']:
+        density_arrays = {key: load(name) for key, name in entry['arrays'].items()}
+        ps.kdes[(entry['data_type'], entry['ms_level'])] = make_density(entry['kind'], entry['params'],
+                                                                         density_arrays)
+
+    ps.file_scan_durations = {}
+    for entry in header['scan_durations']:
+        transitions = {(previous_level, current_level): load(name).tolist()
+                       for previous_level, current_level, name in entry['arrays']}
+        ps.file_scan_durations[(entry['N'], entry['DEW'])] = transitions
+
+    ps.intensity_props = load('intensity_props')
+    if header['version'] >= 2:
+        ps.ms2_library = MS2Library(*[load('ms2_library_%s' % name) for name in [
+            'scan_ids', 'rts', 'precursor_mzs', 'precursor_rts', 'precursor_intensities', 'offsets', 'mzs',
+            'intensities']])
+    else:  # the peaks of each MS2 spectrum were stored with their retention time
+        offsets = load('ms2_peak_offsets')
+        peaks = load('ms2_peaks')
+        precursor_rts = load('ms1_scan_rt')
+        ps.ms2_library = MS2Library(load('ms2_scan_ids'), get_spectrum_rts(offsets, peaks[:, 1], precursor_rts),
+                                    load('ms1_mz'), precursor_rts, load('ms1_intensity'), offsets, peaks[:, 0],
+                                    peaks[:, 2])
+    return ps
+
+
 def filter_df(df, min_ms1_intensity, rt_range, mz_range):
     # filter by rt range
     if rt_range is not None:
@@ -121,6 +308,183 @@ def filter_df(df, min_ms1_intensity, rt_range, mz_range):
     return df
 
 
+EXTRACTED_CACHE_VERSION = 1  # to be increased when the output of DataSource.extract_file changes
+
+# the columns of the precursor info dataframe, other than the ms2 peak lists, and their types
+PRECURSOR_INFO_COLUMNS = [
+    ('ms2_scan_id', np.int64),
+    ('ms2_scan_rt', np.float64),
+    ('ms2_precursor_mz', np.float64),
+    ('ms2_precursor_intensity', np.float64),
+    ('ms1_scan_id', np.int64),
+    ('ms1_scan_rt', np.float64),
+    ('ms1_mz', np.float64),
+    ('ms1_intensity', np.float64),
+    ('intensity_diff', np.float64)
+]
+
+
+def _save_extracted(cache_file, spectra, precursor_info, scan_durations):
+    # stores the output of DataSource.extract_file as flat arrays, so it can be loaded without pickle
+    arrays = {
+        'ms_levels': spectra.ms_levels,
+        'scan_times': spectra.scan_times,
+        'time_units': spectra.time_units,
+        'offsets': spectra.offsets,
+        'mzs': spectra.mzs,
+        'intensities': spectra.intensities,
+        'precursor_index': precursor_info.index.values.astype(np.int64)
+    }
+    for column, dtype in PRECURSOR_INFO_COLUMNS:
+        arrays['precursor_%s' % column] = precursor_info[column].values.astype(dtype)
+    peaklists = list(precursor_info['ms2_peaklist'])
+    arrays['precursor_peak_offsets'] = np.cumsum([0] + [len(peaklist) for peaklist in peaklists])
+    arrays['precursor_peaks'] = np.concatenate(peaklists) if len(peaklists) > 0 else np.empty((0, 3))
+    for (previous_level, current_level), durations in scan_durations.items():
+        arrays['durations_%d_%d' % (previous_level, current_level)] = np.array(durations, dtype=np.float64)
+    np.savez(cache_file, **arrays)
+
+
+def _load_extracted(cache_file):
+    # the inverse of _save_extracted
+    with np.load(cache_file, allow_pickle=False) as arrays:
+        spectra = FileSpectra(arrays['ms_levels'], arrays['scan_times'], arrays['time_units'], arrays['offsets'],
+                              arrays['mzs'], arrays['intensities'])
+        columns = {column: arrays['precursor_%s' % column] for column, _ in PRECURSOR_INFO_COLUMNS}
+        peak_offsets = arrays['precursor_peak_offsets']
+        peaks = arrays['precursor_peaks']
+        columns['ms2_peaklist'] = [peaks[peak_offsets[i]:peak_offsets[i + 1]] for i in range(len(peak_offsets) - 1)]
+        order = ['ms2_scan_id', 'ms2_scan_rt', 'ms2_precursor_mz', 'ms2_precursor_intensity', 'ms2_peaklist',
+                 'ms1_scan_id', 'ms1_scan_rt', 'ms1_mz', 'ms1_intensity', 'intensity_diff']
+        precursor_info = pd.DataFrame(columns, columns=order, index=arrays['precursor_index'])
+        scan_durations = {}
+        for key in arrays.files:
+            if key.startswith('durations_'):
+                _, previous_level, current_level = key.split('_')
+                scan_durations[(int(previous_level), int(current_level))] = arrays[key].tolist()
+    return spectra, precursor_info, scan_durations
+
+
+def _extract_file_job(job):
+    # runs DataSource.extract_file in a worker process, see DataSource.load_data
+    ds = DataSource()
+    ds.obo_version = job['obo_version']
+    ds.ms1_precision = job['ms1_precision']
+    if job['cache_dir'] is None:
+        return ds.extract_file(job['filename'])
+    return ds.extract_file_cached(job['filename'], job['cache_dir'])
+
+
+class FileSpectra(Mapping):
+    """
+    The spectra of an mzML file stored as compact arrays: the peaks of all spectra one after the other, with the start
+    of each spectrum in offsets. It's a mapping from scan number to SpectrumView objects, so it can be used in place of
+    the dictionaries of pymzml spectra that DataSource used to keep.
+    """
+
+    def __init__(self, ms_levels, scan_times, time_units, offsets, mzs, intensities):
+        """
+        Creates the spectra of a file
+        :param ms_levels: the ms level of each spectrum
+        :param scan_times: the scan time of each spectrum, as stored in the mzML file
+        :param time_units: the unit of each scan time, e.g. 'minute' or 'second'
+        :param offsets: the start of each spectrum in mzs and intensities, followed by the total number of peaks
+        :param mzs: the m/z values of all spectra
+        :param intensities: the intensities of all spectra
+        """
+        self.ms_levels = ms_levels
+        self.scan_times = scan_times
+        self.time_units = time_units
+        self.offsets = offsets
+        self.mzs = mzs
+        self.intensities = intensities
+        self.rts = np.where(time_units == 'minute', scan_times * 60.0, scan_times)  # in seconds
+
+    def get_peaks(self, scan_no):
+        """
+        Returns the peaks of a spectrum, without copying them
+        :param scan_no: the scan number
+        :return: a tuple of the m/z and intensity arrays of the spectrum
+        """
+        start, end = self.offsets[scan_no], self.offsets[scan_no + 1]
+        return self.mzs[start:end], self.intensities[start:end]
+
+    def select_peaks(self, ms_level, min_intensity=None, min_rt=None, max_rt=None, min_mz=None, max_mz=None):
+        """
+        Selects the peaks of the spectra that match some criteria
+        :param ms_level: the ms level of the spectra
+        :param min_intensity: the minimum intensity of the peaks, or None
+        :param min_rt: the minimum retention time of the spectra, in seconds, or None
+        :param max_rt: the maximum retention time of the spectra, in seconds, or None
+        :param min_mz: the minimum m/z of the peaks, or None
+        :param max_mz: the maximum m/z of the peaks, or None
+        :return: a boolean mask over mzs and intensities
+        """
+        keep_spectra = self.ms_levels == ms_level
+        if min_rt is not None:
+            keep_spectra &= self.rts >= min_rt
+        if max_rt is not None:
+            keep_spectra &= self.rts <= max_rt
+        keep = np.repeat(keep_spectra, np.diff(self.offsets))
+        if min_intensity is not None:
+            keep &= self.intensities >= min_intensity
+        if min_mz is not None:
+            keep &= self.mzs >= min_mz
+        if max_mz is not None:
+            keep &= self.mzs <= max_mz
+        return keep
+
+    def get_peak_rts(self):
+        """
+        Returns the retention time of each peak, i.e. the retention time of its spectrum
+        :return: an array of retention times in seconds, aligned with mzs and intensities
+        """
+        return np.repeat(self.rts, np.diff(self.offsets))
+
+    def __getitem__(self, scan_no):
+        if not 0 <= scan_no < len(self.ms_levels):
+            raise KeyError(scan_no)
+        return SpectrumView(self, scan_no)
+
+    def __iter__(self):
+        return iter(range(len(self.ms_levels)))
+
+    def __len__(self):
+        return len(self.ms_levels)
+
+
+class SpectrumView(object):
+    """
+    A spectrum in FileSpectra, with the attributes of pymzml spectra that are used in ViMMS
+    """
+    __slots__ = ('spectra', 'scan_no')
+
+    def __init__(self, spectra, scan_no):
+        self.spectra = spectra
+        self.scan_no = scan_no
+
+    @property
+    def ms_level(self):
+        return int(self.spectra.ms_levels[self.scan_no])
+
+    @property
+    def scan_time(self):
+        return float(self.spectra.scan_times[self.scan_no]), str(self.spectra.time_units[self.scan_no])
+
+    @property
+    def mz(self):
+        return self.spectra.get_peaks(self.scan_no)[0]
+
+    @property
+    def i(self):
+        return self.spectra.get_peaks(self.scan_no)[1]
+
+    def peaks(self, peak_type):
+        if peak_type != 'raw':
+            raise KeyError(peak_type)  # only the peaks read from the file are stored
+        return np.stack(self.spectra.get_peaks(self.scan_no), axis=-1)
+
+
 class DataSource(object):
     """
     A class to load and extract centroided peaks from CSV and mzML files.
@@ -131,8 +495,8 @@ class DataSource(object):
     """
 
     def __init__(self):
-        # A dictionary that stores the actual pymzml spectra for each filename
-        self.file_spectra = {}  # key: filename, value: a dict where key is scan_number and value is spectrum
+        # A dictionary that stores the spectra for each filename
+        self.file_spectra = {}  # key: filename, value: a FileSpectra object mapping scan_number to spectrum
 
         # A dictionary to store the distribution on scan durations for each ms_level in each file
         self.file_scan_durations = {}  # key: filename, value: a dict with key ms level and value scan durations
@@ -147,29 +511,141 @@ class DataSource(object):
         # xcms peak picking results, if any
         self.df = None
 
-    def load_data(self, mzml_path, file_name=None):
+        # files that could not be loaded by a parallel load_data
+        self.load_errors = {}  # key: filename, value: the formatted exception
+
+    def load_data(self, mzml_path, file_name=None, cache_dir=None, n_jobs=1):
         """
         Loads data and generate peaks from mzML files. The resulting peak objects will not have chromatographic peak
         shapes, because no peak picking has been performed yet.
         :param mzml_path: the input folder containing the mzML files
+        :param file_name: a particular mzML file to load, or None to load all the files in mzml_path
+        :param cache_dir: a directory to cache the data extracted from each file, keyed by the content of the file and
+        the extraction parameters, or None to not use a cache
+        :param n_jobs: the number of worker processes used to extract files in parallel, None for the number of CPUs.
+        With more than one worker, a file that fails to load is skipped and its error is stored in load_errors,
+        instead of stopping the whole load.
         :return: nothing, but the instance variable file_spectra and scan_durations are populated
         """
-        for filename in glob.glob(os.path.join(mzml_path, '*.mzML')):
+        filenames = []
+        for filename in sorted(glob.glob(os.path.join(mzml_path, '*.mzML'))):
             fname = os.path.basename(filename)
             if file_name is not None and fname != file_name:
                 continue
-            logger.info('Loading %s' % fname)
+            filenames.append(filename)
+
+        if n_jobs == 1 or len(filenames) <= 1:
+            for filename in filenames:
+                logger.info('Loading %s' % os.path.basename(filename))
+                if cache_dir is None:
+                    extracted = self.extract_file(filename)
+                else:
+                    extracted = self.extract_file_cached(filename, cache_dir)
+                self._add_extracted(os.path.basename(filename), extracted)
+        else:
+            self._load_parallel(filenames, cache_dir, n_jobs)
+
+    def _load_parallel(self, filenames, cache_dir, n_jobs):
+        max_workers = min(n_jobs if n_jobs is not None else os.cpu_count(), len(filenames))
+        logger.info('Loading %d files with %d workers' % (len(filenames), max_workers))
+        jobs = [{
+            'filename': filename,
+            'cache_dir': cache_dir,
+            'obo_version': self.obo_version,
+            'ms1_precision': self.ms1_precision
+        } for filename in filenames]
+        results = run_jobs(_extract_file_job, jobs, max_workers=max_workers, progress_bar=False)
+
+        # results are in the same order as the files, whatever the order in which the workers finished
+        load_errors = getattr(self, 'load_errors', {})
+        for filename, result in zip(filenames, results):
+            fname = os.path.basename(filename)
+            if result.success:
+                self._add_extracted(fname, result.result)
+                load_errors.pop(fname, None)
+            else:
+                logger.warning('Failed to load %s' % fname)
+                load_errors[fname] = result.error
+        self.load_errors = load_errors
 
-            # TODO: inefficient because we have to parse the mzML file multiple times
-            self.file_spectra[fname] = self.extract_all_scans(filename)
-            self.precursor_info[fname] = self.extract_precursor_info(filename)
-            self.file_scan_durations[fname] = self.extract_scan_durations(filename)
+    def _add_extracted(self, fname, extracted):
+        spectra, precursor_info, scan_durations = extracted
+        self.file_spectra[fname] = spectra
+        self.precursor_info[fname] = precursor_info
+        self.file_scan_durations[fname] = scan_durations
+
+    def extract_file(self, filename):
+        """
+        Extracts the spectra, precursor information and scan durations of an mzML file in a single pass
+        :param filename: the mzML file
+        :return: a tuple of the FileSpectra object, the precursor info dataframe and the scan durations dictionary
+        """
+        ms_levels = []
+        scan_times = []
+        time_units = []
+        offsets = [0]
+        all_mzs = []
+        all_intensities = []
+        precursor_extractor = PrecursorInfoExtractor()
+        transitions = {
+            (1, 1): [],
+            (1, 2): [],
+            (2, 1): [],
+            (2, 2): []
+        }
+        for scan_no, scan in enumerate(self._read_mzml(filename)):
+            ms_level = scan['ms level']
+            scan_time, units = scan.scan_time
+            rt = scan_time * 60.0 if units == 'minute' else scan_time
+            mzs = np.asarray(scan.mz, dtype=np.float64)
+            intensities = np.asarray(scan.i, dtype=np.float64)
+
+            ms_levels.append(ms_level)
+            scan_times.append(scan_time)
+            time_units.append(units)
+            offsets.append(offsets[-1] + len(mzs))
+            all_mzs.append(mzs)
+            all_intensities.append(intensities)
+            precursor_extractor.add_scan(scan_no, ms_level, rt, mzs, intensities, scan.selected_precursors)
+            if scan_no > 0:
+                transitions[(previous_level, ms_level)].append(rt - old_rt)
+            previous_level = ms_level
+            old_rt = rt
+
+        spectra = FileSpectra(np.array(ms_levels, dtype=np.int32), np.array(scan_times, dtype=np.float64),
+                              np.array(time_units), np.array(offsets, dtype=np.int64),
+                              np.concatenate(all_mzs) if len(all_mzs) > 0 else np.empty(0),
+                              np.concatenate(all_intensities) if len(all_intensities) > 0 else np.empty(0))
+        return spectra, precursor_extractor.get_precursor_info(), transitions
+
+    def extract_file_cached(self, filename, cache_dir):
+        """
+        Same as extract_file, but the results are cached in a directory. The cache key is a hash of the content of the
+        file and of the extraction parameters, so the cache is not used if either changes.
+        :param filename: the mzML file
+        :param cache_dir: the cache directory
+        :return: a tuple of the FileSpectra object, the precursor info dataframe and the scan durations dictionary
+        """
+        cache_file = os.path.join(cache_dir, '%s.npz' % self._get_cache_key(filename))
+        if os.path.exists(cache_file):
+            try:
+                extracted = _load_extracted(cache_file)
+                logger.debug('Loaded %s from cache %s' % (filename, cache_file))
+                return extracted
+            except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+                logger.warning('Ignoring invalid cache file %s: %s' % (cache_file, e))
+
+        extracted = self.extract_file(filename)
+        create_if_not_exist(cache_dir)
+        temp_file = '%s.%d.tmp.npz' % (cache_file[:-len('.npz')], os.getpid())
+        _save_extracted(temp_file, *extracted)
+        os.replace(temp_file, cache_file)  # so that other processes never see a partially written cache file
+        logger.debug('Cached %s to %s' % (filename, cache_file))
+        return extracted
 
     def extract_all_scans(self, filename):
         scans = {}
-        run = pymzml.run.Reader(filename, obo_version=self.obo_version,
-                                MS1_Precision=self.ms1_precision,
-                                extraAccessions=[('MS:1000016', ['value', 'unitName'])])
+        run = self._read_mzml(filename)
         for scan_no, scan in enumerate(run):
             scans[scan_no] = scan
         return scans
@@ -185,9 +661,7 @@ class DataSource(object):
             (2, 1): [],
             (2, 2): []
         }
-        run = pymzml.run.Reader(filename, obo_version=self.obo_version,
-                                MS1_Precision=self.ms1_precision,
-                                extraAccessions=[('MS:1000016', ['value', 'unitName'])])
+        run = self._read_mzml(filename)
         for scan_no, scan in enumerate(run):
             if scan_no == 0:
                 previous_level = scan['ms level']
@@ -261,7 +735,7 @@ class DataSource(object):
         axarr[1].plot(peak.rt_values, peak.mz_values, linestyle='None', marker='o', markersize=1.0, color='b')
 
     def get_data(self, data_type, filename, ms_level, min_intensity=None,
-                 min_rt=None, max_rt=None, log=False, max_data=100000):
+                 min_rt=None, max_rt=None, log=False, max_data=100000, rng=None):
         """
         Retrieves values as numpy array
         :param data_type: data_type is 'mz', 'rt', 'intensity' or 'n_peaks'
@@ -271,6 +745,8 @@ class DataSource(object):
         :param min_rt: minimum RT value for thresholding
         :param max_rt: max RT value for thresholding
         :param log: if true, the returned values will be logged
+        :param max_data: the maximum number of values to return, randomly subsampled if there are more
+        :param rng: the random number generator used for subsampling, None to use the global numpy random state
         :return: an Nx1 numpy array of all the values requested
         """
         # if xcms peak picking results are provided, use that instead
@@ -294,41 +770,11 @@ class DataSource(object):
         else:  # else we get the values by reading from the scans in mzML files directly
             logger.info('Using values from scans')
 
-            # get spectra from either one file or all files
-            if filename is None:  # use all spectra
-                all_spectra = []
-                for f in self.file_spectra:
-                    spectra_for_f = list(self.file_spectra[f].values())
-                    all_spectra.extend(spectra_for_f)
-            else:  # use spectra for that file only
-                all_spectra = self.file_spectra[filename].values()
-
-            # loop through spectrum and get all peaks above threshold
-            values = []
-            for spectrum in all_spectra:
-                # if wrong ms level, skip this spectrum
-                if spectrum.ms_level != ms_level:
-                    continue
-
-                # collect all valid Peak objects in a spectrum
-                spectrum_peaks = []
-                for mz, intensity in spectrum.peaks('raw'):
-                    rt = self._get_rt(spectrum)
-                    p = Peak(mz, rt, intensity, spectrum.ms_level)
-                    if self._valid_peak(p, min_intensity, min_rt, max_rt):
-                        spectrum_peaks.append(p)
-
-                if data_type == MZ_INTENSITY_RT:  # used when fitting m/z, rt and intensity together for the manuscript
-                    mzs = list(getattr(x, MZ) for x in spectrum_peaks)
-                    intensities = list(getattr(x, INTENSITY) for x in spectrum_peaks)
-                    rts = list(getattr(x, RT) for x in spectrum_peaks)
-                    values.extend(list(zip(mzs, intensities, rts)))
-
-                else:  # MZ, INTENSITY or RT separately
-                    attrs = list(getattr(x, data_type) for x in spectrum_peaks)
-                    values.extend(attrs)
-
-            X = np.array(values)
+            peaks = self.query_peaks(filename, ms_level, min_intensity=min_intensity, min_rt=min_rt, max_rt=max_rt)
+            if data_type == MZ_INTENSITY_RT:  # used when fitting m/z, rt and intensity together for the manuscript
+                X = np.stack([peaks[MZ], peaks[INTENSITY], peaks[RT]], axis=1)
+            else:  # MZ, INTENSITY or RT separately
+                X = peaks[data_type]
 
         # log-transform if necessary
         if log:
@@ -340,7 +786,7 @@ class DataSource(object):
         # pick random samples
         try:
             idx = np.arange(len(X))
-            rnd_idx = np.random.choice(idx, size=int(max_data), replace=False)
+            rnd_idx = get_rng(rng).choice(idx, size=int(max_data), replace=False)
             sampled_X = X[rnd_idx]
         except ValueError:
             sampled_X = X
@@ -353,39 +799,51 @@ class DataSource(object):
             return sampled_X[:, np.newaxis]
 
     def get_n_peaks(self, filename, ms_level, min_intensity=None, min_rt=None, max_rt=None):
-        # get spectra from either one file or all files
-        if filename is None:  # use all spectra
-            all_spectra = []
-            for f in self.file_spectra:
-                spectra_for_f = list(self.file_spectra[f].values())
-                all_spectra.extend(spectra_for_f)
-        else:  # use spectra for that file only
-            all_spectra = self.file_spectra[filename].values()
-
-        # loop through spectrum and get all peaks above threshold
+        # count the valid peaks of each spectrum, keeping the spectra that have at least one
         values = []
-        for spectrum in all_spectra:
-            # if wrong ms level, skip this spectrum
-            if spectrum.ms_level != ms_level:
-                continue
-
-            # collect all valid Peak objects in a spectrum
-            spectrum_peaks = []
-            for mz, intensity in spectrum.peaks('raw'):
-                rt = self._get_rt(spectrum)
-                p = Peak(mz, rt, intensity, spectrum.ms_level)
-                if self._valid_peak(p, min_intensity, min_rt, max_rt):
-                    spectrum_peaks.append(p)
-
-            # collect the data points we need into a list
-            n_peaks = len(spectrum_peaks)
-            if n_peaks > 0:
-                values.append(n_peaks)
+        for spectra in self._get_file_spectra(filename):
+            keep = spectra.select_peaks(ms_level, min_intensity=min_intensity, min_rt=min_rt, max_rt=max_rt)
+            n_spectra = len(spectra)
+            spectrum_idx = np.repeat(np.arange(n_spectra), np.diff(spectra.offsets))
+            n_peaks = np.bincount(spectrum_idx[keep], minlength=n_spectra)
+            values.append(n_peaks[n_peaks > 0])
 
         # convert into Nx1 array
-        X = np.array(values)
+        X = np.concatenate(values) if len(values) > 0 else np.array([])
         return X[:, np.newaxis]
 
+    def query_peaks(self, filename, ms_level, min_intensity=None, min_rt=None, max_rt=None, min_mz=None,
+                    max_mz=None):
+        """
+        Retrieves the peaks matching some criteria as columns of values
+        :param filename: the mzml filename or None for all files
+        :param ms_level: level 1 or 2
+        :param min_intensity: minimum intensity for thresholding
+        :param min_rt: minimum RT value for thresholding
+        :param max_rt: max RT value for thresholding
+        :param min_mz: minimum m/z value for thresholding
+        :param max_mz: max m/z value for thresholding
+        :return: a dictionary of numpy arrays with keys 'mz', 'rt', 'intensity' and 'log_intensity', with one value per
+        peak, in file and scan order
+        """
+        mzs = []
+        rts = []
+        intensities = []
+        for spectra in self._get_file_spectra(filename):
+            keep = spectra.select_peaks(ms_level, min_intensity=min_intensity, min_rt=min_rt, max_rt=max_rt,
+                                        min_mz=min_mz, max_mz=max_mz)
+            mzs.append(spectra.mzs[keep])
+            rts.append(spectra.get_peak_rts()[keep])
+            intensities.append(spectra.intensities[keep])
+        peaks = {
+            MZ: np.concatenate(mzs) if len(mzs) > 0 else np.array([]),
+            RT: np.concatenate(rts) if len(rts) > 0 else np.array([]),
+            INTENSITY: np.concatenate(intensities) if len(intensities) > 0 else np.array([])
+        }
+        with np.errstate(divide='ignore'):
+            peaks['log_' + INTENSITY] = np.log(peaks[INTENSITY])
+        return peaks
+
     def get_scan_durations(self, fname):
         if fname is None:  # if no filename, then combine all the dictionary keys
             combined = None
@@ -399,21 +857,67 @@ class DataSource(object):
             combined = self.file_scan_durations[fname]
         return combined
 
+    def _get_cache_key(self, filename):
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        params = {
+            'version': EXTRACTED_CACHE_VERSION,
+            'content': sha1.hexdigest(),
+            'obo_version': self.obo_version,
+            'ms1_precision': self.ms1_precision
+        }
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_file_spectra(self, filename):
+        # the spectra of either one file or all files
+        if filename is None:
+            return list(self.file_spectra.values())
+        return [self.file_spectra[filename]]
+
+    def _read_mzml(self, filename):
+        return pymzml.run.Reader(filename, obo_version=self.obo_version,
+                                 MS1_Precision=self.ms1_precision,
+                                 extraAccessions=[('MS:1000016', ['value', 'unitName'])])
+
     def _get_rt(self, spectrum):
         rt, units = spectrum.scan_time
         if units == 'minute':
             rt *= 60.0
         return rt
 
-    def _valid_peak(self, peak, min_intensity, min_rt, max_rt):
-        if min_intensity is not None and peak.intensity < min_intensity:
-            return False
-        elif min_rt is not None and peak.rt < min_rt:
-            return False
-        elif max_rt is not None and peak.rt > max_rt:
-            return False
-        else:
-            return True
+
+# block sizes used by PeakSampler.get_peak to draw peaks within bounds
+MIN_BLOCK_SIZE = 1000
+MAX_BLOCK_SIZE = 1000000
+MIN_ACCEPTANCE_RATE = 1e-3  # so that the block size stays bounded when nothing has been accepted yet
+
+
+class SampleReservoir(object):
+    """
+    Peaks drawn from a density that fall within some bounds and haven't been used yet, with the acceptance rate of
+    the draws so far
+    """
+
+    def __init__(self):
+        self.values = np.empty((0, 3))
+        self.n_drawn = 0
+        self.n_accepted = 0
+
+    def get_acceptance_rate(self):
+        return self.n_accepted / self.n_drawn if self.n_drawn > 0 else 1.0
+
+    def take(self, n):
+        taken = self.values[:n]
+        self.values = self.values[n:]
+        return taken
+
+    def add(self, values):
+        self.values = np.concatenate([self.values, values])
+
+    def __len__(self):
+        return len(self.values)
 
 
 class PeakSampler(object):
@@ -422,7 +926,8 @@ class PeakSampler(object):
     # TODO: add min intensity threshold here so we don't store everything??!!!
     def __init__(self, data_source, min_rt, max_rt, min_ms1_intensity, min_ms2_intensity,
                  filename=None, plot=False,
-                 bandwidth_mz_intensity_rt=1.0, bandwidth_n_peaks=1.0, filename_to_N_DEW=None):
+                 bandwidth_mz_intensity_rt=1.0, bandwidth_n_peaks=1.0, filename_to_N_DEW=None, rng=None,
+                 density=KDE_DENSITY, n_bins=100):
         self.min_rt = min_rt
         self.max_rt = max_rt
         self.min_ms1_intensity = min_ms1_intensity
@@ -430,10 +935,12 @@ class PeakSampler(object):
         self.filename = filename
         self.plot = plot
         self.filename_to_N_DEW = filename_to_N_DEW  # a dictionary that maps from filename to (N, DEW)
+        self.rng = rng  # the default stream to draw from, None to use the global numpy random state
+        self.reservoirs = {}  # key: (bounds, random stream), value: a SampleReservoir of peaks drawn within the bounds
 
-        # get all the scan dataframes across all files and combine them all
-        self.all_ms2_scans = self._extract_ms2_scans(data_source)
-        logger.debug('Extracted %d MS2 scans' % len(self.all_ms2_scans))
+        # get the MS2 scans across all files and combine them in a library
+        self.ms2_library = make_ms2_library(data_source.precursor_info.values())
+        logger.debug('Extracted %d MS2 scans' % len(self.ms2_library))
 
         # compute sum(ms2 peak intensities) / ms1.intensity
         self.intensity_props = self._compute_intensity_props()
@@ -456,6 +963,8 @@ class PeakSampler(object):
         max_data = 100000
         self.kdes = {}
         self.kernel = 'gaussian'
+        self.density = density  # KDE_DENSITY or HISTOGRAM_DENSITY
+        self.n_bins = n_bins  # the number of bins in each dimension for HISTOGRAM_DENSITY
         self._kde(data_source, filename, 1, bandwidth_mz_intensity_rt, bandwidth_n_peaks, max_data)
         try:  # exceptions if data_source only contains fullscan data but we try to train kde on ms level 2
             self._kde(data_source, filename, 2, bandwidth_mz_intensity_rt, bandwidth_n_peaks, max_data)
@@ -468,7 +977,7 @@ class PeakSampler(object):
     # Public methods
     ####################################################################################################################
 
-    def scan_durations(self, previous_level, current_level, n_sample, N, DEW):
+    def scan_durations(self, previous_level, current_level, n_sample, N, DEW, rng=None):
         # the scan durations is stored for each N and DEW combination
         key = (previous_level, current_level,)
         try:
@@ -507,61 +1016,40 @@ class PeakSampler(object):
             return values
         else:  # sample scan durations without replacement
             try:
-                sampled = np.random.choice(values, replace=False, size=n_sample)
+                sampled = self._get_rng(rng).choice(values, replace=False, size=n_sample)
                 return sampled
             except ValueError:
                 return np.array([])
 
-    def get_peak(self, ms_level, N=None, min_mz=None, max_mz=None, min_rt=None, max_rt=None, min_intensity=None):
+    def get_peak(self, ms_level, N=None, min_mz=None, max_mz=None, min_rt=None, max_rt=None, min_intensity=None,
+                 rng=None):
         if N is None:
-            N = max(self.n_peaks(ms_level, 1).astype(int)[0][0], 0)
-
-        peaks = []
-        while len(peaks) < N:
-            vals = self.sample(ms_level, 1)
-            intensity = np.exp(vals[0, 1])
-            mz = vals[0, 0]
-            rt = vals[0, 2]
-            p = Peak(mz, rt, intensity, ms_level)
-            if self._is_valid(p, min_mz, max_mz, min_rt, max_rt, min_intensity):  # othwerise we just keep rejecting
-                peaks.append(p)
-        return peaks
+            N = max(self.n_peaks(ms_level, 1, rng=rng).astype(int)[0][0], 0)
+
+        vals = self._sample_valid(ms_level, N, min_mz, max_mz, min_rt, max_rt, min_intensity, rng)
+        return [Peak(mz, rt, intensity, ms_level) for mz, intensity, rt in vals]
 
-    def sample(self, ms_level, n_sample):
-        vals = self.kdes[(MZ_INTENSITY_RT, ms_level)].sample(n_sample)
+    def sample(self, ms_level, n_sample, rng=None):
+        vals = self.kdes[(MZ_INTENSITY_RT, ms_level)].sample(n_sample, random_state=self._get_random_state(rng))
         return vals
 
-    def n_peaks(self, ms_level, n_sample):
-        return self.kdes[(N_PEAKS, ms_level)].sample(n_sample)
-
-    def get_ms2_spectra(self, N=1):
-        spectra = []
-        total = len(self.all_ms2_scans)
-
-        if total > 0:
-            # select N random spectra
-            idx = np.random.choice(total, replace=False, size=N)
-            samples = self.all_ms2_scans.iloc[idx, :]
-
-            # convert to Scan objects
-            for idx, row in samples.iterrows():
-                # create precursor (MS1) peak
-                parent_ms_level = 1
-                parent_mz = row['ms1_mz']
-                parent_rt = row['ms1_scan_rt']
-                parent_intensity = row['ms1_intensity']
-                parent_peak = Peak(parent_mz, parent_rt, parent_intensity, parent_ms_level)
-
-                # create MS2 scan
-                ms_level = 2
-                ms2_peaks = row['ms2_peaklist']
-                ms2_scan_id = idx
-                ms2_mzs = ms2_peaks[:, 0]
-                ms2_rt = ms2_peaks[0, 1]  # all the values are the same, so we can take the first one
-                ms2_intensities = ms2_peaks[:, 2]  # TODO: filter by min_ms2_intensity here
-                ms2_scan = Scan(ms2_scan_id, ms2_mzs, ms2_intensities, ms_level, ms2_rt, parent=parent_peak)
-                spectra.append(ms2_scan)
-        return spectra
+    def n_peaks(self, ms_level, n_sample, rng=None):
+        return self.kdes[(N_PEAKS, ms_level)].sample(n_sample, random_state=self._get_random_state(rng))
+
+    def get_ms2_spectra(self, N=1, rng=None, min_mz=None, max_mz=None):
+        """
+        Draws MS2 spectra from the library without replacement
+        :param N: the number of spectra, fewer if there aren't as many within the precursor m/z window
+        :param rng: the random number generator, None to use the sampler's stream
+        :param min_mz: the minimum precursor m/z of the spectra, or None
+        :param max_mz: the maximum precursor m/z of the spectra, or None
+        :return: a list of MS2 scans, with their precursor MS1 peak as parent
+        """
+        library = self._get_ms2_library()
+        if len(library) == 0:
+            return []
+        idx = library.sample(N, min_mz=min_mz, max_mz=max_mz, rng=self._get_rng(rng))
+        return library.get_scans(idx)
 
     def get_noise_sample(self):
         # TODO: finish this
@@ -592,35 +1080,93 @@ class PeakSampler(object):
         # variability in noise variance as a function of mz itself, and intensity.
         return mz
 
-    def get_parent_intensity_proportion(self, N=1):
+    def get_parent_intensity_proportion(self, N=1, rng=None):
         # this is the proportion of all fragment intensities in a spectra over the parent intensity
         # returns number between 0 and 1
-        if len(self.all_ms2_scans) > 0:
-            return np.random.choice(self.intensity_props, replace=False, size=N)
+        if len(self._get_ms2_library()) > 0:
+            return self._get_rng(rng).choice(self.intensity_props, replace=False, size=N)
         return None
 
     ####################################################################################################################
-    # Private methods used in the constructor
+    # Rejection sampling
+    ####################################################################################################################
+
+    def _sample_valid(self, ms_level, N, min_mz, max_mz, min_rt, max_rt, min_intensity, rng):
+        # Draws N peaks within the bounds by rejection sampling. Peaks are drawn in blocks sized from the acceptance
+        # rate seen so far for these bounds, and the accepted peaks that are not needed yet are kept in a reservoir
+        # for the next calls with the same bounds and random stream. Peaks drawn from the global numpy random state
+        # are never kept, as it can be re-seeded at any time, so blocks are then only as large as the call needs.
+        keep_values = self._get_rng(rng) is not np.random
+        reservoir = self._get_reservoir((ms_level, min_mz, max_mz, min_rt, max_rt, min_intensity), rng)
+        accepted = [reservoir.take(N)]
+        n_needed = N - len(accepted[0])
+        while n_needed > 0:
+            rate = max(reservoir.get_acceptance_rate(), MIN_ACCEPTANCE_RATE)
+            block_size = math.ceil(1.2 * n_needed / rate)
+            if keep_values:
+                block_size = max(block_size, MIN_BLOCK_SIZE)
+            block_size = int(min(block_size, MAX_BLOCK_SIZE))
+            vals = self.sample(ms_level, block_size, rng=rng)
+            vals = np.stack([vals[:, 0], np.exp(vals[:, 1]), vals[:, 2]], axis=1)
+            valid = vals[self._is_valid(vals, min_mz, max_mz, min_rt, max_rt, min_intensity)]
+            reservoir.n_drawn += block_size
+            reservoir.n_accepted += len(valid)
+            accepted.append(valid[:n_needed])
+            if keep_values:
+                reservoir.add(valid[n_needed:])
+            n_needed -= len(accepted[-1])
+        return np.concatenate(accepted)
+
+    def _get_reservoir(self, bounds, rng):
+        # reservoirs are kept for each random stream, so that runs with their own streams stay reproducible. The
+        # reservoirs of the global numpy random state only keep the acceptance rate of the bounds, and no peaks.
+        reservoirs = self.__dict__.setdefault('reservoirs', {})  # samplers pickled before reservoirs existed
+        key = (bounds, self._get_rng(rng))
+        try:
+            return reservoirs[key]
+        except KeyError:
+            reservoirs[key] = SampleReservoir()
+            return reservoirs[key]
+
+    def __getstate__(self):
+        # reservoirs are only a cache of draws, and they refer to random streams
+        state = self.__dict__.copy()
+        state.pop('reservoirs', None)
+        return state
+
+    ####################################################################################################################
+    # Random number streams
     ####################################################################################################################
 
-    def _extract_ms2_scans(self, data_source):
-        combined_dfs = pd.concat(data_source.precursor_info.values())
-        # select only the column we need
-        # 'ms2_peaklist' is a 2d-array, where each row is an ms2 peak, and columns are mz, rt, intensity
-        col_names = ['ms1_mz', 'ms1_scan_rt', 'ms1_intensity', 'ms2_peaklist']
-        return combined_dfs[col_names]
+    def _get_rng(self, rng):
+        # a stream passed by the caller (e.g. the mass spec) takes precedence over the sampler's own stream.
+        # Samplers pickled before the rng attribute existed fall back to the global numpy random state.
+        if rng is None:
+            rng = getattr(self, 'rng', None)
+        return get_rng(rng)
+
+    def _get_random_state(self, rng):
+        # sklearn only accepts seeds or RandomState objects, so derive a seed from the stream.
+        # None keeps sklearn on the global numpy random state.
+        rng = self._get_rng(rng)
+        if rng is np.random:
+            return None
+        return int(rng.integers(np.iinfo(np.int32).max))
+
+    ####################################################################################################################
+    # Private methods used in the constructor
+    ####################################################################################################################
 
     def _compute_intensity_props(self):
         logger.debug('Computing parent intensity proportions')
-        intensity_props = []
-        for idx, row in self.all_ms2_scans.iterrows():
-            parent_intensity = row['ms1_intensity']
-            ms2_peaks = row['ms2_peaklist']
-            ms2_intensities = ms2_peaks[:, 2]
-            prop = np.sum(ms2_intensities) / parent_intensity
-            if prop <= 1:
-                intensity_props.append(prop)
-        return np.array(intensity_props)
+        props = self.ms2_library.get_total_intensities() / self.ms2_library.precursor_intensities
+        return props[props <= 1]
+
+    def _get_ms2_library(self):
+        # samplers pickled before the MS2 library existed keep their MS2 scans in a dataframe
+        if 'ms2_library' not in self.__dict__:
+            self.ms2_library = make_ms2_library([self.__dict__.pop('all_ms2_scans')])
+        return self.ms2_library
 
     def _kde(self, data_source, filename, ms_level, bandwidth_mz_intensity_rt, bandwidth_n_peaks, max_data):
         logger.debug('Training KDEs for ms_level=%d' % ms_level)
@@ -641,30 +1187,34 @@ class PeakSampler(object):
             else:
                 log = True if data_type == MZ_INTENSITY_RT else False
                 X = data_source.get_data(data_type, filename, ms_level, min_intensity=min_intensity,
-                                         min_rt=self.min_rt, max_rt=self.max_rt, log=log, max_data=max_data)
+                                         min_rt=self.min_rt, max_rt=self.max_rt, log=log, max_data=max_data,
+                                         rng=self.rng)
 
             # fit kde
             bandwidth = param['bandwidth']
-            kde = KernelDensity(kernel=self.kernel, bandwidth=bandwidth).fit(X)
+            if self.density == HISTOGRAM_DENSITY:
+                kde = HistogramDensity(n_bins=self.n_bins, bandwidth=bandwidth).fit(X)
+            else:
+                kde = KernelDensity(kernel=self.kernel, bandwidth=bandwidth).fit(X)
             self.kdes[(data_type, ms_level)] = kde
 
             # plot if necessary
             self._plot(kde, X, data_type, filename, bandwidth)
 
-    def _is_valid(self, peak, min_mz, max_mz, min_rt, max_rt, min_intensity):
-        if peak.intensity < 0:
-            return False
-        if min_mz is not None and min_mz > peak.mz:
-            return False
-        if max_mz is not None and max_mz < peak.mz:
-            return False
-        if min_rt is not None and min_rt > peak.rt:
-            return False
-        if max_rt is not None and max_rt < peak.rt:
-            return False
-        if min_intensity is not None and min_intensity > peak.intensity:
-            return False
-        return True
+    def _is_valid(self, vals, min_mz, max_mz, min_rt, max_rt, min_intensity):
+        # vals has one sampled peak per row, with columns mz, intensity and rt
+        keep = vals[:, 1] >= 0
+        if min_mz is not None:
+            keep &= vals[:, 0] >= min_mz
+        if max_mz is not None:
+            keep &= vals[:, 0] <= max_mz
+        if min_rt is not None:
+            keep &= vals[:, 2] >= min_rt
+        if max_rt is not None:
+            keep &= vals[:, 2] <= max_rt
+        if min_intensity is not None:
+            keep &= vals[:, 1] >= min_intensity
+        return keep
 
     def _plot(self, kde, X, data_type, filename, bandwidth):
         if self.plot:
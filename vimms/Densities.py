@@ -0,0 +1,223 @@
+import numpy as np
+from scipy.special import ndtr, logsumexp
+from sklearn.utils import check_random_state
+
+from vimms.Kernels import build_alias_table
+
+
+# the kinds of densities that can be saved with get_density_arrays
+GAUSSIAN_KDE = 'gaussian_kde'
+HISTOGRAM = 'histogram'
+
+
+class GaussianKernelDensity(object):
+    """
+    A Gaussian kernel density estimator that samples in the same way as sklearn's KernelDensity with a gaussian kernel.
+    A fitted KDE is only its training data and bandwidth, so it can be saved as arrays and loaded back without
+    pickling sklearn objects, and still give the same samples for the same random state.
+    """
+
+    def __init__(self, bandwidth=1.0):
+        """
+        Creates a Gaussian KDE
+        :param bandwidth: the bandwidth of the kernel
+        """
+        self.bandwidth = bandwidth
+
+    def fit(self, X):
+        """
+        Fits the KDE to data
+        :param X: an array of shape (number of points, number of dimensions)
+        :return: self
+        """
+        X = np.asarray(X, dtype=np.float64)
+        self.data = X[:, np.newaxis] if X.ndim == 1 else X
+        return self
+
+    def sample(self, n_samples=1, random_state=None):
+        """
+        Draws samples from the density
+        :param n_samples: the number of samples
+        :param random_state: a seed, a numpy RandomState or None to use the global numpy random state, as for
+        KernelDensity.sample
+        :return: an array of shape (n_samples, number of dimensions)
+        """
+        rng = check_random_state(random_state)
+        u = rng.uniform(0, 1, size=n_samples)
+        i = (u * self.data.shape[0]).astype(np.int64)
+        return np.atleast_2d(rng.normal(self.data[i], self.bandwidth))
+
+    def score_samples(self, X):
+        """
+        Computes the log density at some points
+        :param X: an array of shape (number of points, number of dimensions)
+        :return: the log density at each point
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[:, np.newaxis]
+        n, n_dims = self.data.shape
+        log_norm = np.log(n) + n_dims * np.log(np.sqrt(2 * np.pi) * self.bandwidth)
+        log_density = np.empty(len(X))
+        chunk_size = max(1, 1000000 // self.data.size)
+        for start in range(0, len(X), chunk_size):
+            x = X[start:start + chunk_size, np.newaxis, :]
+            sq_dists = np.sum((x - self.data) ** 2, axis=2)
+            log_density[start:start + chunk_size] = logsumexp(-sq_dists / (2 * self.bandwidth ** 2), axis=1)
+        return log_density - log_norm
+
+
+class HistogramDensity(object):
+    """
+    A binned kernel density estimator, an alternative to sklearn's KernelDensity for PeakSampler.
+    The training data is summarised by the counts of its non-empty histogram cells, so the model is small whatever
+    the size of the training data. Samples are drawn by picking a cell from an alias table (constant time per draw),
+    a uniform position within that cell, and, if a bandwidth is set, Gaussian kernel noise as in a KDE.
+    It has the same fit, sample and score_samples methods as KernelDensity.
+    """
+
+    def __init__(self, n_bins=100, bandwidth=None):
+        """
+        Creates a histogram density
+        :param n_bins: the number of bins in each dimension, either a number or a list with one number per dimension
+        :param bandwidth: the standard deviation of the Gaussian kernel added to samples, None for a plain histogram
+        """
+        self.n_bins = n_bins
+        self.bandwidth = bandwidth
+
+    def fit(self, X):
+        """
+        Fits the histogram to data
+        :param X: an array of shape (number of points, number of dimensions)
+        :return: self
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[:, np.newaxis]
+        if len(X) == 0:
+            raise ValueError('Cannot fit a histogram to an empty array')
+        n_bins = np.broadcast_to(np.asarray(self.n_bins, dtype=np.int64), (X.shape[1],))
+        self.lower = X.min(axis=0)
+        self.widths = (X.max(axis=0) - self.lower) / n_bins  # 0 for dimensions with a single value
+
+        # the cell of each point, the maximum value being in the last bin
+        coords = np.zeros(X.shape, dtype=np.int64)
+        np.floor_divide(X - self.lower, self.widths, out=coords, where=self.widths > 0, casting='unsafe')
+        coords = np.minimum(coords, n_bins - 1)
+        cells, counts = np.unique(coords, axis=0, return_counts=True)
+        self.cells = cells.astype(np.min_scalar_type(n_bins.max() - 1))  # to keep the model small
+        self.counts = counts.astype(np.min_scalar_type(counts.max()))
+        self._build_alias_table()
+        return self
+
+    def sample(self, n_samples=1, random_state=None):
+        """
+        Draws samples from the density
+        :param n_samples: the number of samples
+        :param random_state: a seed, a numpy RandomState or None to use the global numpy random state, as for
+        KernelDensity.sample
+        :return: an array of shape (n_samples, number of dimensions)
+        """
+        rng = check_random_state(random_state)
+        n_cells, n_dims = self.cells.shape
+        idx = rng.randint(n_cells, size=n_samples)
+        keep = rng.uniform(size=n_samples) < self.prob[idx]
+        idx = np.where(keep, idx, self.alias[idx])
+        X = self.lower + (self.cells[idx] + rng.uniform(size=(n_samples, n_dims))) * self.widths
+        if self.bandwidth:
+            X += rng.normal(scale=self.bandwidth, size=(n_samples, n_dims))
+        return X
+
+    def score_samples(self, X):
+        """
+        Computes the log density at some points
+        :param X: an array of shape (number of points, number of dimensions)
+        :return: the log density at each point
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[:, np.newaxis]
+        weights = self.counts / self.counts.sum()
+        cell_lower = self.lower + self.cells * self.widths
+        cell_upper = cell_lower + self.widths
+        density = np.zeros(len(X))
+        chunk_size = max(1, 1000000 // self.cells.size)
+        for start in range(0, len(X), chunk_size):
+            x = X[start:start + chunk_size, np.newaxis, :]
+            kernels = np.empty((len(x), len(self.cells), self.cells.shape[1]))
+            for j, width in enumerate(self.widths):
+                if self.bandwidth and width > 0:  # a uniform distribution on the cell convolved with the kernel
+                    z_lower = (x[:, :, j] - cell_lower[:, j]) / self.bandwidth
+                    z_upper = (x[:, :, j] - cell_upper[:, j]) / self.bandwidth
+                    kernels[:, :, j] = (ndtr(z_lower) - ndtr(z_upper)) / width
+                elif self.bandwidth:  # only the kernel
+                    z = (x[:, :, j] - cell_lower[:, j]) / self.bandwidth
+                    kernels[:, :, j] = np.exp(-z * z / 2) / (np.sqrt(2 * np.pi) * self.bandwidth)
+                elif width > 0:  # only the uniform distribution on the cell
+                    inside = (x[:, :, j] >= cell_lower[:, j]) & (x[:, :, j] < cell_upper[:, j])
+                    kernels[:, :, j] = inside / width
+                else:  # a single value
+                    kernels[:, :, j] = np.where(x[:, :, j] == cell_lower[:, j], np.inf, 0)
+            density[start:start + chunk_size] = np.prod(kernels, axis=2) @ weights
+        with np.errstate(divide='ignore'):
+            return np.log(density)
+
+    def _build_alias_table(self):
+        self.prob, self.alias = build_alias_table(self.counts / self.counts.sum())
+
+    def __getstate__(self):
+        # the alias table is rebuilt from the counts when unpickling, to keep pickles small
+        state = self.__dict__.copy()
+        state.pop('prob', None)
+        state.pop('alias', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'counts' in state:
+            self._build_alias_table()
+
+
+def get_density_arrays(density):
+    """
+    Describes a fitted density as arrays and parameters, so that it can be saved without pickle
+    :param density: a GaussianKernelDensity, a HistogramDensity or a sklearn KernelDensity with a gaussian kernel
+    :return: a tuple of the kind of density, a dictionary of json-compatible parameters and a dictionary of arrays
+    """
+    if isinstance(density, HistogramDensity):
+        n_bins = np.asarray(density.n_bins).tolist()
+        params = {'n_bins': n_bins, 'bandwidth': density.bandwidth}
+        arrays = {'lower': density.lower, 'widths': density.widths, 'cells': density.cells, 'counts': density.counts}
+        return HISTOGRAM, params, arrays
+    elif isinstance(density, GaussianKernelDensity):
+        return GAUSSIAN_KDE, {'bandwidth': float(density.bandwidth)}, {'data': density.data}
+    elif getattr(density, 'kernel', None) == 'gaussian' and hasattr(density, 'tree_'):  # a sklearn KernelDensity
+        if getattr(density.tree_, 'sample_weight', None) is not None:
+            raise ValueError('Weighted kernel densities are not supported')
+        bandwidth = getattr(density, 'bandwidth_', density.bandwidth)  # bandwidth_ exists from sklearn 1.2
+        return GAUSSIAN_KDE, {'bandwidth': float(bandwidth)}, {'data': np.asarray(density.tree_.data)}
+    else:
+        raise ValueError('Unsupported density %s' % density)
+
+
+def make_density(kind, params, arrays):
+    """
+    Creates a fitted density from the output of get_density_arrays
+    :param kind: the kind of density, GAUSSIAN_KDE or HISTOGRAM
+    :param params: the parameters of the density
+    :param arrays: the arrays of the density, e.g. memory-mapped
+    :return: a GaussianKernelDensity or a HistogramDensity object
+    """
+    if kind == GAUSSIAN_KDE:
+        density = GaussianKernelDensity(bandwidth=params['bandwidth'])
+        density.data = arrays['data']
+    elif kind == HISTOGRAM:
+        density = HistogramDensity(n_bins=params['n_bins'], bandwidth=params['bandwidth'])
+        density.lower = arrays['lower']
+        density.widths = arrays['widths']
+        density.cells = arrays['cells']
+        density.counts = arrays['counts']
+        density._build_alias_table()
+    else:
+        raise ValueError('Unknown density %s' % kind)
+    return density
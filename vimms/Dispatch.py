@@ -0,0 +1,114 @@
+from collections import deque
+
+
+class Channel(object):
+    """
+    A FIFO channel used to pass scans and scan parameters between the mass spec, environment and controller.
+    Backed by a deque so both ends are O(1).
+    """
+
+    def __init__(self):
+        """
+        Creates an empty channel
+        """
+        self.items = deque()
+
+    def put(self, item):
+        """
+        Appends an item to the end of the channel
+        :param item: the item to add
+        :return: None
+        """
+        self.items.append(item)
+
+    def extend(self, items):
+        """
+        Appends multiple items to the end of the channel
+        :param items: an iterable of items to add
+        :return: None
+        """
+        self.items.extend(items)
+
+    def get(self):
+        """
+        Removes and returns the item at the front of the channel
+        :return: the oldest item in the channel
+        """
+        return self.items.popleft()
+
+    def peek(self):
+        """
+        Returns the item at the front of the channel without removing it
+        :return: the oldest item in the channel, or None if the channel is empty
+        """
+        return self.items[0] if len(self.items) > 0 else None
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
+    def __repr__(self):
+        return 'Channel len=%d' % len(self.items)
+
+
+class EventDispatcher(object):
+    """
+    Dispatches named events to their registered handlers by calling them directly, in registration order.
+    """
+
+    def __init__(self, event_names):
+        """
+        Creates a dispatcher for a fixed set of event names
+        :param event_names: the names of the events that can be registered and fired
+        """
+        self.handlers = {event_name: [] for event_name in event_names}
+
+    def register(self, event_name, handler):
+        """
+        Registers an event handler
+        :param event_name: the event name
+        :param handler: a callable to be called when the event is fired
+        :return: None
+        """
+        self._get_handlers(event_name).append(handler)
+
+    def fire(self, event_name, arg=None):
+        """
+        Calls all handlers registered to an event
+        :param event_name: the event name
+        :param arg: the event parameter, if any
+        :return: None
+        """
+        handlers = self._get_handlers(event_name)
+        if arg is not None:
+            for handler in handlers:
+                handler(arg)
+        else:
+            for handler in handlers:
+                handler()
+
+    def clear(self, event_name):
+        """
+        Removes all handlers registered to an event
+        :param event_name: the event name
+        :return: None
+        """
+        del self._get_handlers(event_name)[:]
+
+    def clear_all(self):
+        for event_name in self.handlers:
+            self.clear(event_name)
+
+    def _get_handlers(self, event_name):
+        try:
+            return self.handlers[event_name]
+        except KeyError:
+            raise ValueError('Unknown event name')
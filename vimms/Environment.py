@@ -1,17 +1,29 @@
+import asyncio
+import copy
+import os
+import random
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 from loguru import logger
 from tqdm import tqdm
 
-from vimms.Common import DEFAULT_MS1_SCAN_WINDOW, DEFAULT_COLLISION_ENERGY, DEFAULT_ISOLATION_WIDTH
-from vimms.Controller import TopNController, PurityController
-from vimms.MassSpec import ScanParameters, IndependentMassSpectrometer
-from vimms.MzmlWriter import MzmlWriter
+from vimms.Common import DEFAULT_MS1_SCAN_WINDOW, DEFAULT_COLLISION_ENERGY, DEFAULT_ISOLATION_WIDTH, save_obj, \
+    load_obj
+from vimms.Controller import TopNController, PurityController, FixedScheduleController
+from vimms.Dispatch import Channel
+from vimms.MassSpec import ScanParameters, IndependentMassSpectrometer, Scan
+from vimms.MzmlWriter import MzmlWriter, StreamingMzmlWriter, BackgroundMzmlWriter
+from vimms.Parallel import SharedObjectStore, run_jobs, resolve_shared
 
 
 class Environment(object):
-    def __init__(self, mass_spec, controller, min_time, max_time, progress_bar=True, out_dir=None, out_file=None):
+    def __init__(self, mass_spec, controller, min_time, max_time, progress_bar=True, out_dir=None, out_file=None,
+                 trace_recorder=None, checkpoint_file=None, checkpoint_interval=None, stream_mzML=False,
+                 mzml_compression='zlib'):
         """
         Initialises a synchronous environment to run the mass spec and controller
         :param mass_spec: An instance of Mass Spec object
@@ -19,24 +31,43 @@ class Environment(object):
         :param min_time: start time
         :param max_time: end time
         :param progress_bar: True if a progress bar is to be shown
+        :param trace_recorder: An instance of Trace.TraceRecorder to record a per-scan trace, or None to disable tracing
+        :param checkpoint_file: if provided, the state of the run is saved to this file at the end of the run
+        :param checkpoint_interval: if provided together with checkpoint_file, a checkpoint is also saved every
+        checkpoint_interval seconds of simulated time. Each checkpoint stores the whole run so far, so saving them
+        gets slower as the run goes on; use iter_scans(keep_history=False) for long runs that need frequent
+        checkpoints
+        :param stream_mzML: if True, the mzML file is written scan by scan during the run instead of at the end,
+        see MzmlWriter.StreamingMzmlWriter. If 'background', scans are also encoded and written in a background
+        thread, see MzmlWriter.BackgroundMzmlWriter
+        :param mzml_compression: the compression of the binary arrays in the mzML file, one of the keys of
+        MzmlWriter.COMPRESSION_TYPES
         """
-        self.scan_channel = []
-        self.task_channel = []
+        self.scan_channel = Channel()
+        self.task_channel = Channel()
         self.mass_spec = mass_spec
         self.controller = controller
         self.min_time = min_time
         self.max_time = max_time
         self.progress_bar = progress_bar
-        self.default_scan_params = ScanParameters()
-        self.default_scan_params.set(ScanParameters.MS_LEVEL, 1)
-        self.default_scan_params.set(ScanParameters.ISOLATION_WINDOWS, [[DEFAULT_MS1_SCAN_WINDOW]])
-        self.default_scan_params.set(ScanParameters.ISOLATION_WIDTH, DEFAULT_ISOLATION_WIDTH)
-        self.default_scan_params.set(ScanParameters.COLLISION_ENERGY, DEFAULT_COLLISION_ENERGY)
-        self.default_scan_params.set(ScanParameters.POLARITY, self.mass_spec.ionisation_mode)
-        self.default_scan_params.set(ScanParameters.FIRST_MASS, DEFAULT_MS1_SCAN_WINDOW[0])
-        self.default_scan_params.set(ScanParameters.LAST_MASS, DEFAULT_MS1_SCAN_WINDOW[1])
+        default_scan_params = ScanParameters()
+        default_scan_params.set(ScanParameters.MS_LEVEL, 1)
+        default_scan_params.set(ScanParameters.ISOLATION_WINDOWS, [[DEFAULT_MS1_SCAN_WINDOW]])
+        default_scan_params.set(ScanParameters.ISOLATION_WIDTH, DEFAULT_ISOLATION_WIDTH)
+        default_scan_params.set(ScanParameters.COLLISION_ENERGY, DEFAULT_COLLISION_ENERGY)
+        default_scan_params.set(ScanParameters.POLARITY, self.mass_spec.ionisation_mode)
+        default_scan_params.set(ScanParameters.FIRST_MASS, DEFAULT_MS1_SCAN_WINDOW[0])
+        default_scan_params.set(ScanParameters.LAST_MASS, DEFAULT_MS1_SCAN_WINDOW[1])
+        self.default_scan_params = default_scan_params.freeze()  # shared by all the default MS1 scans
         self.out_dir = out_dir
         self.out_file = out_file
+        self.trace_recorder = trace_recorder
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.next_checkpoint_time = None
+        self.stream_mzML = stream_mzML
+        self.mzml_compression = mzml_compression
+        self.mzml_writer = None  # the StreamingMzmlWriter of the current run, if streaming
 
     def run(self):
         """
@@ -49,6 +80,127 @@ class Environment(object):
         self._set_initial_values()
 
         # register event handlers from the controller
+        self._register_event_handlers()
+
+        # run mass spec
+        self._open_mzml_stream()
+        self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING)
+        self._run_loop()
+
+    def iter_scans(self, keep_history=False):
+        """
+        Runs the mass spec and controller as a generator that yields each scan as soon as it's been produced and
+        handled by the controller. The next scan is only generated when the consumer asks for it, and the run can be
+        stopped early by breaking out of the loop or calling close() on the generator.
+        :param keep_history: if False, scans are not kept in the controller or mass spec once they've been yielded,
+        so that arbitrarily long runs use constant memory. If True, the run is stored as in run() and the mzML file
+        is written at the end if out_file is set.
+        When stream_mzML is set, the mzML file is written as the scans are produced, with or without history.
+        :return: a generator of scans
+        """
+        self.mass_spec.reset()
+        self.controller.reset()
+        self._set_initial_values()
+        self._register_event_handlers()
+        self._open_mzml_stream()
+        self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING)
+
+        writer = self.mzml_writer
+        bar = tqdm(total=self.max_time - self.min_time, initial=self.mass_spec.time - self.min_time) \
+            if self.progress_bar else None
+        try:
+            while self.mass_spec.time < self.max_time:
+                scan = self.mass_spec.step()
+                self.controller.update_state_after_scan(scan)
+                if writer is not None:
+                    writer.write_scan(scan)
+                self._update_progress_bar(bar, scan)
+                self._save_periodic_checkpoint()
+                if not keep_history:
+                    self._clear_history()
+                yield scan
+        finally:
+            self.mass_spec.close()
+            self.close_progress_bar(bar)
+            self.close_trace_recorder()
+            self._close_mzml_stream()
+        if keep_history and writer is None:
+            self.write_mzML(self.out_dir, self.out_file)
+
+    def resume(self):
+        """
+        Continues a run loaded by load_checkpoint() until max_time. Since the random number generator states are
+        restored with the checkpoint, the result is the same as if the run had never been interrupted.
+        Streamed mzML files can't be continued, so the mzML file of a resumed run is written at the end.
+        :return: None
+        """
+        self._register_event_handlers()
+        self._run_loop()
+
+    def save_checkpoint(self, filename):
+        """
+        Saves the state of the environment, mass spec, controller and random number generators to a file.
+        The file is replaced atomically, so an interruption while saving leaves the previous checkpoint intact.
+        The scans and fragmentation events produced so far are part of the state, even if they've already been
+        streamed to the mzML file, since a resumed run writes its mzML file from them. The checkpoint therefore grows
+        with the length of the run, and saving one every checkpoint_interval costs O(n^2) over a run of n scans
+        unless the history is discarded as in iter_scans(keep_history=False).
+        :param filename: the checkpoint file
+        :return: None
+        """
+        state = {
+            'environment': self,
+            'np_random_state': np.random.get_state(),
+            'random_state': random.getstate()
+        }
+        tmp_filename = '%s.tmp' % filename
+        save_obj(state, tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def load_checkpoint(filename):
+        """
+        Loads an environment saved by save_checkpoint() and restores the random number generator states.
+        Call resume() on the result to continue the run, or warm_start() to continue it with another controller.
+        :param filename: the checkpoint file
+        :return: the loaded environment
+        """
+        state = load_obj(filename)
+        np.random.set_state(state['np_random_state'])
+        random.setstate(state['random_state'])
+        return state['environment']
+
+    def warm_start(self, controller, max_time=None, out_dir=None, out_file=None, checkpoint_file=None):
+        """
+        Hands over an environment loaded from a checkpoint to a different controller, so that many controller
+        variants can branch from one simulated prefix instead of simulating it again.
+        The scans in the prefix are kept in the new controller, and scans already queued on the mass spec by the
+        previous controller are still acquired.
+        :param controller: the controller that takes over from the checkpoint
+        :param max_time: the new end time, if different
+        :param out_dir: the output directory for the new mzML file
+        :param out_file: the output filename for the new mzML file
+        :param checkpoint_file: the checkpoint file for the new run, if any
+        :return: this environment, ready for resume()
+        """
+        previous = self.controller
+        controller.reset()
+        controller.scans = previous.scans
+        if hasattr(previous, 'precursor_information') and hasattr(controller, 'precursor_information'):
+            controller.precursor_information = previous.precursor_information
+        controller.set_environment(self)
+        self.controller = controller
+
+        if max_time is not None:
+            self.max_time = max_time
+        self.out_dir = out_dir
+        self.out_file = out_file
+        self.checkpoint_file = checkpoint_file
+        self.next_checkpoint_time = self._get_next_checkpoint_time()
+        return self
+
+    def _register_event_handlers(self):
+        self.mass_spec.clear_events()
         self.mass_spec.register_event(IndependentMassSpectrometer.MS_SCAN_ARRIVED, self.add_scan)
         self.mass_spec.register_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING,
                                       self.controller.handle_acquisition_open)
@@ -57,9 +209,14 @@ class Environment(object):
         self.mass_spec.register_event(IndependentMassSpectrometer.STATE_CHANGED,
                                       self.controller.handle_state_changed)
 
-        # run mass spec
-        bar = tqdm(total=self.max_time - self.min_time, initial=0) if self.progress_bar else None
-        self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING)
+    def _run_loop(self):
+        """
+        Steps the mass spec until max_time, saving checkpoints along the way if enabled
+        :return: None
+        """
+        writer = getattr(self, 'mzml_writer', None)
+        bar = tqdm(total=self.max_time - self.min_time, initial=self.mass_spec.time - self.min_time) \
+            if self.progress_bar else None
         try:
             # perform one step of mass spec up to max_time
             while self.mass_spec.time < self.max_time:
@@ -67,14 +224,45 @@ class Environment(object):
                 scan = self.mass_spec.step()
                 # update controller internal states AFTER a scan has been generated and handled
                 self.controller.update_state_after_scan(scan)
+                # write the scan now if the mzML file is streamed
+                if writer is not None:
+                    writer.write_scan(scan)
                 # increment progress bar
                 self._update_progress_bar(bar, scan)
-        except Exception as e:
-            raise e
+                # save a checkpoint if it's time to
+                self._save_periodic_checkpoint()
+
+            # also save the final state, e.g. as a prefix for warm_start()
+            if self.checkpoint_file is not None:
+                self.save_checkpoint(self.checkpoint_file)
         finally:
             self.mass_spec.close()
             self.close_progress_bar(bar)
-        self.write_mzML(self.out_dir, self.out_file)
+            self.close_trace_recorder()
+            # an interrupted run still leaves a valid mzML file with the scans produced so far
+            self._close_mzml_stream()
+        if writer is None:
+            self.write_mzML(self.out_dir, self.out_file)
+
+    def _clear_history(self):
+        """
+        Discards the scans and fragmentation events stored so far. Controllers keep their exclusion and ROI states.
+        :return: None
+        """
+        self.controller.scans.clear()
+        if hasattr(self.controller, 'precursor_information'):
+            self.controller.precursor_information.clear()
+        self.mass_spec.fragmentation_events = []
+
+    def _save_periodic_checkpoint(self):
+        if self.next_checkpoint_time is not None and self.mass_spec.time >= self.next_checkpoint_time:
+            self.save_checkpoint(self.checkpoint_file)
+            self.next_checkpoint_time += self.checkpoint_interval
+
+    def _get_next_checkpoint_time(self):
+        if self.checkpoint_file is None or self.checkpoint_interval is None:
+            return None
+        return self.mass_spec.time + self.checkpoint_interval
 
     def _update_progress_bar(self, pbar, scan):
         """
@@ -102,16 +290,36 @@ class Environment(object):
                 logger.warning('Failed to close progress bar: %s' % str(e))
                 pass
 
+    def close_trace_recorder(self):
+        if self.trace_recorder is not None:
+            self.trace_recorder.close()
+
     def add_scan(self, scan):
         """
         Adds a newly generated scan. In this case, immediately we process it in the controller without saving the scan.
         :param scan: A newly generated scan
         :return: None
         """
-        self.scan_channel.append(scan)
-        scan = self.scan_channel.pop(0)
+        self.scan_channel.put(scan)
+        scan_channel_size = len(self.scan_channel)
+        self._handle_scan(self.scan_channel.get(), scan_channel_size)
+
+    def _handle_scan(self, scan, scan_channel_size=1):
+        """
+        Passes a scan to the controller and pushes the resulting tasks to the mass spec
+        :param scan: the scan to handle
+        :param scan_channel_size: the number of scans waiting when this one was taken, including itself, for the trace
+        :return: None
+        """
         queue_size = len(self.mass_spec.get_processing_queue())
-        tasks = self.controller.handle_scan(scan, queue_size)
+        if self.trace_recorder is None:
+            tasks = self.controller.handle_scan(scan, queue_size)
+        else:
+            start = time.perf_counter()
+            tasks = self.controller.handle_scan(scan, queue_size)
+            latency = time.perf_counter() - start
+            self.trace_recorder.record(scan.scan_id, scan.rt, scan.ms_level, scan_channel_size, len(tasks),
+                                       queue_size, latency)
         self.add_tasks(tasks)
 
     def add_tasks(self, scan_params):
@@ -122,7 +330,7 @@ class Environment(object):
         """
         self.task_channel.extend(scan_params)
         while len(self.task_channel) > 0:
-            new_task = self.task_channel.pop(0)
+            new_task = self.task_channel.get()
             self.mass_spec.add_to_processing_queue(new_task)
 
     def write_mzML(self, out_dir, out_file):
@@ -132,23 +340,61 @@ class Environment(object):
         :param out_file: output filename
         :return: None
         """
-        if out_file is None:  # if no filename provided, just quits
+        mzml_filename = self._get_mzml_filename(out_dir, out_file)
+        if mzml_filename is None:  # if no filename provided, just quits
             return
-        else:
-            if out_dir is None:  # no out_dir, use only out_file
-                mzml_filename = Path(out_file)
-            else:  # both our_dir and out_file are provided
-                mzml_filename = Path(out_dir, out_file)
 
         logger.debug('Writing mzML file to %s' % mzml_filename)
         try:
             precursor_information = self.controller.precursor_information
         except AttributeError:
             precursor_information = None
-        writer = MzmlWriter('my_analysis', self.controller.scans, precursor_information)
+        writer = MzmlWriter('my_analysis', self.controller.scans, precursor_information,
+                            compression=getattr(self, 'mzml_compression', 'zlib'))
         writer.write_mzML(mzml_filename)
         logger.debug('mzML file successfully written!')
 
+    def _get_mzml_filename(self, out_dir, out_file):
+        if out_file is None:
+            return None
+        elif out_dir is None:  # no out_dir, use only out_file
+            return Path(out_file)
+        else:  # both our_dir and out_file are provided
+            return Path(out_dir, out_file)
+
+    def _open_mzml_stream(self):
+        """
+        Starts streaming the mzML file if enabled
+        :return: None
+        """
+        mzml_filename = self._get_mzml_filename(self.out_dir, self.out_file)
+        if self.stream_mzML and mzml_filename is not None:
+            logger.debug('Streaming mzML file to %s' % mzml_filename)
+            if self.stream_mzML == 'background':
+                self.mzml_writer = BackgroundMzmlWriter('my_analysis', mzml_filename,
+                                                        compression=self.mzml_compression)
+            else:
+                self.mzml_writer = StreamingMzmlWriter('my_analysis', mzml_filename,
+                                                       compression=self.mzml_compression)
+            self.mzml_writer.open()
+
+    def _close_mzml_stream(self):
+        """
+        Finishes the streamed mzML file, if any
+        :return: None
+        """
+        writer = getattr(self, 'mzml_writer', None)
+        if writer is not None:
+            self.mzml_writer = None
+            writer.close()
+            logger.debug('mzML file successfully written!')
+
+    def __getstate__(self):
+        # the streamed mzML file can't be stored in checkpoints
+        state = self.__dict__.copy()
+        state['mzml_writer'] = None
+        return state
+
     def _set_initial_values(self):
         """
         Sets initial environment, mass spec start time, default scan parameters and other values
@@ -157,6 +403,7 @@ class Environment(object):
         self.controller.set_environment(self)
         self.mass_spec.set_environment(self)
         self.mass_spec.time = self.min_time
+        self.next_checkpoint_time = self._get_next_checkpoint_time()
 
         N, DEW = self._get_N_DEW(self.mass_spec.time)
         if N is not None:
@@ -185,10 +432,140 @@ class Environment(object):
             return None, None
 
 
+class ShardedEnvironment(Environment):
+    """
+    Runs a FixedScheduleController by splitting the retention time axis into shards whose scans are generated in
+    parallel worker processes. The scan timings are computed serially first, drawing scan durations exactly as a
+    serial run would, so the merged result is identical to running the same controller in Environment.
+    This requires scan generation itself to be deterministic, which is the case for the current noise model.
+    """
+
+    def __init__(self, mass_spec, controller, min_time, max_time, progress_bar=True, out_dir=None, out_file=None,
+                 n_shards=None, max_workers=None):
+        """
+        Initialises a sharded environment.
+        Parameters are the same as in Environment, with the addition of:
+        :param n_shards: the number of chunks to split the run into, defaults to four per worker
+        :param max_workers: the maximum number of worker processes, defaults to the number of CPUs
+        """
+        super().__init__(mass_spec, controller, min_time, max_time, progress_bar=progress_bar, out_dir=out_dir,
+                         out_file=out_file)
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.n_shards = n_shards if n_shards is not None else 4 * self.max_workers
+
+    def run(self):
+        """
+        Runs the mass spec and controller
+        :return: None
+        """
+        if not isinstance(self.controller, FixedScheduleController):
+            raise ValueError('Sharded runs need a FixedScheduleController')
+
+        # reset mass spec and set some initial values for each run
+        self.mass_spec.reset()
+        self.controller.reset()
+        self._set_initial_values()
+        self._register_event_handlers()
+
+        self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING)
+        try:
+            placeholders = self._compute_timings()
+            scans, fragmentation_events = self._generate_scans(placeholders)
+        finally:
+            self.mass_spec.close()
+
+        # replace the placeholder scans seen by the controller with the generated ones
+        self.controller.scans = defaultdict(list)
+        for placeholder, scan in zip(placeholders, scans):
+            scan.scan_duration = placeholder.scan_duration
+            scan.scan_params = placeholder.scan_params
+            self.controller.scans[scan.ms_level].append(scan)
+        self.mass_spec.fragmentation_events = fragmentation_events
+        self.write_mzML(self.out_dir, self.out_file)
+
+    def _compute_timings(self):
+        """
+        Runs the controller against empty placeholder scans to find the time and parameters of every scan
+        :return: the list of placeholder scans, in acquisition order
+        """
+        placeholders = []
+        while self.mass_spec.time < self.max_time:
+            params = self.mass_spec._get_params()
+            scan = Scan(self.mass_spec.idx, np.array([]), np.array([]), params.get(ScanParameters.MS_LEVEL),
+                        self.mass_spec.time, scan_params=params)
+            self._handle_scan(scan)
+            self.mass_spec.complete_scan(scan)
+            self.controller.update_state_after_scan(scan)
+            placeholders.append(scan)
+        return placeholders
+
+    def _generate_scans(self, placeholders):
+        """
+        Generates the actual scans in worker processes, one job per shard
+        :param placeholders: the placeholder scans returned by _compute_timings()
+        :return: a tuple of the generated scans and their fragmentation events, in acquisition order
+        """
+        with SharedObjectStore() as store:
+            ref = store.publish(self._get_scan_generator())
+            entries = [(scan.scan_id, scan.rt, scan.scan_params) for scan in placeholders]
+            jobs = [{'mass_spec': ref, 'entries': [entries[i] for i in shard]}
+                    for shard in np.array_split(np.arange(len(entries)), self.n_shards) if len(shard) > 0]
+            results = run_jobs(_generate_shard, jobs, max_workers=self.max_workers, progress_bar=self.progress_bar,
+                               desc='Generating scans')
+
+        scans = []
+        fragmentation_events = []
+        for job_result in results:
+            if not job_result.success:
+                raise RuntimeError('Failed to generate scans:\n%s' % job_result.error)
+            shard_scans, shard_events = job_result.result
+            scans.extend(shard_scans)
+            for chem_idx, frag in shard_events:
+                frag.chem = self.mass_spec.chemicals[chem_idx]
+                fragmentation_events.append(frag)
+        return scans, fragmentation_events
+
+    def _get_scan_generator(self):
+        """
+        Returns a copy of the mass spec that can be sent to the workers, without the environment and event handlers
+        :return: the copied mass spec
+        """
+        generator = copy.copy(self.mass_spec)
+        generator.environment = None
+        generator.dispatcher = None
+        generator.processing_queue = Channel()
+        generator.fragmentation_events = []
+        return generator
+
+
+def _generate_shard(job):
+    """
+    Generates the scans of one shard in a worker process
+    :param job: a dictionary with the published mass spec and the (scan_id, rt, scan_params) of each scan
+    :return: a tuple of the generated scans and (chemical index, fragmentation event) pairs
+    """
+    mass_spec = resolve_shared(job['mass_spec'])
+    mass_spec.fragmentation_events = []
+    scans = []
+    for scan_id, scan_time, params in job['entries']:
+        mass_spec.idx = scan_id
+        scans.append(mass_spec._get_scan(scan_time, params))
+
+    # send chemical indices back instead of copies of the chemicals
+    chem_indices = {id(chem): i for i, chem in enumerate(mass_spec.chemicals)}
+    events = []
+    for frag in mass_spec.fragmentation_events:
+        chem_idx = chem_indices[id(frag.chem)]
+        frag.chem = None
+        events.append((chem_idx, frag))
+    return scans, events
+
+
 class IAPIEnvironment(Environment):
 
-    def __init__(self, mass_spec, controller, max_time, progress_bar=True, out_dir=None, out_file=None):
-        super().__init__(mass_spec, controller, 0, max_time, progress_bar, out_dir, out_file)
+    def __init__(self, mass_spec, controller, max_time, progress_bar=True, out_dir=None, out_file=None,
+                 trace_recorder=None):
+        super().__init__(mass_spec, controller, 0, max_time, progress_bar, out_dir, out_file, trace_recorder)
         self.start_time = None
         self.stop_time = None
         self.last_time = None
@@ -208,13 +585,7 @@ class IAPIEnvironment(Environment):
         self.stop_time = self.start_time + self.max_time
 
         # register event handlers from the controller
-        self.mass_spec.register_event(IndependentMassSpectrometer.MS_SCAN_ARRIVED, self.add_scan)
-        self.mass_spec.register_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING,
-                                      self.controller.handle_acquisition_open)
-        self.mass_spec.register_event(IndependentMassSpectrometer.ACQUISITION_STREAM_CLOSING,
-                                      self.controller.handle_acquisition_closing)
-        self.mass_spec.register_event(IndependentMassSpectrometer.STATE_CHANGED,
-                                      self.controller.handle_state_changed)
+        self._register_event_handlers()
 
         self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING)
         self.mass_spec.run()
@@ -224,14 +595,14 @@ class IAPIEnvironment(Environment):
         if time.time() > self.stop_time:
             self.mass_spec.close()
             self.close_progress_bar(self.pbar)
+            self.close_trace_recorder()
             self.write_mzML(self.out_dir, self.out_file)
         else:
-            # handle the scan immediately by passing it to the controller
-            self.scan_channel.append(scan)
-            scan = self.scan_channel.pop(0)
-            queue_size = len(self.mass_spec.get_processing_queue())
-            tasks = self.controller.handle_scan(scan, queue_size)
-            self.add_tasks(tasks)  # push new tasks to mass spec queue
+            # handle the scan immediately by passing it to the controller, and push new tasks to mass spec queue
+            self.scan_channel.put(scan)
+            scan_channel_size = len(self.scan_channel)
+            scan = self.scan_channel.get()
+            self._handle_scan(scan, scan_channel_size)
 
             # update controller internal states AFTER a scan has been generated and handled
             self.controller.update_state_after_scan(scan)
@@ -255,3 +626,190 @@ class IAPIEnvironment(Environment):
                 msg = '(%.3fs) ms_level=%d' % (self.mass_spec.time, scan.ms_level)
             pbar.update(elapsed)
             pbar.set_description(msg)
+
+
+class AsyncEnvironment(Environment):
+    """
+    An asyncio-based environment. The mass spec produces scans into an async queue that is consumed by a controller
+    coroutine, while sinks (see vimms.Sinks) consume the finished scans concurrently in worker threads, so writing
+    outputs or serving live metrics doesn't stall the simulation. Slow sinks apply back-pressure through their
+    bounded queues. The same controller classes work here and in Environment, and produce the same scans.
+    """
+
+    def __init__(self, mass_spec, controller, min_time, max_time, progress_bar=True, out_dir=None, out_file=None,
+                 trace_recorder=None, checkpoint_file=None, checkpoint_interval=None, sinks=None,
+                 sink_queue_size=100):
+        """
+        Initialises an asynchronous environment to run the mass spec and controller.
+        Parameters are the same as in Environment, with the addition of:
+        :param sinks: a list of ScanSink objects to receive the scans as they are produced
+        :param sink_queue_size: the maximum number of scans waiting to be handled by each sink
+        """
+        super().__init__(mass_spec, controller, min_time, max_time, progress_bar=progress_bar, out_dir=out_dir,
+                         out_file=out_file, trace_recorder=trace_recorder, checkpoint_file=checkpoint_file,
+                         checkpoint_interval=checkpoint_interval)
+        self.sinks = [] if sinks is None else sinks
+        self.sink_queue_size = sink_queue_size
+
+    def run(self):
+        """
+        Runs the mass spec and controller in a new event loop.
+        Use 'await env.run_async()' instead when an event loop is already running, e.g. in a Jupyter notebook.
+        :return: None
+        """
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        """
+        Runs the mass spec and controller as coroutines in the current event loop
+        :return: None
+        """
+        # reset mass spec and set some initial values for each run
+        self.mass_spec.reset()
+        self.controller.reset()
+        self._set_initial_values()
+
+        # register event handlers from the controller
+        self._register_event_handlers()
+
+        self.mass_spec.fire_event(IndependentMassSpectrometer.ACQUISITION_STREAM_OPENING)
+        await self._run_loop_async()
+
+    def resume(self):
+        """
+        Continues a run loaded by load_checkpoint() until max_time, in a new event loop.
+        Sinks are not stored in checkpoints, so they need to be set again before resuming.
+        :return: None
+        """
+        self._register_event_handlers()
+        asyncio.run(self._run_loop_async())
+
+    async def _run_loop_async(self):
+        """
+        Produces scans until max_time, handing each one to the controller coroutine and then to the sinks
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=len(self.sinks) + 1)
+        scan_queue = asyncio.Queue(maxsize=1)
+        sink_queues = [asyncio.Queue(maxsize=self.sink_queue_size) for _ in self.sinks]
+        open_sinks = []  # the sinks to close, also when the run fails
+        controller_task = None
+        sink_tasks = []
+        bar = None
+        try:
+            for sink in self.sinks:
+                sink.open(self)
+                open_sinks.append(sink)
+            controller_task = asyncio.ensure_future(self._controller_worker(scan_queue))
+            sink_tasks = [asyncio.ensure_future(self._sink_worker(loop, executor, sink, queue))
+                          for sink, queue in zip(self.sinks, sink_queues)]
+            bar = tqdm(total=self.max_time - self.min_time, initial=self.mass_spec.time - self.min_time) \
+                if self.progress_bar else None
+
+            while self.mass_spec.time < self.max_time:
+                # generate a scan and wait until the controller coroutine has handled it
+                scan = self.mass_spec.generate_scan()
+                await scan_queue.put(scan)
+                await scan_queue.join()
+                self._check_tasks([controller_task] + sink_tasks)
+
+                # the scan duration depends on the tasks pushed by the controller
+                self.mass_spec.complete_scan(scan)
+                self.controller.update_state_after_scan(scan)
+                self._update_progress_bar(bar, scan)
+                self._save_periodic_checkpoint()
+
+                # pass the finished scan to the sinks, waiting if any of them is falling behind
+                for queue, sink_task in zip(sink_queues, sink_tasks):
+                    await self._put_to_sink(queue, scan, sink_task)
+
+            if self.checkpoint_file is not None:
+                self.save_checkpoint(self.checkpoint_file)
+
+            # signal the end of the run and wait for all sinks to catch up
+            await scan_queue.put(None)
+            for queue, sink_task in zip(sink_queues, sink_tasks):
+                await self._put_to_sink(queue, None, sink_task)
+            await asyncio.gather(controller_task, *sink_tasks)
+            while len(open_sinks) > 0:
+                await loop.run_in_executor(executor, open_sinks.pop(0).close)
+        finally:
+            for task in [controller_task] + sink_tasks:
+                if task is not None:
+                    task.cancel()
+            self.mass_spec.close()
+            self.close_progress_bar(bar)
+            await loop.run_in_executor(executor, self.close_trace_recorder)
+            executor.shutdown(wait=True)  # also waits for sinks still handling a scan, before they are closed
+
+            # the run has failed if any sinks are still open, so closing errors mustn't hide the original one
+            for sink in open_sinks:
+                try:
+                    await loop.run_in_executor(None, sink.close)
+                except Exception as e:
+                    logger.warning('Failed to close sink %s: %s' % (sink, str(e)))
+        await loop.run_in_executor(None, self.write_mzML, self.out_dir, self.out_file)
+
+    async def _controller_worker(self, scan_queue):
+        """
+        Passes scans from the queue to the controller until the end of the run is signalled
+        :param scan_queue: the queue of newly generated scans
+        :return: None
+        """
+        while True:
+            scan_channel_size = scan_queue.qsize()
+            scan = await scan_queue.get()
+            try:
+                if scan is None:
+                    return
+                self._handle_scan(scan, max(scan_channel_size, 1))
+            finally:
+                scan_queue.task_done()
+
+    async def _sink_worker(self, loop, executor, sink, queue):
+        """
+        Passes scans from the queue to a sink, running the sink in a worker thread
+        :param loop: the running event loop
+        :param executor: the executor to run the sink in
+        :param sink: the sink
+        :param queue: the queue of finished scans for this sink
+        :return: None
+        """
+        while True:
+            scan = await queue.get()
+            if scan is None:
+                return
+            await loop.run_in_executor(executor, sink.handle_scan, scan)
+
+    async def _put_to_sink(self, queue, item, sink_task):
+        """
+        Puts an item on a sink queue, waiting for space unless the sink fails first, in which case its exception is
+        re-raised instead of waiting forever on a full queue
+        :param queue: the queue of the sink
+        :param item: a scan, or None to signal the end of the run
+        :param sink_task: the worker task of the sink
+        :return: None
+        """
+        put = asyncio.ensure_future(queue.put(item))
+        done, _ = await asyncio.wait({put, sink_task}, return_when=asyncio.FIRST_COMPLETED)
+        if put not in done:
+            put.cancel()
+            sink_task.result()
+            raise RuntimeError('Sink worker stopped before the end of the run')
+
+    def _check_tasks(self, tasks):
+        """
+        Re-raises the exception of any worker that has failed, so the run stops instead of waiting forever
+        :param tasks: the worker tasks
+        :return: None
+        """
+        for task in tasks:
+            if task.done():
+                task.result()
+
+    def __getstate__(self):
+        # sinks may hold open files or callbacks, so they are not included in checkpoints
+        state = super().__getstate__()
+        state['sinks'] = []
+        return state
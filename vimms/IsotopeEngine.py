@@ -0,0 +1,219 @@
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+# the stable isotopes of each element as (mass, natural abundance, nominal mass shift from the lightest isotope)
+ISOTOPE_TABLE = {
+    'C': [(12.0, 0.9893, 0), (13.00335483507, 0.0107, 1)],
+    'H': [(1.00782503223, 0.999885, 0), (2.01410177812, 0.000115, 1)],
+    'N': [(14.00307400443, 0.99636, 0), (15.00010889888, 0.00364, 1)],
+    'O': [(15.99491461957, 0.99757, 0), (16.99913175650, 0.00038, 1), (17.99915961286, 0.00205, 2)],
+    'P': [(30.97376199842, 1.0, 0)],
+    'S': [(31.9720711744, 0.9499, 0), (32.9714589098, 0.0075, 1), (33.967867004, 0.0425, 2),
+          (35.96708071, 0.0001, 4)],
+    'Cl': [(34.968852682, 0.7576, 0), (36.965902602, 0.2424, 2)],
+    'I': [(126.9044719, 1.0, 0)],
+    'Br': [(78.9183376, 0.5069, 0), (80.9162897, 0.4931, 2)],
+    'Si': [(27.97692653465, 0.92223, 0), (28.9764946649, 0.04685, 1), (29.973770136, 0.03092, 2)],
+    'F': [(18.99840316273, 1.0, 0)],
+    'D': [(2.01410177812, 1.0, 0)]  # deuterium labels
+}
+
+ISOTOPE_CACHE_SIZE = 1 << 16  # the number of envelopes kept by an IsotopeEngine
+MIN_FFT_LENGTH = 8
+FFT_CHUNK_SIZE = 10000  # the number of formulas transformed at once
+
+
+class IsotopeEngine(object):
+    """
+    Computes the isotope envelopes of formulas from the isotopes of all their elements, and caches them by formula.
+    Aggregated envelopes have one peak per nominal mass, at the abundance-weighted mean mass of the isotopologues
+    with that nominal mass. They are computed for many formulas at once by FFT: the envelope of a formula is the
+    product of the element polynomials raised to the atom counts, which for a whole batch is a single matrix product
+    of the counts with the logarithms of the transformed polynomials.
+    Fine envelopes keep the isotopologues of the same nominal mass apart, e.g. 13C and 15N, and are computed by
+    convolving sparse element distributions, dropping isotopologues less abundant than `min_abundance`.
+    """
+
+    def __init__(self, elements, fine=False, min_abundance=1e-6, resolution=1e-4, cache_size=ISOTOPE_CACHE_SIZE):
+        """
+        Creates an isotope engine
+        :param elements: the element of each column of the atom counts, e.g. Chemicals.ELEMENTS
+        :param fine: whether to compute fine envelopes rather than aggregated ones
+        :param min_abundance: isotopologues less abundant than this are dropped
+        :param resolution: the mass difference below which fine isotopologues are merged
+        :param cache_size: the number of envelopes to keep
+        """
+        unknown = [element for element in elements if element not in ISOTOPE_TABLE]
+        if len(unknown) > 0:
+            raise ValueError('No isotopes for elements %s' % unknown)
+        self.elements = list(elements)
+        self.fine = fine
+        self.min_abundance = min_abundance
+        self.resolution = resolution
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        # the distribution of the nominal mass shift of one atom of each element
+        self.max_shift = max(shift for element in self.elements for _, _, shift in ISOTOPE_TABLE[element])
+        self.shift_probs = np.zeros((len(self.elements), self.max_shift + 1))
+        self.shift_masses = np.zeros((len(self.elements), self.max_shift + 1))  # abundance-weighted mass shifts
+        for e, element in enumerate(self.elements):
+            lightest_mass = ISOTOPE_TABLE[element][0][0]
+            for mass, abundance, shift in ISOTOPE_TABLE[element]:
+                self.shift_probs[e, shift] += abundance
+                self.shift_masses[e, shift] += abundance * (mass - lightest_mass)
+        self.largest_shifts = np.array([max(shift for _, _, shift in ISOTOPE_TABLE[element])
+                                        for element in self.elements])
+        shifts = np.arange(self.max_shift + 1)
+        self.shift_means = self.shift_probs @ shifts
+        self.shift_vars = self.shift_probs @ (shifts ** 2) - self.shift_means ** 2
+
+    def get_envelope(self, counts):
+        """
+        Gets the isotope envelope of one formula
+        :param counts: the number of atoms of each element
+        :return: a tuple of the mass shifts of the isotopologues from the monoisotopic mass, in increasing order,
+        and their abundances
+        """
+        return self.get_envelopes(np.asarray(counts)[np.newaxis, :])[0]
+
+    def get_envelopes(self, counts):
+        """
+        Gets the isotope envelopes of many formulas, computing the ones that aren't cached together
+        :param counts: an array of shape (number of formulas, number of elements) of atom counts
+        :return: a list of (mass shifts, abundances) tuples as returned by `get_envelope`
+        """
+        keys = [tuple(row) for row in np.asarray(counts, dtype=np.int64).tolist()]
+        envelopes = {}
+        for key in keys:
+            if key in self.cache and key not in envelopes:
+                self.cache.move_to_end(key)
+                envelopes[key] = self.cache[key]
+        missing = list(dict.fromkeys(key for key in keys if key not in envelopes))
+        if len(missing) > 0:
+            if self.fine:
+                computed = [self._compute_fine_envelope(key) for key in missing]
+            else:
+                computed = self._compute_aggregated_envelopes(np.array(missing, dtype=np.int64))
+            for key, envelope in zip(missing, computed):
+                envelopes[key] = envelope
+                self.cache[key] = envelope
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return [envelopes[key] for key in keys]
+
+    def _compute_aggregated_envelopes(self, counts):
+        envelopes = []
+        for start in range(0, len(counts), FFT_CHUNK_SIZE):
+            chunk = counts[start:start + FFT_CHUNK_SIZE].astype(np.float64)
+
+            # long enough for the whole envelope, so that the circular convolution doesn't wrap around: the largest
+            # possible mass shift, or for large formulas a bound well beyond any abundance that matters
+            widest = np.max(np.minimum(chunk @ self.largest_shifts,
+                                       chunk @ self.shift_means + 10 * np.sqrt(chunk @ self.shift_vars) +
+                                       4 * self.max_shift))
+            length = max(MIN_FFT_LENGTH, 1 << int(np.ceil(np.log2(widest + 1))))
+            probs_ft = np.fft.fft(self.shift_probs, n=length, axis=1)
+            masses_ft = np.fft.fft(self.shift_masses, n=length, axis=1)
+            probs_ft[probs_ft == 0] = np.finfo(np.float64).tiny
+
+            # the product of the element polynomials to the power of their counts, and its derivative with respect
+            # to the mass shifts, which gives the abundance-weighted mass shifts
+            log_envelope_ft = chunk @ np.log(probs_ft)
+            magnitudes = np.exp(log_envelope_ft.real)  # np.exp on complex arrays can be many times slower
+            envelope_ft = magnitudes * np.cos(log_envelope_ft.imag) + 1j * (magnitudes * np.sin(log_envelope_ft.imag))
+            weighted_ft = envelope_ft * (chunk @ (masses_ft / probs_ft))
+            probs = np.fft.ifft(envelope_ft, axis=1).real
+            weighted = np.fft.ifft(weighted_ft, axis=1).real
+
+            # each row keeps at least its most abundant peak, and never the rounding noise around 0
+            threshold = np.minimum(self.min_abundance, probs.max(axis=1))
+            rows, cols = np.nonzero((probs >= threshold[:, np.newaxis]) & (probs > 0))
+            abundances = probs[rows, cols]
+            shifts, abundances = _read_only(weighted[rows, cols] / abundances, abundances)
+            splits = np.cumsum(np.bincount(rows, minlength=len(chunk)))[:-1]
+            envelopes.extend(zip(np.split(shifts, splits), np.split(abundances, splits)))
+        return envelopes
+
+    def _compute_fine_envelope(self, counts):
+        shifts, abundances = np.zeros(1), np.ones(1)
+        for element, n in zip(self.elements, counts):
+            if n > 0:
+                element_shifts, element_abundances = _get_element_distribution(element, n, self.min_abundance,
+                                                                               self.resolution)
+                shifts, abundances = _convolve(shifts, abundances, element_shifts, element_abundances,
+                                               self.min_abundance, self.resolution)
+        return _read_only(shifts, abundances)
+
+
+def truncate_envelope(shifts, abundances, total_proportion, max_peaks=None):
+    """
+    Keeps the lightest isotopologues of an envelope that together make up a proportion of its abundance
+    :param shifts: the mass shifts of the envelope, in increasing order
+    :param abundances: the abundances of the envelope
+    :param total_proportion: the proportion of the abundance to keep
+    :param max_peaks: the maximum number of isotopologues to keep, the most abundant ones, or None for no limit
+    :return: a tuple of the kept mass shifts and their abundances, in increasing order of mass shift and normalised
+    to sum to 1
+    """
+    cumulative = np.cumsum(abundances)
+    n = min(int(np.searchsorted(cumulative, total_proportion * cumulative[-1])) + 1, len(abundances))
+    if max_peaks is None or n <= max_peaks:
+        return shifts[:n], abundances[:n] / cumulative[n - 1]
+    keep = np.sort(np.argsort(-abundances[:n], kind='stable')[:max_peaks])
+    return shifts[keep], abundances[keep] / np.sum(abundances[keep])
+
+
+def merge_envelope(shifts, abundances, resolution):
+    """
+    Merges the isotopologues of an envelope that an instrument can't tell apart into one peak at their
+    abundance-weighted mean mass shift. Isotopologues closer than the resolution to the previous one are merged with
+    it, so the merged peaks are at least the resolution apart.
+    :param shifts: the mass shifts of the envelope, in increasing order
+    :param abundances: the abundances of the envelope
+    :param resolution: the mass difference below which isotopologues are merged
+    :return: a tuple of the merged mass shifts, in increasing order, and their abundances
+    """
+    starts = np.flatnonzero(np.concatenate([[True], np.diff(shifts) >= resolution]))
+    merged_abundances = np.add.reduceat(abundances, starts)
+    merged_shifts = np.add.reduceat(abundances * shifts, starts) / merged_abundances
+    return merged_shifts, merged_abundances
+
+
+@lru_cache(maxsize=ISOTOPE_CACHE_SIZE)
+def _get_element_distribution(element, n, min_abundance, resolution):
+    # the fine isotope distribution of n atoms of an element, by repeated squaring
+    isotopes = ISOTOPE_TABLE[element]
+    atom_shifts = np.array([mass - isotopes[0][0] for mass, _, _ in isotopes])
+    atom_abundances = np.array([abundance for _, abundance, _ in isotopes])
+    shifts, abundances = np.zeros(1), np.ones(1)
+    while n > 0:
+        if n & 1:
+            shifts, abundances = _convolve(shifts, abundances, atom_shifts, atom_abundances, min_abundance,
+                                           resolution)
+        n >>= 1
+        if n > 0:
+            atom_shifts, atom_abundances = _convolve(atom_shifts, atom_abundances, atom_shifts, atom_abundances,
+                                                     min_abundance, resolution)
+    return _read_only(shifts, abundances)
+
+
+def _convolve(shifts_a, abundances_a, shifts_b, abundances_b, min_abundance, resolution):
+    # the distribution of the sum of two independent mass shifts, merging shifts closer than the resolution
+    shifts = np.add.outer(shifts_a, shifts_b).ravel()
+    abundances = np.multiply.outer(abundances_a, abundances_b).ravel()
+    keep = abundances >= min(min_abundance, abundances.max())  # keeping at least the most abundant
+    shifts, abundances = shifts[keep], abundances[keep]
+    bins, inverse = np.unique(np.round(shifts / resolution).astype(np.int64), return_inverse=True)
+    merged_abundances = np.bincount(inverse.ravel(), weights=abundances, minlength=len(bins))
+    merged_shifts = np.bincount(inverse.ravel(), weights=abundances * shifts, minlength=len(bins)) / merged_abundances
+    return merged_shifts, merged_abundances
+
+
+def _read_only(shifts, abundances):
+    # cached envelopes are shared, so they mustn't be modified
+    shifts.flags.writeable = False
+    abundances.flags.writeable = False
+    return shifts, abundances
@@ -0,0 +1,349 @@
+# Inner loops that are hard to vectorise, compiled with numba when it's installed.
+# Each kernel is written once as plain Python over numpy arrays. Without numba, that same code is run by the
+# interpreter, so installing numba makes the simulation faster but never changes its results.
+import math
+
+import numpy as np
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+SQRT_2PI = math.sqrt(2 * math.pi)
+LOG_SQRT_2PI = math.log(SQRT_2PI)
+
+
+def jit_kernel(func):
+    """
+    Compiles a kernel with numba if it's available, otherwise returns it unchanged.
+    The uncompiled kernel is always available as kernel.py_func, like for numba dispatchers.
+    :param func: a function that only uses numpy arrays, scalars and the numpy functions supported by numba
+    :return: the kernel
+    """
+    if NUMBA_AVAILABLE:
+        # error_model='numpy' so that e.g. a division by zero gives inf or nan in both paths instead of raising
+        return njit(cache=True, nogil=True, error_model='numpy')(func)
+    func.py_func = func
+    return func
+
+
+########################################################################################################################
+# Regions of interest
+########################################################################################################################
+
+
+@jit_kernel
+def roi_assign(mzs, roi_sums, roi_counts, mz_tol, ppm):
+    """
+    Assigns the peaks of an MS1 scan to regions of interest, in the same way as calling Roi.match() then adding
+    the peak to the matched ROI, or inserting a new ROI, for each peak in turn.
+    Existing ROI have ids 0 to len(roi_sums) - 1, new ROI get the following ids in order of creation.
+    :param mzs: the m/z values of the peaks to assign, in scan order
+    :param roi_sums: the sum of the m/z values of each live ROI, in the order of the live ROI list
+    :param roi_counts: the number of points of each live ROI
+    :param mz_tol: the m/z tolerance
+    :param ppm: True if mz_tol is in ppm, False if it's in Da
+    :return: a tuple of the ROI id assigned to each peak and the ids of all ROI in their final list order
+    """
+    n_roi = roi_sums.shape[0]
+    n_peaks = mzs.shape[0]
+    size = n_roi
+    sums = np.empty(n_roi + n_peaks)
+    counts = np.empty(n_roi + n_peaks, dtype=np.int64)
+    ids = np.empty(n_roi + n_peaks, dtype=np.int64)
+    for i in range(n_roi):
+        sums[i] = roi_sums[i]
+        counts[i] = roi_counts[i]
+        ids[i] = i
+    assigned = np.empty(n_peaks, dtype=np.int64)
+    next_id = n_roi
+
+    for k in range(n_peaks):
+        mz = mzs[k]
+
+        # same as bisect.bisect_right, where a ROI is smaller than another if its mean m/z is smaller or equal
+        lo = 0
+        hi = size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mz <= sums[mid] / counts[mid]:
+                hi = mid
+            else:
+                lo = mid + 1
+        pos = lo
+
+        match = -1
+        if size > 0:
+            dist_left = 0.0
+            dist_right = 0.0
+            if pos > 0:
+                dist_left = mz - sums[pos - 1] / counts[pos - 1]
+                if ppm:
+                    dist_left = 1e6 * dist_left / mz
+            if pos < size:
+                dist_right = sums[pos] / counts[pos] - mz
+                if ppm:
+                    dist_right = 1e6 * dist_right / mz
+
+            if pos == size:
+                if dist_left < mz_tol:
+                    match = pos - 1
+            elif pos == 0:
+                if dist_right < mz_tol:
+                    match = pos
+            elif dist_left < mz_tol and dist_right > mz_tol:
+                match = pos - 1
+            elif dist_left > mz_tol and dist_right < mz_tol:
+                match = pos
+            elif dist_left < mz_tol and dist_right < mz_tol:
+                if dist_left <= dist_right:
+                    match = pos - 1
+                else:
+                    match = pos
+
+        if match >= 0:
+            sums[match] += mz
+            counts[match] += 1
+            assigned[k] = ids[match]
+        else:
+            # insert a new ROI, at the position bisect.insort_right would use
+            for i in range(size, pos, -1):
+                sums[i] = sums[i - 1]
+                counts[i] = counts[i - 1]
+                ids[i] = ids[i - 1]
+            sums[pos] = mz
+            counts[pos] = 1
+            ids[pos] = next_id
+            assigned[k] = next_id
+            next_id += 1
+            size += 1
+
+    return assigned, ids[:size].copy()
+
+
+@jit_kernel
+def _aligned_correlation(rts, intensities, offsets, a, b, pearson):
+    # the correlation of the intensities of ROI a and b once aligned on retention time, see Roi.roi_correlation
+    if rts[offsets[b]] < rts[offsets[a]]:
+        a, b = b, a
+    start_a, end_a = offsets[a], offsets[a + 1]
+    start_b, end_b = offsets[b], offsets[b + 1]
+    len_a = end_a - start_a
+    len_b = end_b - start_b
+    if rts[end_a - 1] < rts[start_b]:
+        return 0.0
+
+    pos = -1
+    for i in range(len_a):
+        if rts[start_a + i] == rts[start_b]:
+            pos = i
+            break
+    if pos < 0:
+        raise ValueError('ROI retention times are not aligned')
+
+    total_length = max(len_a, len_b + pos)
+    r1 = np.zeros(total_length)
+    r2 = np.zeros(total_length)
+    for i in range(len_a):
+        r1[i] = intensities[start_a + i]
+    for i in range(len_b):
+        r2[pos + i] = intensities[start_b + i]
+
+    if pearson:
+        mean1 = 0.0
+        mean2 = 0.0
+        for i in range(total_length):
+            mean1 += r1[i]
+            mean2 += r2[i]
+        mean1 /= total_length
+        mean2 /= total_length
+        for i in range(total_length):
+            r1[i] -= mean1
+            r2[i] -= mean2
+
+    numerator = 0.0
+    norm1 = 0.0
+    norm2 = 0.0
+    for i in range(total_length):
+        numerator += r1[i] * r2[i]
+        norm1 += r1[i] * r1[i]
+        norm2 += r2[i] * r2[i]
+    r = numerator / (np.sqrt(norm1) * np.sqrt(norm2))
+    if pearson:
+        r = max(min(r, 1.0), -1.0)
+    return r
+
+
+@jit_kernel
+def greedy_cluster_labels(rts, intensities, offsets, corr_thresh, pearson):
+    """
+    Greedily clusters ROI: the first unclustered ROI starts a new cluster, which takes all the following unclustered
+    ROI whose correlation with it is above the threshold.
+    ROI are stored one after the other in flat arrays, ROI i being at offsets[i]:offsets[i + 1].
+    :param rts: the retention times of all ROI
+    :param intensities: the intensities of all ROI
+    :param offsets: the start of each ROI in rts and intensities, followed by the total length
+    :param corr_thresh: the correlation threshold
+    :param pearson: True to use the Pearson correlation, False to use the cosine similarity
+    :return: the cluster index of each ROI
+    """
+    n = offsets.shape[0] - 1
+    labels = np.full(n, -1, dtype=np.int64)
+    n_clusters = 0
+    for a in range(n):
+        if labels[a] >= 0:
+            continue
+        labels[a] = n_clusters
+        for b in range(a + 1, n):
+            if labels[b] < 0 and _aligned_correlation(rts, intensities, offsets, a, b, pearson) > corr_thresh:
+                labels[b] = n_clusters
+        n_clusters += 1
+    return labels
+
+
+########################################################################################################################
+# Dynamic exclusion
+########################################################################################################################
+
+
+@jit_kernel
+def find_exclusion(mz, rt, from_mz, to_mz, from_rt, to_rt):
+    """
+    Finds the first exclusion window containing an (m/z, rt) pair
+    :param mz: m/z value
+    :param rt: RT value
+    :param from_mz: the lower m/z of each window
+    :param to_mz: the upper m/z of each window
+    :param from_rt: the start RT of each window
+    :param to_rt: the end RT of each window
+    :return: the index of the first window containing the pair, or -1 if none does
+    """
+    for i in range(from_mz.shape[0]):
+        if from_mz[i] <= mz <= to_mz[i] and from_rt[i] <= rt <= to_rt[i]:
+            return i
+    return -1
+
+
+########################################################################################################################
+# Peak picking
+########################################################################################################################
+
+
+@jit_kernel
+def mixture_log_likelihoods(particles, y, t, mixture):
+    """
+    Computes the log likelihood of the data for each particle, as PeakPicking.MSmixture_posterior
+    :param particles: an array of parameters, one particle per row
+    :param y: the observed intensities
+    :param t: the observed retention times
+    :param mixture: True if the model has a peak (N == 1), False if it's only a baseline
+    :return: the log likelihood of each particle
+    """
+    n_particles = particles.shape[0]
+    n = y.shape[0]
+    log_likes = np.empty(n_particles)
+    mean = np.empty(n)
+    for p in range(n_particles):
+        for j in range(n):
+            mean[j] = particles[p, 0]
+        if mixture:
+            height = particles[p, 1] ** 2
+            loc = np.abs(particles[p, 2])
+            scale = np.abs(particles[p, 3])
+            for j in range(n):
+                z = (t[j] - loc) / scale
+                mean[j] += height * (math.exp(-z * z / 2) / SQRT_2PI / scale)
+
+        sum_sq = 0.0
+        for j in range(n):
+            sum_sq += (y[j] - mean[j]) ** 2
+        var = sum_sq / n
+        if not var > 0:
+            log_likes[p] = np.nan
+            continue
+
+        # the model uses var as the standard deviation of the noise
+        log_like = 0.0
+        log_var = math.log(var)
+        for j in range(n):
+            z = (y[j] - mean[j]) / var
+            log_like += -z * z / 2 - LOG_SQRT_2PI - log_var
+        log_likes[p] = log_like
+    return log_likes
+
+
+########################################################################################################################
+# Matrix factorisation
+########################################################################################################################
+
+
+@jit_kernel
+def observed_weighted_sums(X, observed, V):
+    """
+    Computes, for each row n of X, the sum of X[n, m] * V[m, :] over the observed entries m of that row,
+    accumulated in increasing m as in the Gibbs sampler updates
+    :param X: the data matrix, of shape (N, M)
+    :param observed: a matrix of the same shape, non-zero where X is observed
+    :param V: the factor matrix, of shape (M, R)
+    :return: the sums, of shape (N, R)
+    """
+    N, M = X.shape
+    R = V.shape[1]
+    sums = np.zeros((N, R))
+    for n in range(N):
+        for m in range(M):
+            if observed[n, m]:
+                for r in range(R):
+                    sums[n, r] += X[n, m] * V[m, r]
+    return sums
+
+
+########################################################################################################################
+# Density sampling
+########################################################################################################################
+
+
+@jit_kernel
+def build_alias_table(probs):
+    """
+    Builds the alias table of a discrete distribution with Vose's method, to draw from it in constant time:
+    draw an outcome i uniformly, then keep it with probability prob[i], otherwise take alias[i]
+    :param probs: the probability of each outcome, summing to 1
+    :return: a tuple of the acceptance probability and the alias of each outcome
+    """
+    n = probs.shape[0]
+    scaled = probs * n
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = np.empty(n, dtype=np.int64)
+    large = np.empty(n, dtype=np.int64)
+    n_small = 0
+    n_large = 0
+    for i in range(n):
+        if scaled[i] < 1.0:
+            small[n_small] = i
+            n_small += 1
+        else:
+            large[n_large] = i
+            n_large += 1
+
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        s = small[n_small]
+        n_large -= 1
+        g = large[n_large]
+        prob[s] = scaled[s]
+        alias[s] = g
+        scaled[g] = (scaled[g] + scaled[s]) - 1.0
+        if scaled[g] < 1.0:
+            small[n_small] = g
+            n_small += 1
+        else:
+            large[n_large] = g
+            n_large += 1
+
+    # the outcomes left in either list have a probability of 1, up to rounding errors
+    return prob, alias
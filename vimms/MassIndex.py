@@ -0,0 +1,119 @@
+import numpy as np
+
+
+class MassIndex(object):
+    """
+    An index of masses sorted once, so that the masses in a range, within a tolerance or nearest to query masses
+    are found by binary search rather than by scanning and sorting all of them for every query.
+    All the lookups take arrays of query masses and return positions in the masses the index was created from.
+    """
+
+    def __init__(self, masses):
+        """
+        Creates a mass index
+        :param masses: the masses to index, in any order
+        """
+        masses = np.asarray(masses, dtype=np.float64)
+        self.order = np.argsort(masses, kind='stable')
+        self.sorted_masses = masses[self.order]
+
+    def __len__(self):
+        return len(self.sorted_masses)
+
+    def get_range(self, min_mass, max_mass):
+        """
+        Finds the masses in a range
+        :param min_mass: the lower bound of the range, inclusive
+        :param max_mass: the upper bound of the range, inclusive
+        :return: the positions of the masses in the range, in increasing order of mass
+        """
+        start = np.searchsorted(self.sorted_masses, min_mass, side='left')
+        end = np.searchsorted(self.sorted_masses, max_mass, side='right')
+        return self.order[start:end]
+
+    def get_within(self, masses, tolerance):
+        """
+        Finds the masses within a tolerance of each query mass
+        :param masses: an array of query masses
+        :param tolerance: the largest absolute difference in mass
+        :return: a list with the positions of the masses within the tolerance of each query, as for `get_range`
+        """
+        masses = np.asarray(masses, dtype=np.float64)
+        starts = np.searchsorted(self.sorted_masses, masses - tolerance, side='left')
+        ends = np.searchsorted(self.sorted_masses, masses + tolerance, side='right')
+        return [self.order[start:end] for start, end in zip(starts, ends)]
+
+    def get_nearest(self, masses, k=1):
+        """
+        Finds the k nearest masses to each query mass
+        :param masses: an array of query masses
+        :param k: the number of masses to find for each query
+        :return: an array of shape (number of queries, k) of positions, from the nearest to the furthest, where ties
+        are broken towards smaller masses
+        """
+        masses = np.asarray(masses, dtype=np.float64)
+        k = min(k, len(self))
+        # the k nearest are among the k masses on either side of the insertion point
+        candidates = np.searchsorted(self.sorted_masses, masses)[:, np.newaxis] + np.arange(-k, k)
+        valid = (candidates >= 0) & (candidates < len(self))
+        candidates = np.clip(candidates, 0, len(self) - 1)
+        distances = np.where(valid, np.abs(self.sorted_masses[candidates] - masses[:, np.newaxis]), np.inf)
+        nearest = np.take_along_axis(candidates, np.argsort(distances, axis=1, kind='stable')[:, :k], axis=1)
+        return self.order[nearest]
+
+    def sample_nearest(self, masses, groups):
+        """
+        Picks the nearest mass to each query mass in turn, without replacement: once a mass is picked, it and all the
+        masses of the same group can't be picked again, e.g. all the compounds with the same formula.
+        Used masses are skipped with pointers to the nearest unused masses on either side, which are shortened as
+        they are followed, so each query takes close to constant time after the binary search.
+        :param masses: an array of query masses, in the order in which they pick
+        :param groups: the group of each indexed mass, e.g. formula strings
+        :return: an array of the position of the mass picked by each query. Ties are broken towards smaller masses,
+        then towards earlier positions.
+        """
+        masses = np.asarray(masses, dtype=np.float64)
+        n = len(self)
+        n_groups = len(set(groups))
+        if len(masses) > n_groups:
+            raise ValueError('Cannot pick %d masses from %d groups' % (len(masses), n_groups))
+
+        # the sorted positions in each group
+        _, group_ids = np.unique(np.asarray(groups, dtype=object)[self.order].astype(str), return_inverse=True)
+        group_ids = group_ids.ravel()
+        group_order = np.argsort(group_ids, kind='stable')
+        group_starts = np.searchsorted(group_ids[group_order], np.arange(group_ids.max() + 2))
+
+        # right[i] leads to the first unused position >= i, or to n if there is none. left[i] leads to one plus the
+        # last unused position < i, or to 0 if there is none
+        right = list(range(n + 1))
+        left = list(range(n + 1))
+        insertion_points = np.searchsorted(self.sorted_masses, masses).tolist()
+        run_starts = np.searchsorted(self.sorted_masses, self.sorted_masses).tolist()  # the first of equal masses
+        sorted_masses = self.sorted_masses.tolist()
+
+        picked = []
+        for mass, i in zip(masses.tolist(), insertion_points):
+            upper = _find(right, i)
+            lower = _find(left, i) - 1
+            if upper == n or (lower >= 0 and mass - sorted_masses[lower] <= sorted_masses[upper] - mass):
+                pos = _find(right, run_starts[lower])  # the first unused of the masses equal to the lower one
+            else:
+                pos = upper
+            picked.append(pos)
+
+            group = group_ids[pos]
+            for used in group_order[group_starts[group]:group_starts[group + 1]].tolist():
+                right[used] = used + 1
+                left[used + 1] = used
+        return self.order[np.array(picked, dtype=np.int64)]
+
+
+def _find(parents, i):
+    # follows the parents from i to a root, the nearest unused position, and points the path straight to the root
+    root = i
+    while parents[root] != root:
+        root = parents[root]
+    while parents[i] != root:
+        parents[i], i = root, parents[i]
+    return root
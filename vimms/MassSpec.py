@@ -2,20 +2,22 @@ import atexit
 import math
 import sys
 import time
+import types
 
 import numpy as np
 import scipy
-from events import Events
 from loguru import logger
 
 from vimms.Common import adduct_transformation, DEFAULT_MS1_SCAN_WINDOW, DEFAULT_IAPI_SINGLE_PROCESSING_DELAY, \
     create_if_not_exist
+from vimms.Dispatch import Channel, EventDispatcher
 
 
 class Peak(object):
     """
     A class to represent an empirical or sampled scan-level peak object
     """
+    __slots__ = ('mz', 'rt', 'intensity', 'ms_level')
 
     def __init__(self, mz, rt, intensity, ms_level):
         """
@@ -43,11 +45,19 @@ class Peak(object):
                math.isclose(self.intensity, other.intensity) and \
                self.ms_level == other.ms_level
 
+    def __getstate__(self):
+        return self.mz, self.rt, self.intensity, self.ms_level
+
+    def __setstate__(self, state):
+        _set_slots(self, state)
+
 
 class Scan(object):
     """
     A class to store scan information
     """
+    __slots__ = ('scan_id', 'mzs', 'intensities', 'ms_level', 'rt', 'num_peaks', 'scan_duration', 'scan_params',
+                 'parent')
 
     def __init__(self, scan_id, mzs, intensities, ms_level, rt,
                  scan_duration=None, scan_params=None, parent=None):
@@ -81,6 +91,12 @@ class Scan(object):
     def __repr__(self):
         return 'Scan %d num_peaks=%d rt=%.2f ms_level=%d' % (self.scan_id, self.num_peaks, self.rt, self.ms_level)
 
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        _set_slots(self, state)
+
 
 class ScanParameters(object):
     """
@@ -110,6 +126,8 @@ class ScanParameters(object):
     # for other DDA controllers it's always the same throughout the whole run, so we don't send this parameter
     CURRENT_TOP_N = 'current_top_N'
 
+    __slots__ = ('params',)
+
     def __init__(self):
         """
         Creates a scan parameter object
@@ -131,10 +149,14 @@ class ScanParameters(object):
         :param key:
         :return:
         """
-        if key in self.params:
-            return self.params[key]
-        else:
-            return None
+        return self.params.get(key)
+
+    def freeze(self):
+        """
+        Returns an immutable, hashable copy of these scan parameters
+        :return: a FrozenScanParameters object
+        """
+        return FrozenScanParameters(self.params)
 
     def compute_isolation_windows(self):
         """
@@ -152,6 +174,95 @@ class ScanParameters(object):
     def __repr__(self):
         return 'ScanParameters %s' % (self.params)
 
+    def __getstate__(self):
+        return (self.params,)
+
+    def __setstate__(self, state):
+        _set_slots(self, state)
+
+
+class FrozenScanParameters(ScanParameters):
+    """
+    Immutable scan parameters that can be hashed, compared and shared between scans, e.g. the default MS1 scan
+    parameters or a fixed DIA window schedule. Controllers read them through get() as usual.
+    The parameters are a read-only view of a private dictionary. The values are the original objects so existing
+    code sees the same types, and they should not be modified.
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, params):
+        """
+        Creates frozen scan parameters
+        :param params: a dictionary of scan parameter names and values
+        """
+        super().__init__()
+        self.params = types.MappingProxyType(dict(params))
+        self.key = _freeze(self.params)
+
+    def set(self, key, value):
+        raise TypeError('FrozenScanParameters cannot be modified, use thaw() to get a modifiable copy')
+
+    def freeze(self):
+        return self
+
+    def thaw(self):
+        """
+        Returns a modifiable copy of these scan parameters
+        :return: a ScanParameters object
+        """
+        params = ScanParameters()
+        params.params = dict(self.params)
+        return params
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenScanParameters):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return 'FrozenScanParameters %s' % (dict(self.params))
+
+    def __getstate__(self):
+        return (dict(self.params),)
+
+    def __setstate__(self, state):
+        self.params = types.MappingProxyType(dict(state[0]))
+        self.key = _freeze(self.params)
+
+
+def _freeze(value):
+    """
+    Converts a scan parameter value into a hashable equivalent, used to hash and compare frozen scan parameters
+    :param value: a value, possibly containing lists, dictionaries or numpy arrays
+    :return: the hashable equivalent
+    """
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return _freeze(value.tolist())
+    return value
+
+
+def _set_slots(obj, state):
+    """
+    Restores a slotted object from its pickled state.
+    Objects pickled before their class had __slots__ have a dictionary of attributes as their state.
+    :param obj: the object being unpickled
+    :param state: a tuple of slot values, or a dictionary of attributes
+    :return: None
+    """
+    if isinstance(state, dict):
+        for key, value in state.items():
+            setattr(obj, key, value)
+    else:
+        for slot, value in zip(obj.__slots__, state):
+            setattr(obj, slot, value)
+
 
 class FragmentationEvent(object):
     """
@@ -211,7 +322,7 @@ class IndependentMassSpectrometer(object):
     STATE_CHANGED = 'StateChanged'
 
     def __init__(self, ionisation_mode, chemicals, peak_sampler, add_noise=False,
-                 isolation_transition_window='rectangular', isolation_transition_window_params=None):
+                 isolation_transition_window='rectangular', isolation_transition_window_params=None, rng=None):
         """
         Creates a mass spec object.
         :param ionisation_mode: POSITIVE or NEGATIVE
@@ -219,6 +330,7 @@ class IndependentMassSpectrometer(object):
         :param peak_sampler: an instance of DataGenerator.PeakSampler object
         :param add_noise: a flag to indicate whether to add noise
         :param use_exclusion_list: a flag to indicate whether to perform dynamic exclusion
+        :param rng: a numpy Generator used to sample scan durations, None to use the global numpy random state
         """
 
         # current scan index and internal time
@@ -226,18 +338,12 @@ class IndependentMassSpectrometer(object):
         self.time = 0
 
         # current task queue
-        self.processing_queue = []
+        self.processing_queue = Channel()
         self.environment = None
 
         # the events here follows IAPI events
-        self.events = Events((self.MS_SCAN_ARRIVED, self.ACQUISITION_STREAM_OPENING, self.ACQUISITION_STREAM_CLOSING,
-                              self.STATE_CHANGED,))
-        self.event_dict = {
-            self.MS_SCAN_ARRIVED: self.events.MsScanArrived,
-            self.ACQUISITION_STREAM_OPENING: self.events.AcquisitionStreamOpening,
-            self.ACQUISITION_STREAM_CLOSING: self.events.AcquisitionStreamClosing,
-            self.STATE_CHANGED: self.events.StateChanged
-        }
+        self.dispatcher = EventDispatcher((self.MS_SCAN_ARRIVED, self.ACQUISITION_STREAM_OPENING,
+                                           self.ACQUISITION_STREAM_CLOSING, self.STATE_CHANGED,))
 
         # the list of all chemicals in the dataset
         self.chemicals = chemicals
@@ -250,6 +356,7 @@ class IndependentMassSpectrometer(object):
 
         # here's where we store all the stuff to sample from
         self.peak_sampler = peak_sampler
+        self.rng = rng
 
         # required to sample for different scan durations based on (N, DEW) in the hybrid controller
         self.current_N = 0
@@ -271,26 +378,39 @@ class IndependentMassSpectrometer(object):
     def step(self):
         """
         Performs one step of a mass spectrometry process
-        :return:
+        :return: the generated scan
         """
-
-        # get scan param from the processing queue and do one scan
-        params = self._get_params()
-        scan = self._get_scan(self.time, params)
+        scan = self.generate_scan()
 
         # notify the controller that a new scan has been generated
         # at this point, the MS_SCAN_ARRIVED event handler in the controller is called
         # and the processing queue will be updated with new sets of scan parameters to do
         self.fire_event(self.MS_SCAN_ARRIVED, scan)
 
+        self.complete_scan(scan)
+        return scan
+
+    def generate_scan(self):
+        """
+        First half of a step: takes the next scan parameters from the processing queue and generates the scan at the
+        current time. The controller should handle the scan before complete_scan() is called.
+        :return: the generated scan
+        """
+        params = self._get_params()
+        return self._get_scan(self.time, params)
+
+    def complete_scan(self, scan):
+        """
+        Second half of a step: samples the scan duration, which depends on the next scan in the processing queue,
+        and increases the internal time
+        :param scan: the scan returned by generate_scan()
+        :return: None
+        """
         # sample scan duration and increase internal time
         current_level = scan.ms_level
         current_N = self.current_N
         current_DEW = self.current_DEW
-        try:
-            next_scan_param = self.get_processing_queue()[0]
-        except IndexError:
-            next_scan_param = None
+        next_scan_param = self.processing_queue.peek()
 
         current_scan_duration = self._increase_time(current_level, current_N, current_DEW,
                                                     next_scan_param)
@@ -298,7 +418,6 @@ class IndependentMassSpectrometer(object):
 
         # stores the updated value of N and DEW
         self._store_next_N_DEW(next_scan_param)
-        return scan
 
     def get_processing_queue(self):
         """
@@ -313,7 +432,7 @@ class IndependentMassSpectrometer(object):
         :param param: the scan parameters to add
         :return: None
         """
-        self.processing_queue.append(param)
+        self.processing_queue.put(param)
 
     def reset(self):
         """
@@ -323,7 +442,7 @@ class IndependentMassSpectrometer(object):
         self.clear_events()
         self.time = 0
         self.idx = 0
-        self.processing_queue = []
+        self.processing_queue = Channel()
         self.current_N = 0
         self.current_DEW = 0
         self.fragmentation_events = []
@@ -335,16 +454,9 @@ class IndependentMassSpectrometer(object):
         :param arg: the event parameter
         :return: None
         """
-        if event_name not in self.event_dict:
-            raise ValueError('Unknown event name')
-
         # pretend to fire the event
         # actually here we just runs the event handler method directly
-        e = self.event_dict[event_name]
-        if arg is not None:
-            e(arg)
-        else:
-            e()
+        self.dispatcher.fire(event_name, arg)
 
     def register_event(self, event_name, handler):
         """
@@ -353,14 +465,10 @@ class IndependentMassSpectrometer(object):
         :param handler: the event handler
         :return: None
         """
-        if event_name not in self.event_dict:
-            raise ValueError('Unknown event name')
-        e = self.event_dict[event_name]
-        e += handler  # register a new event handler for e
+        self.dispatcher.register(event_name, handler)
 
     def clear_events(self):
-        for key in self.event_dict:  # clear event handlers
-            self.clear_event(key)
+        self.dispatcher.clear_all()
 
     def clear_event(self, event_name):
         """
@@ -368,10 +476,7 @@ class IndependentMassSpectrometer(object):
         :param event_name: the event name
         :return: None
         """
-        if event_name not in self.event_dict:
-            raise ValueError('Unknown event name')
-        e = self.event_dict[event_name]
-        e.targets = []
+        self.dispatcher.clear(event_name)
 
     def close(self):
         logger.debug('Acquisition stream is closing!')
@@ -393,7 +498,7 @@ class IndependentMassSpectrometer(object):
             params = self.environment.get_default_scan_params()
         else:
             # otherwise pop the parameter for the next scan from the queue
-            params = self.processing_queue.pop(0)
+            params = self.processing_queue.get()
         return params
 
     def _increase_time(self, current_level, current_N, current_DEW, next_scan_param):
@@ -410,7 +515,6 @@ class IndependentMassSpectrometer(object):
                                                            current_level, next_level)
 
         self.time += current_scan_duration
-        logger.info('Time %f Len(queue)=%d' % (self.time, len(self.processing_queue)))
         return current_scan_duration
 
     def _sample_scan_duration(self, current_DEW, current_N, current_level, next_level):
@@ -419,13 +523,14 @@ class IndependentMassSpectrometer(object):
             # special case: for the transition (1, 1), we can try to get the times for the
             # fullscan data (N=0, DEW=0) if it's stored
             try:
-                current_scan_duration = self.peak_sampler.scan_durations(current_level, next_level, 1, N=0, DEW=0)
+                current_scan_duration = self.peak_sampler.scan_durations(current_level, next_level, 1, N=0, DEW=0,
+                                                                         rng=self.rng)
             except KeyError:  ## ooops not found
                 current_scan_duration = self.peak_sampler.scan_durations(current_level, next_level, 1,
-                                                                         N=current_N, DEW=current_DEW)
+                                                                         N=current_N, DEW=current_DEW, rng=self.rng)
         else:  # for (1, 2), (2, 1) and (2, 2)
             current_scan_duration = self.peak_sampler.scan_durations(current_level, next_level, 1,
-                                                                     N=current_N, DEW=current_DEW)
+                                                                     N=current_N, DEW=current_DEW, rng=self.rng)
         current_scan_duration = current_scan_duration.flatten()[0]
         return current_scan_duration
 
@@ -7,6 +7,8 @@ import pylab as plt
 import scipy
 from loguru import logger
 
+from vimms.Kernels import observed_weighted_sums
+
 
 class BlockData(object):
     def __init__(self, datasets, mz_step, rt_step, rt_range=[(0, 1450)], mz_range=[(50, 1070)]):
@@ -88,6 +90,7 @@ def gibbs_sampler(X, observed, R, prior_u, prec_u, prior_v, prec_v, alpha, n_its
         # first compute the covariance - shared if all data observed
         prec_mat = prec_u + alpha * np.dot(V.T, V)
         cov_mat = np.linalg.inv(prec_mat)
+        sums_U = observed_weighted_sums(X, observed, V)
         for n in range_U:
             if observed[n, :].sum() < M:
                 # not all data observed, compute specific precision
@@ -96,10 +99,7 @@ def gibbs_sampler(X, observed, R, prior_u, prec_u, prior_v, prec_v, alpha, n_its
             else:
                 this_prec_mat = prec_mat
                 this_cov_mat = cov_mat
-            s = np.zeros(R)
-            for m in range(M):
-                if observed[n, m]:
-                    s += X[n, m] * V[m, :]
+            s = sums_U[n, :]
             s *= alpha
             s += np.dot(prec_u, prior_u)
             cond_mu = np.dot(this_cov_mat, s)
@@ -110,6 +110,7 @@ def gibbs_sampler(X, observed, R, prior_u, prec_u, prior_v, prec_v, alpha, n_its
         if len(true_V) == 0:
             prec_mat = prec_v + alpha * np.dot(U.T, U)
             cov_mat = np.linalg.inv(prec_mat)
+            sums_V = observed_weighted_sums(X.T, observed.T, U)
             for m in range(M):
                 if observed[:, m].sum() < N:
                     this_prec_mat = prec_v + alpha * np.dot(np.dot(U.T, np.diag(observed[:, m])), U)
@@ -118,10 +119,7 @@ def gibbs_sampler(X, observed, R, prior_u, prec_u, prior_v, prec_v, alpha, n_its
                     this_prec_mat = prec_mat
                     this_cov_mat = cov_mat
 
-                s = np.zeros(R)
-                for n in range(N):
-                    if observed[n, m]:
-                        s += X[n, m] * U[n, :]
+                s = sums_V[m, :]
                 s *= alpha
                 s += np.dot(prec_v, prior_v)
                 cond_mu = np.dot(this_cov_mat, s)
@@ -0,0 +1,271 @@
+import heapq
+
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+from vimms.Common import POSITIVE, adduct_transformation
+from vimms.Environment import Environment
+from vimms.MassSpec import IndependentMassSpectrometer
+
+# the key of the last chromatogram lookup of a chemical in its SharedPeakCache entry, next to the ms level keys
+RELATIVE_KEY = 'relative'
+
+
+class SharedChemicals(object):
+    """
+    The structure shared by all the samples of a multi-sample simulation: the chemicals (formulae, chromatograms,
+    fragments), their retention time ranges and a cache of their peaks.
+    Samples only differ in the intensities and presence of these chemicals.
+    """
+
+    def __init__(self, chemicals):
+        """
+        Compiles the shared structure
+        :param chemicals: the list of chemicals shared by all samples, e.g. MultiSampleCreator.original_dataset
+        """
+        self.chemicals = chemicals
+        self.chem_index = {id(chem): i for i, chem in enumerate(chemicals)}
+        self.max_intensities = np.array([chem.max_intensity for chem in chemicals], dtype=float)
+        chem_rts = np.array([chem.rt for chem in chemicals])
+        self.chrom_min_rts = np.array([chem.chromatogram.min_rt for chem in chemicals]) + chem_rts
+        self.chrom_max_rts = np.array([chem.chromatogram.max_rt for chem in chemicals]) + chem_rts
+        self.peak_cache = SharedPeakCache(self.chrom_max_rts)
+
+
+class SharedPeakCache(object):
+    """
+    Caches the parts of the peaks of the shared chemicals that don't depend on the retention time: for each isotope
+    and adduct of a chemical, the m/z and intensity before the chromatogram is applied, and for MS2 scans the m/z and
+    intensity proportions of its fragments. Any scan of any sample then only needs to look up the chromatogram of a
+    chemical once, and the templates are reused however the scan times of the samples drift apart.
+    """
+
+    def __init__(self, chrom_max_rts):
+        """
+        Creates an empty cache
+        :param chrom_max_rts: the retention time after which each shared chemical can't be scanned anymore
+        """
+        self.chrom_max_rts = chrom_max_rts
+        self.entries = {}  # key: chemical index, value: dict of ms level to the peak template of the chemical
+        self.expiry = []  # a heap of (retention time, chemical index) to remove the chemicals that have eluted
+        self.hits = 0
+        self.misses = 0
+
+    def get_entry(self, chem_idx):
+        """
+        Returns the peak templates cached for a chemical, creating an empty entry if needed
+        :param chem_idx: the index of the chemical
+        :return: a dictionary of ms level to peak template, and of RELATIVE_KEY to the last chromatogram lookup, to
+        be read and filled by the caller
+        """
+        try:
+            return self.entries[chem_idx]
+        except KeyError:
+            entry = {}
+            self.entries[chem_idx] = entry
+            heapq.heappush(self.expiry, (self.chrom_max_rts[chem_idx], chem_idx))
+            return entry
+
+    def evict_before(self, rt):
+        """
+        Removes the entries of chemicals that have eluted before a retention time, once no sample can scan them
+        :param rt: the retention time
+        :return: None
+        """
+        while len(self.expiry) > 0 and self.expiry[0][0] < rt:
+            del self.entries[heapq.heappop(self.expiry)[1]]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SampleMassSpectrometer(IndependentMassSpectrometer):
+    """
+    A view of the shared chemicals as one sample: chemicals that are absent from the sample are skipped, and the
+    intensities of the others are scaled to their intensities in the sample.
+    """
+
+    def __init__(self, ionisation_mode, shared, intensities, mask, peak_sampler, add_noise=False, rng=None):
+        """
+        Creates a mass spec for one sample
+        :param ionisation_mode: POSITIVE or NEGATIVE
+        :param shared: the SharedChemicals object
+        :param intensities: the maximum intensity of each shared chemical in this sample
+        :param mask: a boolean array indicating which shared chemicals are present in this sample, or None if all are
+        :param peak_sampler: an instance of DataGenerator.PeakSampler object
+        :param add_noise: a flag to indicate whether to add noise
+        :param rng: a numpy Generator used to sample scan durations, None to use the global numpy random state
+        """
+        super().__init__(ionisation_mode, [], peak_sampler, add_noise=add_noise, rng=rng)
+        n = len(shared.chemicals)
+        self.shared = shared
+        self.chemicals = shared.chemicals
+        self.chrom_min_rts = shared.chrom_min_rts
+        self.chrom_max_rts = shared.chrom_max_rts
+        self.mask = np.ones(n, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        self.scales = np.zeros(n)
+        np.divide(np.asarray(intensities, dtype=float), shared.max_intensities, out=self.scales,
+                  where=shared.max_intensities != 0)
+
+    def _get_chem_indices(self, query_rt):
+        idx = super()._get_chem_indices(query_rt)
+        return idx[self.mask[idx]]
+
+    def _get_all_mz_peaks(self, chemical, query_rt, ms_level, isolation_windows):
+        if ms_level > 2 or chemical.ms_level != 1 or self.isolation_transition_window == 'gaussian':
+            mz_peaks = super()._get_all_mz_peaks(chemical, query_rt, ms_level, isolation_windows)
+        else:
+            mz_peaks = self._get_template_mz_peaks(chemical, query_rt, ms_level, isolation_windows)
+        if mz_peaks is None:
+            return None
+        scale = self.scales[self.shared.chem_index[id(chemical)]]
+        return [(mz, intensity * scale) for mz, intensity in mz_peaks]
+
+    def _get_template_mz_peaks(self, chemical, query_rt, ms_level, isolation_windows):
+        # the same peaks as IndependentMassSpectrometer._get_all_mz_peaks, in the same order and with the same
+        # floating point operations, from the cached template of the chemical
+        if not self._rt_match(chemical, query_rt):
+            return None
+        entry = self.shared.peak_cache.get_entry(self.shared.chem_index[id(chemical)])
+        template = self._get_template(entry, chemical, query_rt, ms_level)
+
+        # the chromatogram at the last retention time the chemical was scanned at, by any sample. The intensity is
+        # only looked up once a peak is in the isolation windows, which most chemicals aren't in MS2 scans
+        last_rt, relative_mz, relative_intensity = entry.get(RELATIVE_KEY, (None, None, None))
+        if last_rt != query_rt:
+            relative_mz = chemical.chromatogram.get_relative_mz(query_rt - chemical.rt)
+            relative_intensity = None
+
+        mz_peaks = []
+        for base_mz, base_intensity, fragments in template:
+            mz = base_mz + relative_mz
+            if not any(window[0] < mz <= window[1] for window in isolation_windows[0]):
+                continue
+            if relative_intensity is None:
+                relative_intensity = chemical.chromatogram.get_relative_intensity(query_rt - chemical.rt)
+            intensity = base_intensity * relative_intensity
+            if ms_level == 1:
+                mz_peaks.append((mz, intensity))
+            else:
+                for fragment_mz, parent_mass_prop, prop_ms2_mass in fragments:
+                    mz_peaks.append((fragment_mz, intensity * parent_mass_prop * prop_ms2_mass))
+        entry[RELATIVE_KEY] = (query_rt, relative_mz, relative_intensity)
+        return mz_peaks if len(mz_peaks) > 0 else None
+
+    def _get_template(self, entry, chemical, query_rt, ms_level):
+        # a list of (m/z and intensity without the chromatogram, fragments) for each isotope and adduct
+        cache = self.shared.peak_cache
+        try:
+            template = entry[ms_level]
+            cache.hits += 1
+            return template
+        except KeyError:
+            cache.misses += 1
+
+        template = []
+        adducts = self._get_adducts(chemical)
+        for which_isotope in range(len(chemical.isotopes)):
+            for which_adduct in range(len(adducts)):
+                if ms_level == 1 and which_isotope > 0 and which_adduct > 0:
+                    continue  # only the monoisotopic peaks of other adducts, as in _get_mz_peaks
+                base_mz = adduct_transformation(chemical.isotopes[which_isotope][0], adducts[which_adduct][0])
+                base_intensity = chemical.isotopes[which_isotope][1] * adducts[which_adduct][1] * \
+                                 chemical.max_intensity
+                fragments = []
+                if ms_level == 2 and chemical.children is not None:
+                    fragments = [(self._get_mz(child, query_rt, which_isotope, which_adduct), child.parent_mass_prop,
+                                  child.prop_ms2_mass) for child in chemical.children if child.ms_level == 2]
+                template.append((base_mz, base_intensity, fragments))
+        entry[ms_level] = template
+        return template
+
+
+class MultiSampleEnvironment(object):
+    """
+    Simulates a whole batch of samples (e.g. case/control) that share the same chemicals in one pass.
+    Each sample has its own mass spec view and controller, so controllers still make their own decisions, but the
+    samples are stepped together in time order so that peaks computed for one sample are reused by the others.
+    Results are the same as simulating each sample separately, up to floating point rounding of the intensities.
+    """
+
+    def __init__(self, chemicals, sample_intensities, sample_masks, peak_sampler, controllers, min_time, max_time,
+                 ionisation_mode=POSITIVE, add_noise=False, rngs=None, progress_bar=True, out_dir=None,
+                 out_files=None):
+        """
+        Creates a multi-sample environment
+        :param chemicals: the list of chemicals shared by all samples, e.g. MultiSampleCreator.original_dataset
+        :param sample_intensities: an array of shape (number of samples, number of chemicals) of maximum intensities,
+        e.g. MultiSampleCreator.sample_intensities
+        :param sample_masks: a boolean array of the same shape indicating which chemicals are present in each sample,
+        e.g. MultiSampleCreator.sample_masks, or None if all chemicals are present in all samples
+        :param peak_sampler: an instance of DataGenerator.PeakSampler object
+        :param controllers: a list of controllers, one for each sample
+        :param min_time: start time
+        :param max_time: end time
+        :param ionisation_mode: POSITIVE or NEGATIVE
+        :param add_noise: a flag to indicate whether to add noise
+        :param rngs: a list of numpy Generators to sample the scan durations of each sample, or None to use the global
+        numpy random state
+        :param progress_bar: True if a progress bar is to be shown
+        :param out_dir: output directory for the mzML files
+        :param out_files: a list of mzML filenames, one for each sample, or None to not write any
+        """
+        n_samples = len(controllers)
+        assert len(sample_intensities) == n_samples
+        assert sample_masks is None or len(sample_masks) == n_samples
+        self.shared = SharedChemicals(chemicals)
+        self.min_time = min_time
+        self.max_time = max_time
+        self.progress_bar = progress_bar
+
+        self.environments = []
+        for i in range(n_samples):
+            mask = None if sample_masks is None else sample_masks[i]
+            rng = None if rngs is None else rngs[i]
+            out_file = None if out_files is None else out_files[i]
+            mass_spec = SampleMassSpectrometer(ionisation_mode, self.shared, sample_intensities[i], mask,
+                                               peak_sampler, add_noise=add_noise, rng=rng)
+            env = Environment(mass_spec, controllers[i], min_time, max_time, progress_bar=False, out_dir=out_dir,
+                              out_file=out_file)
+            self.environments.append(env)
+
+    def run(self):
+        """
+        Runs all the samples. The sample that is furthest behind in time is always stepped next.
+        :return: None
+        """
+        generators = [env.iter_scans(keep_history=True) for env in self.environments]
+        heap = [(self.min_time, i) for i in range(len(generators))]
+        heapq.heapify(heap)
+        bar = tqdm(total=self.max_time - self.min_time, initial=0) if self.progress_bar else None
+        try:
+            while len(heap) > 0:
+                _, i = heapq.heappop(heap)
+                try:
+                    next(generators[i])
+                    heapq.heappush(heap, (self.environments[i].mass_spec.time, i))
+                except StopIteration:
+                    pass
+
+                # no sample will scan before the earliest current time anymore
+                if len(heap) > 0:
+                    earliest = heap[0][0]
+                    self.shared.peak_cache.evict_before(earliest)
+                    if bar is not None and bar.n < earliest - self.min_time <= bar.total:
+                        bar.update(earliest - self.min_time - bar.n)
+        finally:
+            for generator in generators:
+                generator.close()
+            if bar is not None:
+                bar.close()
+        cache = self.shared.peak_cache
+        logger.debug('Peak cache hits=%d misses=%d' % (cache.hits, cache.misses))
+
+    @property
+    def controllers(self):
+        return [env.controller for env in self.environments]
+
+    @property
+    def mass_specs(self):
+        return [env.mass_spec for env in self.environments]
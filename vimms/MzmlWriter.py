@@ -1,24 +1,54 @@
+import copy
+import hashlib
 import os
+import queue
+import re
+import threading
 
 import numpy as np
-from psims.mzml.writer import MzMLWriter as PsimsMzMLWriter
+from loguru import logger
+from psims.mzml import binary_encoding
+from psims.mzml.binary_encoding import COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_NUMPRESS_LINEAR_PREDICTION, \
+    COMPRESSION_NUMPRESS_SHORT_LOGGED_FLOAT
+from psims.mzml.writer import MzMLWriter as PsimsMzMLWriter, MZ_ARRAY, INTENSITY_ARRAY, TIME_ARRAY
 
 from vimms.Common import DEFAULT_MS1_SCAN_WINDOW, create_if_not_exist
+from vimms.MassSpec import ScanParameters
+
+# the spectrum count is only known when a streamed file is closed, so a fixed-width placeholder is written first and
+# overwritten in place, which keeps the byte offsets of the index valid. The count is written without padding, and the
+# unused width is left as whitespace after the attribute
+SPECTRUM_COUNT_WIDTH = 10
+SPECTRUM_COUNT_PLACEHOLDER = '0'.ljust(SPECTRUM_COUNT_WIDTH)
+
+# the compression of the binary arrays: key is the name of the compression, value is a tuple of the psims compression
+# of the m/z (or time) arrays and of the intensity arrays. MS-Numpress is lossy and needs pynumpress to be installed.
+COMPRESSION_TYPES = {
+    'zlib': (COMPRESSION_ZLIB, COMPRESSION_ZLIB),
+    'none': (COMPRESSION_NONE, COMPRESSION_NONE),
+    'numpress': (COMPRESSION_NUMPRESS_LINEAR_PREDICTION, COMPRESSION_NUMPRESS_SHORT_LOGGED_FLOAT)
+}
 
 
 class MzmlWriter(object):
     """A class to write peak data to mzML file"""
 
-    def __init__(self, analysis_name, scans, precursor_information=None):
+    def __init__(self, analysis_name, scans, precursor_information=None, compression='zlib'):
         """
         Initialises the mzML writer class.
         :param analysis_name: Name of the analysis.
         :param scans: A dictionary where key is scan level, value is a list of Scans object for that level.
         :param precursor_information: A dictionary where key is Precursor object, value is a list of ms2 scans only
+        :param compression: the compression of the binary arrays, one of the keys of COMPRESSION_TYPES
         """
+        if compression not in COMPRESSION_TYPES:
+            raise ValueError('Unknown compression %s, use one of %s' % (compression, list(COMPRESSION_TYPES.keys())))
+        if compression == 'numpress' and binary_encoding.pynumpress is None:
+            raise ImportError('pynumpress is required for numpress compression')
         self.analysis_name = analysis_name
         self.scans = scans
         self.precursor_information = precursor_information
+        self.compression = compression
 
     def write_mzML(self, out_file):
         # if directory doesn't exist, create it
@@ -31,7 +61,7 @@ class MzmlWriter(object):
             writer.controlled_vocabularies()
 
             # write other fields like sample list, software list, etc.
-            self._write_info(writer)
+            self._write_info(writer, self.scans.keys())
 
             # open the run
             with writer.run(id=self.analysis_name):
@@ -42,14 +72,14 @@ class MzmlWriter(object):
                     tic_rts, tic_intensities = self._get_tic_chromatogram(self.scans)
                     writer.write_chromatogram(tic_rts, tic_intensities, id='tic',
                                               chromatogram_type='total ion current chromatogram',
-                                              time_unit='second')
+                                              time_unit='second', compression=self._get_compression(TIME_ARRAY))
 
         writer.close()
 
-    def _write_info(self, out):
+    def _write_info(self, out, ms_levels):
         # check file contains what kind of spectra
-        has_ms1_spectrum = 1 in self.scans
-        has_msn_spectrum = 1 in self.scans and len(self.scans) > 1
+        has_ms1_spectrum = 1 in ms_levels
+        has_msn_spectrum = 1 in ms_levels and len(ms_levels) > 1
         file_contents = [
             'centroid spectrum'
         ]
@@ -131,7 +161,7 @@ class MzmlWriter(object):
         scan_id = scan.scan_id
 
         out.write_spectrum(
-            scan.mzs, scan.intensities,
+            np.ravel(scan.mzs), np.ravel(scan.intensities),  # MS2 intensities may be column vectors
             id=scan_id,
             centroided=True,
             scan_start_time=scan.rt / 60.0,
@@ -145,9 +175,21 @@ class MzmlWriter(object):
                 # {'base peak m/z', bp_mz},
                 # {'base peak intensity', bp_intensity}
             ],
-            precursor_information=precursor_information
+            precursor_information=precursor_information,
+            compression=self._get_compression(MZ_ARRAY)
         )
 
+    def _get_compression(self, x_array):
+        """
+        Returns the psims compression of the arrays of a spectrum or chromatogram
+        :param x_array: the type of the first array, MZ_ARRAY for spectra or TIME_ARRAY for chromatograms
+        :return: a psims compression, or a dictionary of array type to compression
+        """
+        x_compression, intensity_compression = COMPRESSION_TYPES[self.compression]
+        if x_compression == intensity_compression:
+            return x_compression
+        return {x_array: x_compression, INTENSITY_ARRAY: intensity_compression}
+
     def _get_tic_chromatogram(self, scans):
         time_array = []
         intensity_array = []
@@ -157,3 +199,265 @@ class MzmlWriter(object):
         time_array = np.array(time_array)
         intensity_array = np.array(intensity_array)
         return time_array, intensity_array
+
+
+class StreamingMzmlWriter(MzmlWriter):
+    """
+    Writes scans to an mzML file one at a time while the simulation runs, so memory use doesn't grow with the run
+    and a partial file exists if the run is interrupted. The TIC chromatogram and the index are written by close().
+    Files left unclosed by a crash can be turned into valid mzML files by recover_mzml().
+    """
+
+    def __init__(self, analysis_name, out_file, ms_levels=(1, 2), flush_every=1, compression='zlib'):
+        """
+        Initialises the streaming mzML writer class.
+        :param analysis_name: Name of the analysis.
+        :param out_file: the output mzML file
+        :param ms_levels: the ms levels of the scans that will be written, used to describe the file contents
+        :param flush_every: the number of scans between flushes of the file to disk
+        :param compression: the compression of the binary arrays, one of the keys of COMPRESSION_TYPES
+        """
+        super().__init__(analysis_name, {ms_level: [] for ms_level in ms_levels}, compression=compression)
+        self.out_file = str(out_file)
+        self.flush_every = flush_every
+        self.out_handle = None
+        self.writer = None
+        self.run_section = None
+        self.spectrum_list_section = None
+        self.spectrum_count = 0
+        self.tic_rts = []
+        self.tic_intensities = []
+
+    def open(self):
+        """
+        Creates the output file and writes everything up to the start of the spectrum list
+        :return: None
+        """
+        create_if_not_exist(os.path.dirname(self.out_file))
+        self.out_handle = open(self.out_file, 'wb')
+        self.writer = PsimsMzMLWriter(self.out_handle)
+        self.writer.begin()
+        self.writer.controlled_vocabularies()
+        self._write_info(self.writer, self.scans.keys())
+        self.run_section = self.writer.run(id=self.analysis_name)
+        self.run_section.begin()
+        self.spectrum_list_section = self.writer.spectrum_list(count=SPECTRUM_COUNT_PLACEHOLDER)
+        self.spectrum_list_section.begin()
+        self.spectrum_count = 0
+        self.tic_rts = []
+        self.tic_intensities = []
+        self._flush()
+
+    def write_scan(self, scan):
+        """
+        Writes a scan to the file. Scans should be written in the order of their scan ids.
+        :param scan: the scan
+        :return: None
+        """
+        if scan.num_peaks == 0:
+            # like sort_filter, add a single peak to empty scans, but without modifying the scan itself
+            scan = copy.copy(scan)
+            scan.mzs = np.array([100.0])
+            scan.intensities = np.array([1.0])
+            scan.num_peaks = 1
+        precursor = None
+        if scan.ms_level >= 2 and scan.scan_params is not None:
+            precursor = scan.scan_params.get(ScanParameters.PRECURSOR_MZ)
+        self._write_scan(self.writer, scan, precursor)
+
+        self.spectrum_count += 1
+        if scan.ms_level == 1:
+            self.tic_rts.append(scan.rt)
+            self.tic_intensities.append(np.sum(scan.intensities))
+        if self.spectrum_count % self.flush_every == 0:
+            self._flush()
+
+    def close(self):
+        """
+        Writes the TIC chromatogram and the index, closes the file and sets the final spectrum count
+        :return: None
+        """
+        if self.writer is None:
+            return
+        writer = self.writer
+        self.writer = None
+        self.spectrum_list_section.end()
+        with writer.chromatogram_list(count=1):
+            writer.write_chromatogram(np.array(self.tic_rts), np.array(self.tic_intensities), id='tic',
+                                      chromatogram_type='total ion current chromatogram', time_unit='second',
+                                      compression=self._get_compression(TIME_ARRAY))
+        self.run_section.end()
+        writer.end()
+        writer.close()
+        self.out_handle = None
+        _set_spectrum_count(self.out_file, self.spectrum_count, update_checksum=True)
+
+    def _flush(self):
+        # each layer only writes its buffer to the next one, down to the file: lxml's buffer, the buffer of the psims
+        # indexing stream, and the buffer of the file itself
+        self.writer.flush()
+        self.writer.outfile.flush()
+        self.out_handle.flush()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BackgroundMzmlWriter(StreamingMzmlWriter):
+    """
+    A StreamingMzmlWriter that encodes, compresses and writes spectra in a background thread, so the simulation
+    thread only hands scans over. Scans wait in a bounded queue: if the encoder falls behind, the simulation waits
+    instead of buffering the whole run in memory.
+    """
+
+    def __init__(self, analysis_name, out_file, ms_levels=(1, 2), flush_every=100, compression='zlib',
+                 queue_size=100):
+        """
+        Initialises the background mzML writer class.
+        Parameters are the same as in StreamingMzmlWriter, with the addition of:
+        :param queue_size: the maximum number of scans waiting to be written
+        """
+        super().__init__(analysis_name, out_file, ms_levels=ms_levels, flush_every=flush_every,
+                         compression=compression)
+        self.queue_size = queue_size
+        self.queue = None
+        self.thread = None
+        self.error = None
+
+    def open(self):
+        super().open()
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._encoder_loop, name='mzML encoder', daemon=True)
+        self.thread.start()
+
+    def write_scan(self, scan):
+        """
+        Queues a scan to be written, waiting if the queue is full
+        :param scan: the scan
+        :return: None
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(scan)
+
+    def close(self):
+        """
+        Waits for the queued scans to be written, then closes the file as in StreamingMzmlWriter
+        :return: None
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        super().close()
+        if self.error is not None:
+            raise self.error
+
+    def _encoder_loop(self):
+        while True:
+            scan = self.queue.get()
+            if scan is None:
+                return
+            if self.error is None:  # after an error, keep emptying the queue so the simulation never blocks
+                try:
+                    super().write_scan(scan)
+                except Exception as e:
+                    logger.warning('Failed to write scan %s: %s' % (scan.scan_id, str(e)))
+                    self.error = e
+
+
+def recover_mzml(partial_file, out_file):
+    """
+    Turns a streamed mzML file that was never closed, e.g. because the simulation crashed, into a valid mzML file
+    containing all the spectra that were completely written. The recovered file has no index or chromatogram.
+    :param partial_file: the file left by StreamingMzmlWriter
+    :param out_file: the recovered mzML file
+    :return: the number of recovered spectra
+    """
+    end_tag = b'</spectrum>'
+    chunk_size = 1 << 20
+    size = os.path.getsize(partial_file)
+
+    # find the end of the last complete spectrum, reading backwards from the end of the file
+    last_end = None
+    with open(partial_file, 'rb') as f:
+        pos = size
+        while pos > 0 and last_end is None:
+            start = max(0, pos - chunk_size)
+            f.seek(start)
+            chunk = f.read(min(pos + len(end_tag), size) - start)
+            found = chunk.rfind(end_tag)
+            if found >= 0:
+                last_end = start + found + len(end_tag)
+            pos = start
+    if last_end is None:
+        raise ValueError('No complete spectrum found in %s' % partial_file)
+
+    count = 0
+    create_if_not_exist(os.path.dirname(str(out_file)))
+    with open(partial_file, 'rb') as f_in, open(out_file, 'wb') as f_out:
+        # the streamed file is an indexed mzML file, drop its <indexedmzML> wrapper to write a plain mzML file
+        header = f_in.read(min(chunk_size, last_end))
+        match = re.search(rb'<indexedmzML[^>]*>\s*', header)
+        if match is not None:
+            header = header[:match.start()] + header[match.end():]
+        f_out.write(header)
+        remaining = last_end - f_in.tell()
+        count += header.count(b'<spectrum ')
+        tail = header[-len(b'<spectrum '):]
+        while remaining > 0:
+            chunk = f_in.read(min(chunk_size, remaining))
+            remaining -= len(chunk)
+            # spectrum tags may be split across chunks
+            count += (tail + chunk).count(b'<spectrum ') - tail.count(b'<spectrum ')
+            tail = chunk[-len(b'<spectrum '):]
+            f_out.write(chunk)
+        f_out.write(b'\n      </spectrumList>\n    </run>\n  </mzML>\n')
+    _set_spectrum_count(out_file, count, update_checksum=False)
+    logger.debug('Recovered %d spectra from %s' % (count, partial_file))
+    return count
+
+
+def _set_spectrum_count(filename, count, update_checksum):
+    """
+    Overwrites the spectrum count placeholder written by StreamingMzmlWriter, and optionally the file checksum that
+    covers it
+    :param filename: the mzML file
+    :param count: the number of spectra
+    :param update_checksum: True to also recompute the checksum of an indexed mzML file
+    :return: None
+    """
+    placeholder = ('<spectrumList count="%s"' % SPECTRUM_COUNT_PLACEHOLDER).encode('utf-8')
+    value = ('<spectrumList count="%d"' % count).ljust(len(placeholder)).encode('utf-8')
+    assert len(value) == len(placeholder)
+    with open(filename, 'r+b') as f:
+        # the spectrum list starts after the header, which is small
+        header = f.read(1 << 20)
+        pos = header.find(placeholder)
+        if pos < 0:
+            raise ValueError('No spectrum count placeholder found in %s' % filename)
+        f.seek(pos)
+        f.write(value)
+
+        if update_checksum:
+            # the checksum covers the file up to and including the <fileChecksum> tag
+            tag = b'<fileChecksum>'
+            f.seek(max(0, os.path.getsize(filename) - 1024))
+            tail_start = f.tell()
+            tail = f.read()
+            checksum_pos = tail_start + tail.rfind(tag) + len(tag)
+            f.seek(0)
+            sha1 = hashlib.sha1()
+            remaining = checksum_pos
+            while remaining > 0:
+                chunk = f.read(min(1 << 20, remaining))
+                sha1.update(chunk)
+                remaining -= len(chunk)
+            f.seek(checksum_pos)
+            f.write(sha1.hexdigest().encode('utf-8'))
@@ -0,0 +1,209 @@
+# Helpers to run independent jobs in a local process pool
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import traceback
+import weakref
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from loguru import logger
+from tqdm import tqdm
+
+# objects published by SharedObjectStore, loaded once per worker process. Key: file path, value: the loaded object
+_worker_objects = {}
+
+# pickle protocol 5 passes contiguous buffers such as numpy arrays out-of-band, so they can be stored raw
+BUFFER_PROTOCOL = 5
+BUFFER_ALIGNMENT = 64
+
+
+class SharedRef(object):
+    """
+    A small placeholder for a published object, sent to workers instead of the object itself
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def resolve(self):
+        """
+        Returns the published object, loading it from its memory-mapped file the first time it's seen by this process
+        :return: the published object
+        """
+        try:
+            return _worker_objects[self.path]
+        except KeyError:
+            obj = load_shared_file(self.path)
+            _worker_objects[self.path] = obj
+            return obj
+
+    def __repr__(self):
+        return 'SharedRef %s' % self.path
+
+
+class SharedObjectStore(object):
+    """
+    Publishes large read-only objects (chemical datasets, peak samplers) once to files in a temporary directory, so
+    jobs only need to carry small SharedRefs. The numpy arrays in an object are written raw to a separate file, which
+    workers memory-map copy-on-write: the arrays are rebuilt as views of the mapping, so their memory is shared by all
+    the workers on the machine until a worker writes to them. The rest of the object is unpickled once per worker.
+    Use it as a context manager, or call close(), to delete the files; they are also deleted when the store is
+    garbage collected or at exit.
+    """
+
+    def __init__(self, tmp_dir=None):
+        """
+        Creates an empty store
+        :param tmp_dir: the parent directory to create the store in. Defaults to the system temporary directory.
+        """
+        self.store_dir = tempfile.mkdtemp(prefix='vimms_shared_', dir=tmp_dir)
+        self.refs = {}  # key: id of the published object, value: (object, SharedRef)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.store_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def publish(self, obj):
+        """
+        Publishes an object. Publishing the same object again returns the existing reference.
+        :param obj: the object to publish
+        :return: a SharedRef to the object
+        """
+        try:
+            return self.refs[id(obj)][1]
+        except KeyError:
+            path = os.path.join(self.store_dir, 'object_%d.p' % len(self.refs))
+            write_shared_file(obj, path)
+            ref = SharedRef(path)
+            self.refs[id(obj)] = (obj, ref)  # keep obj alive so its id can't be reused
+            return ref
+
+    def publish_values(self, d, keys):
+        """
+        Returns a copy of a dictionary where the values of the selected keys have been published
+        :param d: a dictionary, e.g. experimental parameters
+        :param keys: the keys whose values should be published
+        :return: a new dictionary where the selected values are replaced by SharedRefs
+        """
+        published = dict(d)
+        for key in keys:
+            if key in published and published[key] is not None:
+                published[key] = self.publish(published[key])
+        return published
+
+    def close(self):
+        """
+        Deletes all the published files
+        :return: None
+        """
+        self._finalizer()
+        self.refs = {}
+
+
+class JobResult(object):
+    """
+    The outcome of a single job run by run_jobs
+    """
+
+    def __init__(self, index, result=None, error=None):
+        """
+        Creates a job result
+        :param index: the position of the job in the submitted list
+        :param result: the value returned by the job, if it succeeded
+        :param error: the formatted exception, if it failed
+        """
+        self.index = index
+        self.result = result
+        self.error = error
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        return 'JobResult %d success=%s' % (self.index, self.success)
+
+
+def write_shared_file(obj, path):
+    """
+    Pickles an object to a file, and the buffers of its numpy arrays to path + '.buffers', each aligned to
+    BUFFER_ALIGNMENT bytes
+    :param obj: the object to write
+    :param path: the file to write the pickled object to
+    :return: None
+    """
+    buffers = []
+    if pickle.HIGHEST_PROTOCOL >= BUFFER_PROTOCOL:
+        data = pickle.dumps(obj, protocol=BUFFER_PROTOCOL, buffer_callback=buffers.append)
+    else:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    extents = []
+    with open(path + '.buffers', 'wb') as f:
+        for buffer in buffers:
+            raw = buffer.raw()
+            f.write(b'\0' * (-f.tell() % BUFFER_ALIGNMENT))
+            extents.append((f.tell(), raw.nbytes))
+            f.write(raw)
+    with open(path, 'wb') as f:
+        pickle.dump((data, extents), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_shared_file(path):
+    """
+    Loads an object written by write_shared_file. Its numpy arrays are views of a copy-on-write memory mapping of
+    the buffers file, so they are only read from disk, and only copied, when they are used or written to.
+    :param path: the file written by SharedObjectStore
+    :return: the loaded object
+    """
+    with open(path, 'rb') as f:
+        data, extents = pickle.load(f)
+    if len(extents) == 0:
+        return pickle.loads(data)
+    if all(nbytes == 0 for _, nbytes in extents):  # an empty buffers file can't be memory-mapped
+        return pickle.loads(data, buffers=[memoryview(bytearray()) for _ in extents])
+    with open(path + '.buffers', 'rb') as f:
+        # the mapping stays open for as long as the arrays that view it are alive
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+    return pickle.loads(data, buffers=[view[offset:offset + nbytes] for offset, nbytes in extents])
+
+
+def resolve_shared(value):
+    """
+    Resolves SharedRefs to their objects, leaving any other value untouched
+    """
+    return value.resolve() if isinstance(value, SharedRef) else value
+
+
+def run_jobs(func, jobs, max_workers=None, progress_bar=True, desc=None):
+    """
+    Runs func(job) for each job in a local process pool.
+    A failing job doesn't stop the others: its exception is recorded in its JobResult.
+    :param func: a picklable (module-level) function that takes a single job
+    :param jobs: a list of jobs, e.g. parameter dictionaries. Large shared values should be SharedRefs.
+    :param max_workers: the maximum number of worker processes, defaults to the number of CPUs
+    :param progress_bar: True if a progress bar is to be shown
+    :param desc: description shown on the progress bar
+    :return: a list of JobResult, in the same order as jobs
+    """
+    results = [None] * len(jobs)
+    bar = tqdm(total=len(jobs), desc=desc) if progress_bar else None
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(func, job): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = JobResult(i, result=future.result())
+            except Exception as e:
+                error = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+                logger.warning('Job %d failed: %s' % (i, str(e)))
+                results[i] = JobResult(i, error=error)
+            if bar is not None:
+                bar.update(1)
+    if bar is not None:
+        bar.close()
+    return results
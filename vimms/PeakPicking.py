@@ -3,6 +3,7 @@ from scipy.optimize import minimize
 from pyDOE import *
 
 from vimms.BOMAS import GetScaledValues
+from vimms.Kernels import mixture_log_likelihoods
 
 
 PARAM_RANGE_N0 = [[0, 250]]
@@ -86,8 +87,9 @@ class SMC_MSmixture(object):
 
     def _get_weights(self):
         # get posteriors
-        weights = [MSmixture_posterior(self.current_particles[i], self.y, self.t, self.n_mixtures, neg_like=False) for i in
-                   range(self.n_particles)]
+        particles = np.asarray(self.current_particles, dtype=np.double).reshape(self.n_particles, -1)
+        weights = mixture_log_likelihoods(particles, np.asarray(self.y, dtype=np.double),
+                                          np.asarray(self.t, dtype=np.double), self.n_mixtures == 1)
         updated_weights = np.exp(np.array(weights) - np.array(weights).max())
         # re weight
         normalised_weights = np.exp(updated_weights) / sum(np.exp(updated_weights))
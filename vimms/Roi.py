@@ -13,6 +13,7 @@ from scipy.stats import pearsonr
 from vimms.Chemicals import ChemicalCreator, UnknownChemical, GET_MS2_BY_PEAKS
 from vimms.Chromatograms import EmpiricalChromatogram
 from vimms.Common import PROTON_MASS, CHEM_NOISE, save_obj
+from vimms.Kernels import roi_assign, greedy_cluster_labels
 
 POS_TRANSFORMATIONS = OrderedDict()
 POS_TRANSFORMATIONS['M+H'] = lambda mz: (mz + PROTON_MASS)
@@ -174,6 +175,37 @@ def match(mz, roi_list, mz_tol, mz_units='Da'):
             return None
 
 
+def update_roi(live_roi, mzs, rt, intensities, mz_tol, mz_units='Da'):
+    """
+    Adds the peaks of an MS1 scan to the live ROI. Each peak is matched with match() in turn and added to the
+    matched ROI, or starts a new ROI inserted in order into the live ROI list.
+    :param live_roi: the list of live ROI, sorted by mean m/z at the start of the scan
+    :param mzs: the m/z values of the peaks to add
+    :param rt: the retention time of the scan
+    :param intensities: the intensities of the peaks to add
+    :param mz_tol: the m/z tolerance
+    :param mz_units: the units of mz_tol, 'Da' or 'ppm'
+    :return: a tuple of the updated live ROI list and, for each of its ROI, its position in the original list or
+    None if it's a new ROI
+    """
+    n_roi = len(live_roi)
+    roi_sums = np.array([roi.mz_sum for roi in live_roi], dtype=np.double)
+    roi_counts = np.array([roi.n for roi in live_roi], dtype=np.int64)
+    assigned, order = roi_assign(np.asarray(mzs, dtype=np.double), roi_sums, roi_counts, mz_tol, mz_units == 'ppm')
+
+    new_roi = {}
+    for mz, intensity, roi_id in zip(mzs, intensities, assigned):
+        if roi_id < n_roi:
+            live_roi[roi_id].add(mz, rt, intensity)
+        elif roi_id in new_roi:
+            new_roi[roi_id].add(mz, rt, intensity)
+        else:
+            new_roi[roi_id] = Roi(mz, rt, intensity)
+    updated_roi = [live_roi[roi_id] if roi_id < n_roi else new_roi[roi_id] for roi_id in order]
+    positions = [int(roi_id) if roi_id < n_roi else None for roi_id in order]
+    return updated_roi, positions
+
+
 def roi_correlation(roi1, roi2, min_rt_point_overlap=5, method='pearson'):
     # flip around so that roi1 starts earlier (or equal)
     if roi2.rt_list[0] < roi1.rt_list[0]:
@@ -253,16 +285,12 @@ def make_roi(input_file, mz_tol=0.001, mz_units='Da', min_length=10, min_intensi
 
             # print current_ms1_scan_rt
             # print spectrum.peaks
-            not_grew = set(live_roi)
-            for mz, intensity in spectrum.peaks('raw'):
-                if intensity >= min_intensity:
-                    match_roi = match(Roi(mz, 0, 0), live_roi, mz_tol, mz_units=mz_units)
-                    if match_roi:
-                        match_roi.add(mz, current_ms1_scan_rt, intensity)
-                        if match_roi in not_grew:
-                            not_grew.remove(match_roi)
-                    else:
-                        bisect.insort_right(live_roi, Roi(mz, current_ms1_scan_rt, intensity))
+            n_points = {roi: roi.n for roi in live_roi}
+            peaks = [(mz, intensity) for mz, intensity in spectrum.peaks('raw') if intensity >= min_intensity]
+            mzs = [mz for mz, _ in peaks]
+            intensities = [intensity for _, intensity in peaks]
+            live_roi, _ = update_roi(live_roi, mzs, current_ms1_scan_rt, intensities, mz_tol, mz_units=mz_units)
+            not_grew = set(roi for roi in n_points if roi.n == n_points[roi])
 
             for roi in not_grew:
                 if roi.n >= min_length:
@@ -289,20 +317,19 @@ def greedy_roi_cluster(roi_list, corr_thresh=0.75, corr_type='cosine'):
     # sort in descending intensity
     roi_list_copy = [r for r in roi_list]
     roi_list_copy.sort(key=lambda x: max(x.intensity_list), reverse=True)
-    roi_clusters = []
-    while len(roi_list_copy) > 0:
-        roi_clusters.append([roi_list_copy[0]])
-        remove_idx = [0]
-        if len(roi_list_copy) > 1:
-            for i, r in enumerate(roi_list_copy[1:]):
-                corr = roi_correlation(roi_list_copy[0], r)
-                if corr > corr_thresh:
-                    roi_clusters[-1].append(r)
-                    remove_idx.append(i + 1)
-        remove_idx.sort(reverse=True)
-        for r in remove_idx:
-            del roi_list_copy[r]
-
+    if len(roi_list_copy) == 0:
+        return []
+
+    # clusters are built by a kernel on the concatenated rt and intensity lists, with the pearson correlation as
+    # computed by roi_correlation
+    offsets = np.cumsum([0] + [len(r.rt_list) for r in roi_list_copy])
+    rts = np.concatenate([r.rt_list for r in roi_list_copy]).astype(np.double)
+    intensities = np.concatenate([r.intensity_list for r in roi_list_copy]).astype(np.double)
+    labels = greedy_cluster_labels(rts, intensities, offsets, corr_thresh, True)
+
+    roi_clusters = [[] for _ in range(labels.max() + 1)]
+    for r, label in zip(roi_list_copy, labels):
+        roi_clusters[label].append(r)
     return roi_clusters
 
 
@@ -0,0 +1,374 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from vimms.Common import create_if_not_exist
+from vimms.Controller import Precursor
+from vimms.MassSpec import Scan, ScanParameters
+from vimms.MzmlWriter import StreamingMzmlWriter
+
+STORE_VERSION = 1
+
+# files of a scan store directory
+HEADER_FILE = 'header.json'  # written last, so a store without it is incomplete
+MZS_FILE = 'mzs.bin'  # the m/z values of all scans, one after the other, as float64
+INTENSITIES_FILE = 'intensities.bin'  # the intensities of all scans, as float64
+SCANS_FILE = 'scans.npz'  # the scan metadata table, one entry per scan
+PARAMS_FILE = 'params.json'  # the distinct scan parameters, referred to by the param_index column
+
+
+class ScanStoreWriter(object):
+    """
+    Writes a simulated run in a columnar format: the peaks of all scans are appended to flat binary arrays that can be
+    memory-mapped by ScanStore, and the scan metadata (retention time, ms level, precursor, isolation windows,
+    parameters) is kept in a table. Scans are written one at a time, so the whole run never needs to be in memory.
+    """
+
+    def __init__(self, path, analysis_name='my_analysis'):
+        """
+        Creates a scan store writer
+        :param path: the directory to write the store to
+        :param analysis_name: the analysis name, used when the store is exported to mzML
+        """
+        self.path = str(path)
+        self.analysis_name = analysis_name
+        self.mzs_file = None
+        self.intensities_file = None
+
+    def open(self):
+        """
+        Creates the store directory and starts writing
+        :return: None
+        """
+        create_if_not_exist(self.path)
+        header_file = os.path.join(self.path, HEADER_FILE)
+        if os.path.exists(header_file):
+            os.remove(header_file)
+        self.mzs_file = open(os.path.join(self.path, MZS_FILE), 'wb')
+        self.intensities_file = open(os.path.join(self.path, INTENSITIES_FILE), 'wb')
+        self.n_peaks = 0
+        self.columns = {
+            'offsets': [0],
+            'scan_id': [],
+            'rt': [],
+            'ms_level': [],
+            'scan_duration': [],
+            'precursor_mz': [],
+            'precursor_intensity': [],
+            'precursor_charge': [],
+            'precursor_scan_id': [],
+            'window_offsets': [0],
+            'windows': [],
+            'param_index': []
+        }
+        self.params = []  # the distinct scan parameters, as json-compatible dictionaries
+        self.params_index = {}  # key: json string of the parameters, value: index in self.params
+
+    def write_scan(self, scan):
+        """
+        Appends a scan to the store. Peaks are stored as flat arrays, so intensities that aren't 1-D, e.g. the column
+        vectors of some simulated MS2 scans, are read back by ScanStore as 1-D arrays of the same values.
+        :param scan: the scan
+        :return: None
+        """
+        mzs = np.asarray(scan.mzs, dtype=np.float64).ravel()
+        intensities = np.asarray(scan.intensities, dtype=np.float64).ravel()
+        mzs.tofile(self.mzs_file)
+        intensities.tofile(self.intensities_file)
+        self.n_peaks += len(mzs)
+
+        columns = self.columns
+        columns['offsets'].append(self.n_peaks)
+        columns['scan_id'].append(scan.scan_id)
+        columns['rt'].append(scan.rt)
+        columns['ms_level'].append(scan.ms_level)
+        columns['scan_duration'].append(np.nan if scan.scan_duration is None else scan.scan_duration)
+
+        params = scan.scan_params
+        precursor = params.get(ScanParameters.PRECURSOR_MZ) if params is not None else None
+        if precursor is not None:
+            columns['precursor_mz'].append(precursor.precursor_mz)
+            columns['precursor_intensity'].append(precursor.precursor_intensity)
+            columns['precursor_charge'].append(precursor.precursor_charge)
+            columns['precursor_scan_id'].append(precursor.precursor_scan_id)
+        else:
+            columns['precursor_mz'].append(np.nan)
+            columns['precursor_intensity'].append(np.nan)
+            columns['precursor_charge'].append(0)
+            columns['precursor_scan_id'].append(-1)
+
+        for level, windows in enumerate(_get_isolation_windows(params)):
+            for mz_lower, mz_upper in windows:
+                columns['windows'].append((level + 1, mz_lower, mz_upper))
+        columns['window_offsets'].append(len(columns['windows']))
+        columns['param_index'].append(self._get_param_index(params))
+
+    def write_scans(self, scans):
+        """
+        Appends scans to the store, in the order of their scan ids
+        :param scans: a dictionary where key is scan level, value is a list of Scans object for that level,
+        e.g. controller.scans
+        :return: None
+        """
+        all_scans = [scan for ms_level in scans for scan in scans[ms_level]]
+        for scan in sorted(all_scans, key=lambda x: x.scan_id):
+            self.write_scan(scan)
+
+    def close(self):
+        """
+        Writes the scan metadata table and the header
+        :return: None
+        """
+        if self.mzs_file is None:
+            return
+        self.mzs_file.close()
+        self.intensities_file.close()
+        self.mzs_file = None
+        self.intensities_file = None
+
+        columns = self.columns
+        windows = np.array(columns['windows'], dtype=np.float64).reshape(-1, 3)
+        np.savez(os.path.join(self.path, SCANS_FILE),
+                 offsets=np.array(columns['offsets'], dtype=np.int64),
+                 scan_id=np.array(columns['scan_id'], dtype=np.int64),
+                 rt=np.array(columns['rt'], dtype=np.float64),
+                 ms_level=np.array(columns['ms_level'], dtype=np.int32),
+                 scan_duration=np.array(columns['scan_duration'], dtype=np.float64),
+                 precursor_mz=np.array(columns['precursor_mz'], dtype=np.float64),
+                 precursor_intensity=np.array(columns['precursor_intensity'], dtype=np.float64),
+                 precursor_charge=np.array(columns['precursor_charge'], dtype=np.int32),
+                 precursor_scan_id=np.array(columns['precursor_scan_id'], dtype=np.int64),
+                 window_offsets=np.array(columns['window_offsets'], dtype=np.int64),
+                 window_levels=windows[:, 0].astype(np.int32),
+                 windows=np.ascontiguousarray(windows[:, 1:]),
+                 param_index=np.array(columns['param_index'], dtype=np.int64))
+        with open(os.path.join(self.path, PARAMS_FILE), 'w') as f:
+            json.dump(self.params, f)
+        header = {
+            'version': STORE_VERSION,
+            'analysis_name': self.analysis_name,
+            'n_scans': len(columns['scan_id']),
+            'n_peaks': self.n_peaks
+        }
+        with open(os.path.join(self.path, HEADER_FILE), 'w') as f:
+            json.dump(header, f)
+        logger.debug('Stored %d scans in %s' % (header['n_scans'], self.path))
+
+    def _get_param_index(self, params):
+        if params is None:
+            return -1
+        values = {key: _to_json_value(value) for key, value in params.params.items()
+                  if key != ScanParameters.PRECURSOR_MZ}
+        key = json.dumps(values, sort_keys=True)
+        try:
+            return self.params_index[key]
+        except KeyError:
+            self.params.append(values)
+            self.params_index[key] = len(self.params) - 1
+            return self.params_index[key]
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ScanStore(object):
+    """
+    Reads a run written by ScanStoreWriter. The peak arrays are memory-mapped, so opening a store is fast whatever its
+    size, and the metadata columns can be used directly with numpy, e.g. store.rt[store.ms_level == 2].
+    """
+
+    def __init__(self, path, mmap=True):
+        """
+        Opens a scan store
+        :param path: the store directory
+        :param mmap: True to memory-map the peak arrays, False to load them in memory
+        """
+        self.path = str(path)
+        header_file = os.path.join(self.path, HEADER_FILE)
+        if not os.path.exists(header_file):
+            raise ValueError('%s is not a complete scan store' % self.path)
+        with open(header_file) as f:
+            self.header = json.load(f)
+        if self.header['version'] > STORE_VERSION:
+            raise ValueError('Unsupported scan store version %d' % self.header['version'])
+        with open(os.path.join(self.path, PARAMS_FILE)) as f:
+            self.params = json.load(f)
+
+        with np.load(os.path.join(self.path, SCANS_FILE)) as table:
+            self.offsets = table['offsets']
+            self.scan_id = table['scan_id']
+            self.rt = table['rt']
+            self.ms_level = table['ms_level']
+            self.scan_duration = table['scan_duration']
+            self.precursor_mz = table['precursor_mz']
+            self.precursor_intensity = table['precursor_intensity']
+            self.precursor_charge = table['precursor_charge']
+            self.precursor_scan_id = table['precursor_scan_id']
+            self.window_offsets = table['window_offsets']
+            self.window_levels = table['window_levels']
+            self.windows = table['windows']
+            self.param_index = table['param_index']
+        self.mzs = self._load_array(MZS_FILE, mmap)
+        self.intensities = self._load_array(INTENSITIES_FILE, mmap)
+
+    @property
+    def analysis_name(self):
+        return self.header['analysis_name']
+
+    def __len__(self):
+        return self.header['n_scans']
+
+    def get_peaks(self, i):
+        """
+        Returns the peaks of a scan, without copying them
+        :param i: the position of the scan in the store
+        :return: a tuple of the m/z and intensity arrays of the scan
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mzs[start:end], self.intensities[start:end]
+
+    def get_isolation_windows(self, i):
+        """
+        Returns the isolation windows of a scan, in the nested format of ScanParameters.ISOLATION_WINDOWS
+        :param i: the position of the scan in the store
+        :return: a list of lists of (lower m/z, upper m/z) tuples, one list per ms level
+        """
+        start, end = self.window_offsets[i], self.window_offsets[i + 1]
+        n_levels = self.window_levels[start:end].max() if end > start else 0
+        isolation_windows = [[] for _ in range(n_levels)]
+        for level, (mz_lower, mz_upper) in zip(self.window_levels[start:end], self.windows[start:end]):
+            isolation_windows[level - 1].append((float(mz_lower), float(mz_upper)))
+        return isolation_windows
+
+    def get_scan(self, i):
+        """
+        Rebuilds a scan with its parameters and precursor
+        :param i: the position of the scan in the store
+        :return: the scan
+        """
+        mzs, intensities = self.get_peaks(i)
+        scan_params = None
+        if self.param_index[i] >= 0:
+            scan_params = ScanParameters()
+            for key, value in self.params[self.param_index[i]].items():
+                if key == ScanParameters.ISOLATION_WINDOWS and value is not None:
+                    value = [[tuple(window) for window in windows] for windows in value]
+                scan_params.set(key, value)
+            if self.precursor_scan_id[i] >= 0:
+                precursor = Precursor(precursor_mz=float(self.precursor_mz[i]),
+                                      precursor_intensity=float(self.precursor_intensity[i]),
+                                      precursor_charge=int(self.precursor_charge[i]),
+                                      precursor_scan_id=int(self.precursor_scan_id[i]))
+                scan_params.set(ScanParameters.PRECURSOR_MZ, precursor)
+        scan_duration = None if np.isnan(self.scan_duration[i]) else float(self.scan_duration[i])
+        return Scan(int(self.scan_id[i]), np.array(mzs), np.array(intensities), int(self.ms_level[i]),
+                    float(self.rt[i]), scan_duration=scan_duration, scan_params=scan_params)
+
+    def select(self, ms_level=None, min_rt=None, max_rt=None):
+        """
+        Finds the scans matching some criteria
+        :param ms_level: the ms level of the scans, or None for all levels
+        :param min_rt: the minimum retention time, or None
+        :param max_rt: the maximum retention time, or None
+        :return: an array of the positions of the matching scans
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if ms_level is not None:
+            keep &= self.ms_level == ms_level
+        if min_rt is not None:
+            keep &= self.rt >= min_rt
+        if max_rt is not None:
+            keep &= self.rt <= max_rt
+        return np.nonzero(keep)[0]
+
+    def iter_scans(self, ms_level=None):
+        """
+        Rebuilds the scans one at a time
+        :param ms_level: the ms level of the scans, or None for all levels
+        :return: a generator of scans
+        """
+        for i in self.select(ms_level=ms_level):
+            yield self.get_scan(i)
+
+    def to_scans(self):
+        """
+        Rebuilds all the scans
+        :return: a dictionary where key is scan level, value is a list of Scans object for that level, as in
+        controller.scans
+        """
+        scans = {}
+        for scan in self.iter_scans():
+            scans.setdefault(scan.ms_level, []).append(scan)
+        return scans
+
+    def write_mzML(self, out_file, analysis_name=None, compression='zlib'):
+        """
+        Exports the run to an mzML file, one scan at a time
+        :param out_file: the output mzML file
+        :param analysis_name: the analysis name stored in the mzML file, defaults to the one of the store
+        :param compression: the compression of the binary arrays, one of the keys of MzmlWriter.COMPRESSION_TYPES
+        :return: None
+        """
+        if analysis_name is None:
+            analysis_name = self.analysis_name
+        ms_levels = sorted(set(self.ms_level.tolist()))
+        logger.debug('Writing mzML file to %s' % out_file)
+        with StreamingMzmlWriter(analysis_name, Path(out_file), ms_levels=ms_levels, flush_every=1000,
+                                 compression=compression) as writer:
+            for scan in self.iter_scans():
+                writer.write_scan(scan)
+        logger.debug('mzML file successfully written!')
+
+    def _load_array(self, filename, mmap):
+        path = os.path.join(self.path, filename)
+        n_peaks = self.header['n_peaks']
+        if n_peaks == 0:
+            return np.empty(0, dtype=np.float64)
+        elif mmap:
+            return np.memmap(path, dtype=np.float64, mode='r', shape=(n_peaks,))
+        else:
+            return np.fromfile(path, dtype=np.float64, count=n_peaks)
+
+
+def save_scans(path, scans, analysis_name='my_analysis'):
+    """
+    Writes scans to a new scan store
+    :param path: the store directory
+    :param scans: a dictionary where key is scan level, value is a list of Scans object for that level,
+    e.g. controller.scans
+    :param analysis_name: the analysis name, used when the store is exported to mzML
+    :return: None
+    """
+    with ScanStoreWriter(path, analysis_name=analysis_name) as writer:
+        writer.write_scans(scans)
+
+
+def _get_isolation_windows(params):
+    # the isolation windows used to generate a scan, as in IndependentMassSpectrometer._get_scan
+    if params is None:
+        return []
+    isolation_windows = params.get(ScanParameters.ISOLATION_WINDOWS)
+    if isolation_windows is None and params.get(ScanParameters.PRECURSOR_MZ) is not None:
+        isolation_windows = params.compute_isolation_windows()
+    return isolation_windows if isolation_windows is not None else []
+
+
+def _to_json_value(value):
+    # converts scan parameter values to types that can be written to json
+    if isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json_value(v) for v in value]
+    elif isinstance(value, dict):
+        return {str(k): _to_json_value(v) for k, v in value.items()}
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    else:
+        return str(value)
@@ -0,0 +1,147 @@
+import time
+from collections import defaultdict
+
+from loguru import logger
+
+from vimms.MzmlWriter import StreamingMzmlWriter
+from vimms.ScanStore import ScanStoreWriter
+
+
+class ScanSink(object):
+    """
+    A consumer of the scans produced during a simulation, e.g. a file writer or a live metrics reporter.
+    AsyncEnvironment runs every sink concurrently with the simulation, each sink in its own worker thread, so
+    blocking I/O in a sink doesn't stall scan generation. Scans are passed to a sink in acquisition order.
+    """
+
+    def open(self, environment):
+        """
+        Called once before the first scan is produced
+        :param environment: the environment running the simulation
+        :return: None
+        """
+        pass
+
+    def handle_scan(self, scan):
+        """
+        Called for every scan, after the controller has handled it and its scan duration is known
+        :param scan: the scan
+        :return: None
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Called once after the last scan has been handled
+        :return: None
+        """
+        pass
+
+
+class MzmlSink(ScanSink):
+    """
+    Writes scans to an mzML file as they arrive, see MzmlWriter.StreamingMzmlWriter
+    """
+
+    def __init__(self, out_file, analysis_name='my_analysis', compression='zlib'):
+        """
+        Creates an mzML sink
+        :param out_file: the output mzML file
+        :param analysis_name: the analysis name stored in the mzML file
+        :param compression: the compression of the binary arrays, one of the keys of MzmlWriter.COMPRESSION_TYPES
+        """
+        self.out_file = out_file
+        self.analysis_name = analysis_name
+        self.compression = compression
+        self.writer = None
+
+    def open(self, environment):
+        logger.debug('Streaming mzML file to %s' % self.out_file)
+        self.writer = StreamingMzmlWriter(self.analysis_name, self.out_file, compression=self.compression)
+        self.writer.open()
+
+    def handle_scan(self, scan):
+        self.writer.write_scan(scan)
+
+    def close(self):
+        self.writer.close()
+        self.writer = None
+        logger.debug('mzML file successfully written!')
+
+
+class ScanStoreSink(ScanSink):
+    """
+    Writes scans to a columnar scan store as they arrive, see ScanStore.ScanStoreWriter.
+    The store can be exported to mzML later with ScanStore.write_mzML.
+    """
+
+    def __init__(self, path, analysis_name='my_analysis'):
+        """
+        Creates a scan store sink
+        :param path: the store directory
+        :param analysis_name: the analysis name, used when the store is exported to mzML
+        """
+        self.path = path
+        self.analysis_name = analysis_name
+        self.writer = None
+
+    def open(self, environment):
+        logger.debug('Storing scans to %s' % self.path)
+        self.writer = ScanStoreWriter(self.path, analysis_name=self.analysis_name)
+        self.writer.open()
+
+    def handle_scan(self, scan):
+        self.writer.write_scan(scan)
+
+    def close(self):
+        self.writer.close()
+        self.writer = None
+
+
+class MetricsSink(ScanSink):
+    """
+    Keeps live metrics about the simulation: the number of scans per ms level, the current retention time and the
+    simulation throughput. Metrics can be polled with get_metrics() or pushed to a callback.
+    """
+
+    def __init__(self, callback=None, report_every=100):
+        """
+        Creates a metrics sink
+        :param callback: if provided, called with the metrics dictionary every report_every scans and at the end
+        :param report_every: the number of scans between calls to callback
+        """
+        self.callback = callback
+        self.report_every = report_every
+        self.n_scans = defaultdict(int)  # key: ms level, value: number of scans
+        self.rt = None
+        self.start_time = None
+
+    def open(self, environment):
+        self.n_scans = defaultdict(int)
+        self.rt = None
+        self.start_time = time.time()
+
+    def handle_scan(self, scan):
+        self.n_scans[scan.ms_level] += 1
+        self.rt = scan.rt
+        if self.callback is not None and sum(self.n_scans.values()) % self.report_every == 0:
+            self.callback(self.get_metrics())
+
+    def close(self):
+        if self.callback is not None:
+            self.callback(self.get_metrics())
+
+    def get_metrics(self):
+        """
+        Returns the current metrics
+        :return: a dictionary of metrics
+        """
+        total = sum(self.n_scans.values())
+        elapsed = time.time() - self.start_time if self.start_time is not None else 0
+        return {
+            'n_scans': dict(self.n_scans),
+            'total_scans': total,
+            'rt': self.rt,
+            'elapsed': elapsed,
+            'scans_per_second': total / elapsed if elapsed > 0 else 0
+        }
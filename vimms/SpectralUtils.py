@@ -4,7 +4,8 @@ import pandas as pd
 import pymzml
 from loguru import logger
 
-from vimms.Common import get_rt
+from vimms.Common import get_rt, get_rng
+from vimms.MassSpec import Peak, Scan
 from vimms.Roi import make_roi, RoiToChemicalCreator
 
 
@@ -48,56 +49,217 @@ def get_precursor_info(fragfile):
     run = pymzml.run.Reader(fragfile, obo_version='4.0.1',
                             MS1_Precision=5e-6,
                             extraAccessions=[('MS:1000016', ['value', 'unitName'])])
-
-    last_ms1_peaklist = None
-    last_ms1_scan_no = 0
-    isolation_width = 1.0  # Dalton
-    data = []
+    extractor = PrecursorInfoExtractor()
     for scan_no, scan in enumerate(run):
-        if scan.ms_level == 1:  # save the last ms1 scan that we've seen
-            last_ms1_peaklist = _get_peaks(scan)
-            last_ms1_scan_no = scan_no
+        extractor.add_scan(scan_no, scan.ms_level, get_rt(scan), scan.mz, scan.i, scan.selected_precursors)
+    return extractor.get_precursor_info()
+
+
+class PrecursorInfoExtractor(object):
+    """
+    Matches MS2 scans to their precursor peaks in the previous MS1 scan, one scan at a time, so that it can be done
+    while the scans of an mzML file are read for other purposes
+    """
+
+    def __init__(self, isolation_width=1.0):
+        """
+        Creates a precursor info extractor
+        :param isolation_width: the isolation width (in Dalton) used to find precursor peaks in MS1 scans
+        """
+        self.isolation_width = isolation_width
+        self.last_ms1_peaklist = None
+        self.last_ms1_scan_no = 0
+        self.data = []
+
+    def add_scan(self, scan_no, ms_level, scan_rt, mzs, intensities, precursors):
+        """
+        Processes the next scan of a file
+        :param scan_no: the scan number
+        :param ms_level: the ms level of the scan
+        :param scan_rt: the retention time of the scan, in seconds
+        :param mzs: the m/z values of the scan
+        :param intensities: the intensities of the scan
+        :param precursors: the selected precursors of the scan, as returned by pymzml
+        :return: None
+        """
+        if ms_level == 1:  # save the last ms1 scan that we've seen
+            self.last_ms1_peaklist = _make_peaklist(mzs, scan_rt, intensities)
+            self.last_ms1_scan_no = scan_no
 
         # TODO: it's better to use the "isolation window target m/z" field in the mzML file for matching
-        precursors = scan.selected_precursors
         if len(precursors) > 0:
             assert len(precursors) == 1  # assume exactly 1 precursor peak for each ms2 scan
             precursor = precursors[0]
 
             try:
-                scan_rt = get_rt(scan)
                 precursor_mz = precursor['mz']
                 precursor_intensity = precursor['i']
-                res = _find_precursor_peaks(precursor, last_ms1_peaklist, last_ms1_scan_no,
-                                            isolation_width=isolation_width)
-                ms2_peaklist = _get_peaks(scan)
+                res = _find_precursor_peaks(precursor, self.last_ms1_peaklist, self.last_ms1_scan_no,
+                                            isolation_width=self.isolation_width)
+                ms2_peaklist = _make_peaklist(mzs, scan_rt, intensities)
                 row = [scan_no, scan_rt, precursor_mz, precursor_intensity, ms2_peaklist]
                 row.extend(res)
-                data.append(row)
+                self.data.append(row)
             except ValueError as e:
                 logger.warning(e)
             except KeyError as e:
-                continue  # sometimes we can't find the intensity value precursor['i'] in precursors
+                pass  # sometimes we can't find the intensity value precursor['i'] in precursors
+
+    def get_precursor_info(self):
+        """
+        Returns the precursor information of the scans processed so far
+        :return: a pandas dataframe that contains all the ms1 and ms2 information
+        """
+        columns = ['ms2_scan_id', 'ms2_scan_rt', 'ms2_precursor_mz', 'ms2_precursor_intensity', 'ms2_peaklist',
+                   'ms1_scan_id', 'ms1_scan_rt', 'ms1_mz', 'ms1_intensity']
+        df = pd.DataFrame(self.data, columns=columns)
+
+        # select only rows where we are sure of the matching, i.e. the intensity values aren't too different
+        df['intensity_diff'] = np.abs(df['ms2_precursor_intensity'] - df['ms1_intensity'])
+        idx = (df['intensity_diff'] < 0.1)
+        ms1_df = df[idx]
+        return ms1_df
+
+
+class MS2Library(object):
+    """
+    A library of MS2 spectra stored as columns: the fragment peaks of all spectra one after the other, with the start
+    of each spectrum in offsets, and one value per spectrum in the metadata columns.
+    Spectra are kept in their original order, and an index on precursor m/z is used for precursor window queries.
+    """
 
-    columns = ['ms2_scan_id', 'ms2_scan_rt', 'ms2_precursor_mz', 'ms2_precursor_intensity', 'ms2_peaklist',
-               'ms1_scan_id', 'ms1_scan_rt', 'ms1_mz', 'ms1_intensity']
-    df = pd.DataFrame(data, columns=columns)
+    def __init__(self, scan_ids, rts, precursor_mzs, precursor_rts, precursor_intensities, offsets, mzs, intensities):
+        """
+        Creates a library
+        :param scan_ids: the scan id of each spectrum
+        :param rts: the retention time of each spectrum
+        :param precursor_mzs: the m/z of the MS1 precursor peak of each spectrum
+        :param precursor_rts: the retention time of the MS1 precursor peak of each spectrum
+        :param precursor_intensities: the intensity of the MS1 precursor peak of each spectrum
+        :param offsets: the start of each spectrum in mzs and intensities, followed by the total number of peaks
+        :param mzs: the fragment m/z values of all spectra
+        :param intensities: the fragment intensities of all spectra
+        """
+        self.scan_ids = scan_ids
+        self.rts = rts
+        self.precursor_mzs = precursor_mzs
+        self.precursor_rts = precursor_rts
+        self.precursor_intensities = precursor_intensities
+        self.offsets = offsets
+        self.mzs = mzs
+        self.intensities = intensities
+        self.mz_order = np.argsort(precursor_mzs, kind='stable')
+        self.sorted_precursor_mzs = np.asarray(precursor_mzs)[self.mz_order]
 
-    # select only rows where we are sure of the matching, i.e. the intensity values aren't too different
-    df['intensity_diff'] = np.abs(df['ms2_precursor_intensity'] - df['ms1_intensity'])
-    idx = (df['intensity_diff'] < 0.1)
-    ms1_df = df[idx]
-    return ms1_df
+    def __len__(self):
+        return len(self.scan_ids)
+
+    def get_peaks(self, i):
+        """
+        Returns the fragment peaks of a spectrum, without copying them
+        :param i: the position of the spectrum in the library
+        :return: a tuple of the m/z and intensity arrays of the spectrum
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mzs[start:end], self.intensities[start:end]
+
+    def get_total_intensities(self):
+        """
+        Returns the sum of the fragment intensities of each spectrum
+        :return: an array with one value per spectrum
+        """
+        totals = np.zeros(len(self))
+        non_empty = np.diff(self.offsets) > 0  # reduceat would give empty spectra the next intensity instead of 0
+        if np.any(non_empty):
+            totals[non_empty] = np.add.reduceat(self.intensities, self.offsets[:-1][non_empty])
+        return totals
+
+    def query(self, min_mz=None, max_mz=None):
+        """
+        Finds the spectra with a precursor in an m/z window
+        :param min_mz: the minimum precursor m/z, or None
+        :param max_mz: the maximum precursor m/z, or None
+        :return: the positions of the matching spectra, in library order
+        """
+        lo = 0 if min_mz is None else np.searchsorted(self.sorted_precursor_mzs, min_mz, side='left')
+        hi = len(self) if max_mz is None else np.searchsorted(self.sorted_precursor_mzs, max_mz, side='right')
+        return np.sort(self.mz_order[lo:hi])
+
+    def sample(self, N=1, min_mz=None, max_mz=None, rng=None):
+        """
+        Draws spectra without replacement, optionally within a precursor m/z window
+        :param N: the number of spectra, all the matching spectra are returned if there are fewer than N
+        :param min_mz: the minimum precursor m/z, or None
+        :param max_mz: the maximum precursor m/z, or None
+        :param rng: the random number generator, None to use the global numpy random state
+        :return: the positions of the drawn spectra
+        """
+        if min_mz is None and max_mz is None:
+            candidates = np.arange(len(self))
+        else:
+            candidates = self.query(min_mz, max_mz)
+        if len(candidates) == 0:
+            return candidates
+        return candidates[get_rng(rng).choice(len(candidates), replace=False, size=min(N, len(candidates)))]
+
+    def get_scans(self, idx):
+        """
+        Creates MS2 scans for spectra of the library, with their precursor peak as parent
+        :param idx: the positions of the spectra
+        :return: a list of MassSpec.Scan objects
+        """
+        scans = []
+        for i in idx:
+            parent_peak = Peak(self.precursor_mzs[i], self.precursor_rts[i], self.precursor_intensities[i], 1)
+            mzs, intensities = self.get_peaks(i)
+            scans.append(Scan(self.scan_ids[i], mzs, intensities, 2, self.rts[i], parent=parent_peak))
+        return scans
+
+
+def make_ms2_library(precursor_infos):
+    """
+    Creates an MS2 library from the precursor information of mzML files
+    :param precursor_infos: a list of dataframes returned by get_precursor_info, or with the same columns
+    :return: an MS2Library object
+    """
+    df = pd.concat(precursor_infos)
+    peaklists = list(df['ms2_peaklist'])
+    peaks = np.concatenate(peaklists) if len(peaklists) > 0 else np.empty((0, 3))
+    offsets = np.cumsum([0] + [len(peaklist) for peaklist in peaklists])
+    precursor_rts = df['ms1_scan_rt'].values.astype(np.float64)
+    if 'ms2_scan_rt' in df:
+        rts = df['ms2_scan_rt'].values.astype(np.float64)
+    else:
+        rts = get_spectrum_rts(offsets, peaks[:, 1], precursor_rts)
+    return MS2Library(df.index.values.astype(np.int64), rts,
+                      df['ms1_mz'].values.astype(np.float64),
+                      precursor_rts,
+                      df['ms1_intensity'].values.astype(np.float64),
+                      offsets,
+                      np.ascontiguousarray(peaks[:, 0]), np.ascontiguousarray(peaks[:, 2]))
+
+
+def get_spectrum_rts(offsets, peak_rts, precursor_rts):
+    """
+    Returns the retention time of MS2 spectra stored without it, from the retention time kept with each of their peaks
+    :param offsets: the start of each spectrum in peak_rts, followed by the total number of peaks
+    :param peak_rts: the retention time of each peak, which is the retention time of its spectrum
+    :param precursor_rts: the retention time of the precursor of each spectrum, used for spectra without peaks
+    :return: an array with one retention time per spectrum
+    """
+    offsets = np.asarray(offsets)
+    rts = np.array(precursor_rts, dtype=np.float64)
+    non_empty = np.diff(offsets) > 0
+    rts[non_empty] = np.asarray(peak_rts)[offsets[:-1][non_empty]]
+    return rts
 
 
 ########################################################################################################################
 # Private methods
 ########################################################################################################################
 
-def _get_peaks(spectrum):
-    mzs = spectrum.mz
-    rts = [get_rt(spectrum)] * len(mzs)
-    intensities = spectrum.i
+def _make_peaklist(mzs, rt, intensities):
+    rts = [rt] * len(mzs)
     peaklist = np.stack([mzs, rts, intensities], axis=1)
     return peaklist
 
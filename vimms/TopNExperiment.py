@@ -2,11 +2,12 @@ import os
 
 from loguru import logger
 
-from vimms.Common import save_obj, create_if_not_exist, set_log_level_debug, set_log_level_warning
+from vimms.Common import save_obj, create_if_not_exist, set_log_level_debug, set_log_level_warning, RandomStreams
 from vimms.Controller import TopNController
 from vimms.DataGenerator import DataSource, PeakSampler
 from vimms.Environment import Environment
 from vimms.MassSpec import IndependentMassSpectrometer
+from vimms.Parallel import SharedObjectStore, run_jobs, resolve_shared
 
 
 ########################################################################################################################
@@ -39,7 +40,10 @@ def run_experiment(param):
             max_rt = param['max_rt']
             peak_sampler = get_peak_sampler(mzml_path, fragfile, min_rt, max_rt)
 
-        mass_spec = IndependentMassSpectrometer(param['ionisation_mode'], param['data'], peak_sampler)
+        # experiments sharing a seed draw the same scan durations (common random numbers)
+        seed = param.get('seed')
+        rng = RandomStreams(seed).get('mass_spec') if seed is not None else None
+        mass_spec = IndependentMassSpectrometer(param['ionisation_mode'], param['data'], peak_sampler, rng=rng)
         controller = TopNController(param['ionisation_mode'], param['N'], param['isolation_width'],
                                     param['mz_tol'], param['rt_tol'], param['min_ms1_intensity'])
         # create an environment to run both the mass spec and controller
@@ -78,6 +82,30 @@ def run_parallel_experiment(params):
         logger.debug(analysis_name)
 
 
+def run_batch_experiment(params, max_workers=None, pbar=True):
+    '''
+    Runs experiments in parallel using a local process pool. The chemicals and peak sampler shared by the
+    parameters are published once to memory-mapped files, so each job only carries its small parameters.
+    :param params: the experimental parameter
+    :param max_workers: the maximum number of worker processes, defaults to the number of CPUs
+    :param pbar: True if a progress bar is to be shown
+    :return: a list of Parallel.JobResult in the same order as params. Failed experiments have their error set.
+    '''
+    with SharedObjectStore() as store:
+        jobs = [store.publish_values(param, ['data', 'peak_sampler']) for param in params]
+        results = run_jobs(_run_shared_experiment, jobs, max_workers=max_workers, progress_bar=pbar,
+                           desc='Experiments')
+    for param, result in zip(params, results):
+        if not result.success:
+            logger.warning('Failed %s' % param['analysis_name'])
+    return results
+
+
+def _run_shared_experiment(param):
+    param = {k: resolve_shared(v) for k, v in param.items()}
+    return run_experiment(param)
+
+
 def run_serial_experiment(params):
     '''
     Runs experiments serially
@@ -93,7 +121,7 @@ def run_serial_experiment(params):
 
 def get_params(experiment_name, Ns, rt_tols, mz_tol, isolation_width, ionisation_mode, data, peak_sampler,
                min_ms1_intensity, min_rt, max_rt,
-               out_dir, pbar, mzml_path=None, fragfiles=None):
+               out_dir, pbar, mzml_path=None, fragfiles=None, seed=None):
     '''
     Creates a list of experimental parameters
     :param experiment_name: current experimental name
@@ -109,6 +137,8 @@ def get_params(experiment_name, Ns, rt_tols, mz_tol, isolation_width, ionisation
     :param max_rt: end RT to simulate
     :param out_dir: output directory
     :param pbar: progress bar to update
+    :param seed: if provided, all experiments use random streams derived from this seed, so they can be compared
+    using common random numbers
     :return: a list of parameters
     '''
     create_if_not_exist(out_dir)
@@ -140,6 +170,8 @@ def get_params(experiment_name, Ns, rt_tols, mz_tol, isolation_width, ionisation
                 param_dict['mzml_path'] = mzml_path
             if fragfiles is not None:
                 param_dict['fragfiles'] = fragfiles
+            if seed is not None:
+                param_dict['seed'] = seed
             params.append(param_dict)
     logger.debug('len(params) =', len(params))
     return params
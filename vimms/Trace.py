@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+from loguru import logger
+
+from vimms.Common import create_if_not_exist
+
+# one record per scan handled by the controller, packed to keep trace files small. n_tasks is the number of tasks the
+# controller returned for the scan; the task channel is emptied into the mass spec straight away, so its depth over
+# time isn't recorded
+TRACE_DTYPE = np.dtype([
+    ('scan_id', '<i4'),
+    ('rt', '<f8'),
+    ('ms_level', '<u1'),
+    ('scan_channel_size', '<u4'),
+    ('n_tasks', '<u4'),
+    ('processing_queue_size', '<u4'),
+    ('controller_latency', '<f4'),
+])
+
+
+class TraceRecorder(object):
+    """
+    Records a structured trace of a simulation, one record per scan handled by the controller.
+    Environments only call into the recorder when one is attached, so running without a recorder costs nothing.
+    """
+
+    def __init__(self, out_file=None, chunk_size=4096):
+        """
+        Creates a trace recorder
+        :param out_file: if provided, the trace is written to this file in .npy format when the recorder is closed
+        :param chunk_size: the number of records to preallocate at a time
+        """
+        self.out_file = out_file
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.current = np.zeros(self.chunk_size, dtype=TRACE_DTYPE)
+        self.pos = 0
+
+    def record(self, scan_id, rt, ms_level, scan_channel_size, n_tasks, processing_queue_size,
+               controller_latency):
+        """
+        Adds a new record to the trace
+        :param scan_id: the scan id
+        :param rt: the retention time of the scan
+        :param ms_level: the ms level of the scan
+        :param scan_channel_size: the number of scans waiting in the environment scan channel when this scan was taken
+        from it, including this scan
+        :param n_tasks: the number of new tasks returned by the controller for this scan, i.e. the number of scan
+        parameters put in the environment task channel
+        :param processing_queue_size: the number of scan parameters in the mass spec processing queue
+        :param controller_latency: the wall-clock time (in seconds) the controller spent handling the scan
+        :return: None
+        """
+        if self.pos == self.chunk_size:
+            self.chunks.append(self.current)
+            self.current = np.zeros(self.chunk_size, dtype=TRACE_DTYPE)
+            self.pos = 0
+        self.current[self.pos] = (scan_id, rt, ms_level, scan_channel_size, n_tasks,
+                                  processing_queue_size, controller_latency)
+        self.pos += 1
+
+    def get_trace(self):
+        """
+        Returns all the records collected so far
+        :return: a numpy structured array with TRACE_DTYPE
+        """
+        return np.concatenate(self.chunks + [self.current[:self.pos]])
+
+    def close(self):
+        """
+        Writes the trace to out_file, if set
+        :return: None
+        """
+        if self.out_file is None:
+            return
+        create_if_not_exist(os.path.dirname(self.out_file))
+        trace = self.get_trace()
+        with open(self.out_file, 'wb') as f:
+            np.save(f, trace, allow_pickle=False)
+        logger.debug('Written %d trace records to %s' % (len(trace), self.out_file))
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks) + self.pos
+
+
+def load_trace(filename):
+    """
+    Loads a trace written by TraceRecorder
+    :param filename: the trace file
+    :return: a numpy structured array with TRACE_DTYPE
+    """
+    return np.load(filename, allow_pickle=False)